@@ -110,6 +110,9 @@ connectToMongoDB();
 
 // RAG server configuration
 const RAG_SERVER_URL = 'http://localhost:5002';
+// Deadline for an answer, queueing included; the RAG server rejects requests
+// it cannot start in time with 503 rather than letting them pile up
+const RAG_TIMEOUT_MS = parseInt(process.env.RAG_TIMEOUT_MS || '60000', 10);
 let ragServer = null;
 
 // Start the RAG server
@@ -278,6 +281,70 @@ async function generateEmbeddings(text) {
   }
 }
 
+// Chunk embeddings are stored and sent as a base64 buffer of little-endian
+// float32 values ({ dtype, shape, data }) instead of JSON float lists, which
+// are several times larger and dominate parse time
+function encodeEmbeddings(vectors) {
+  const dimension = vectors.length > 0 ? vectors[0].length : 0;
+  const packed = new Float32Array(vectors.length * dimension);
+  vectors.forEach((vector, i) => packed.set(vector, i * dimension));
+  return {
+    dtype: 'float32',
+    shape: [vectors.length, dimension],
+    data: Buffer.from(packed.buffer).toString('base64')
+  };
+}
+
+// Turn stored chunk embeddings back into one Float32Array per chunk;
+// documents saved before the binary format hold plain arrays
+function decodeEmbeddings(payload) {
+  if (!payload || Array.isArray(payload)) {
+    return payload || [];
+  }
+  if (payload.dtype !== 'float32') {
+    throw new Error(`Unsupported embedding encoding: ${payload.dtype}`);
+  }
+  const bytes = Buffer.from(payload.data, 'base64');
+  // Copy into a fresh ArrayBuffer: pooled Buffers can start at an unaligned offset
+  const values = new Float32Array(bytes.buffer.slice(bytes.byteOffset, bytes.byteOffset + bytes.length));
+  const [count, dimension] = payload.shape;
+  const rows = [];
+  for (let i = 0; i < count; i++) {
+    rows.push(values.subarray(i * dimension, (i + 1) * dimension));
+  }
+  return rows;
+}
+
+// Function to generate embeddings for many texts with a single batched request.
+// Resolves to { embeddings, isMock }; mock embeddings must never be indexed
+async function generateEmbeddingsBatch(texts) {
+  if (texts.length === 0) {
+    return { embeddings: [], isMock: false };
+  }
+
+  try {
+    const response = await axios.post(`${SEMANTIC_SEARCH_URL}/embed`, {
+      texts: texts,
+      encoding: 'float32'
+    }, {
+      timeout: 2000 + texts.length * 100 // Scale the timeout with the batch size
+    });
+
+    const embeddings = response.data && response.data.embeddings;
+    if (embeddings && embeddings.data !== undefined && embeddings.shape && embeddings.shape[0] === texts.length) {
+      console.log(`Using real embeddings from semantic search server for ${texts.length} texts`);
+      return { embeddings, isMock: false };
+    } else {
+      throw new Error('Invalid batch embedding response');
+    }
+  } catch (error) {
+    if (!error.message.includes('ECONNREFUSED') && !error.message.includes('404')) {
+      console.warn('Semantic search server not available, using mock embeddings');
+    }
+    return { embeddings: encodeEmbeddings(texts.map(text => generateMockEmbeddings(text))), isMock: true };
+  }
+}
+
 // Function to generate mock embeddings as fallback
 function generateMockEmbeddings(text) {
   // Create a deterministic but improved mock embedding
@@ -304,6 +371,54 @@ function generateMockEmbeddings(text) {
   return mockEmbedding;
 }
 
+// Chunk, embed and index a document in one pipelined pass on the semantic
+// search server. Resolves to { chunks, chunkEmbeddings } (embeddings computed
+// once, for both the index and storage), or null if the server is unavailable
+async function ingestDocument(documentId, text) {
+  try {
+    const response = await axios.post(`${SEMANTIC_SEARCH_URL}/ingest`, {
+      documentId,
+      text,
+      chunk_size: 500,
+      overlap: 100,
+      encoding: 'float32'
+    }, {
+      responseType: 'stream',
+      timeout: 10000 // until the stream starts
+    });
+
+    return await new Promise((resolve, reject) => {
+      let buffered = '';
+      let result = null;
+      response.data.on('data', data => {
+        buffered += data.toString('utf8');
+        let boundary;
+        while ((boundary = buffered.indexOf('\n\n')) !== -1) {
+          const block = buffered.slice(0, boundary);
+          buffered = buffered.slice(boundary + 2);
+          const event = (block.match(/^event: (.*)$/m) || [])[1];
+          const payload = JSON.parse((block.match(/^data: (.*)$/m) || [])[1] || '{}');
+          if (event === 'progress') {
+            console.log(`Ingest progress: ${payload.chunked} chunked, ${payload.embedded} embedded, ${payload.indexed} indexed`);
+          } else if (event === 'done') {
+            console.log(`Ingested ${payload.total_chunks} chunks in ${payload.total_seconds}s`);
+            result = { chunks: payload.chunks, chunkEmbeddings: payload.embeddings };
+          } else if (event === 'error') {
+            reject(new Error(payload.message));
+          }
+        }
+      });
+      response.data.on('end', () => result ? resolve(result) : reject(new Error('Ingest stream ended early')));
+      response.data.on('error', reject);
+    });
+  } catch (error) {
+    if (!error.message.includes('ECONNREFUSED') && !error.message.includes('404')) {
+      console.warn('Pipelined ingest failed, chunking and embedding separately:', error.message);
+    }
+    return null;
+  }
+}
+
 // Helper function to chunk document text with semantic awareness
 async function chunkDocumentText(text) {
   try {
@@ -454,20 +569,29 @@ app.post('/api/documents/upload', upload.single('document'), async (req, res) =>
     console.log('Generating document embeddings...');
     const embeddings = await generateEmbeddings(text);
     
-    // Chunk the text with semantic awareness
-    console.log('Chunking document text...');
-    const chunks = await chunkDocumentText(text);
+    // The ID is chosen up front so the search server can index the document
+    // while it is chunked and embedded
+    const { ObjectId } = require('mongodb');
+    const docId = useInMemoryStorage ? Date.now().toString() : new ObjectId().toString();
+    
+    // Chunk, embed and index in one pipelined pass; fall back to separate
+    // chunking and embedding calls if the search server cannot ingest
+    console.log('Ingesting document text...');
+    let chunks;
+    let chunkEmbeddings;
+    let mockEmbeddings = false;
+    const ingested = await ingestDocument(docId, text);
+    if (ingested) {
+      ({ chunks, chunkEmbeddings } = ingested);
+    } else {
+      console.log('Chunking document text...');
+      chunks = await chunkDocumentText(text);
+      console.log('Generating chunk embeddings...');
+      ({ embeddings: chunkEmbeddings, isMock: mockEmbeddings } =
+        await generateEmbeddingsBatch(chunks.map(chunk => chunk.text)));
+    }
     console.log(`Created ${chunks.length} chunks`);
     
-    // Generate embeddings for each chunk in parallel
-    console.log('Generating chunk embeddings...');
-    const chunkEmbeddingsPromises = chunks.map(async (chunk) => {
-      return await generateEmbeddings(chunk.text);
-    });
-    
-    // Wait for all chunk embeddings to complete
-    const chunkEmbeddings = await Promise.all(chunkEmbeddingsPromises);
-    
     // Create document record with enhanced metadata
     const newDoc = {
       name: req.file.originalname,
@@ -480,11 +604,9 @@ app.post('/api/documents/upload', upload.single('document'), async (req, res) =>
       processingMethod: 'semantic_chunking'
     };
     
-    let docId;
-    
     if (useInMemoryStorage) {
       // Use in-memory storage
-      newDoc._id = Date.now().toString();
+      newDoc._id = docId;
       newDoc.chunks = chunks;
       inMemoryDocuments.push(newDoc);
       
@@ -498,10 +620,9 @@ app.post('/api/documents/upload', upload.single('document'), async (req, res) =>
         dimensions: embeddings.length
       };
       inMemoryEmbeddings.push(embeddingDoc);
-      
-      docId = newDoc._id;
     } else {
       // Insert document into MongoDB
+      newDoc._id = new ObjectId(docId);
       newDoc.chunks = chunks;
       const result = await db.collection('documents').insertOne(newDoc);
       
@@ -514,28 +635,31 @@ app.post('/api/documents/upload', upload.single('document'), async (req, res) =>
         model: 'improved_embeddings',
         dimensions: embeddings.length
       });
-      
-      docId = result.insertedId.toString();
     }
     
-    // Index the document in the semantic search server
-    try {
-      console.log('Indexing document in semantic search server...');
-      const indexResponse = await axios.post(`${SEMANTIC_SEARCH_URL}/index`, {
-        documentId: docId,
-        chunks: chunks
-      }, {
-        timeout: 10000 // 10 second timeout for indexing
-      });
-      
-      if (indexResponse.data && indexResponse.data.status === 'success') {
-        console.log(`Successfully indexed document ${docId} in semantic search server`);
-      } else {
-        console.warn(`Failed to index document ${docId}:`, indexResponse.data?.message || 'Unknown error');
+    // Index the document in the semantic search server, unless the pipelined
+    // ingest already did. Real stored embeddings are sent so nothing is
+    // re-encoded; mock ones are left out so the server encodes the chunks itself
+    if (!ingested) {
+      try {
+        console.log('Indexing document in semantic search server...');
+        const indexRequest = { documentId: docId, chunks: chunks };
+        if (!mockEmbeddings) {
+          indexRequest.embeddings = chunkEmbeddings;
+        }
+        const indexResponse = await axios.post(`${SEMANTIC_SEARCH_URL}/index`, indexRequest, {
+          timeout: 10000 // 10 second timeout for indexing
+        });
+        
+        if (indexResponse.data && indexResponse.data.status === 'success') {
+          console.log(`Successfully indexed document ${docId} in semantic search server`);
+        } else {
+          console.warn(`Failed to index document ${docId}:`, indexResponse.data?.message || 'Unknown error');
+        }
+      } catch (indexError) {
+        console.error('Error indexing document in semantic search server:', indexError.message);
+        // Don't fail the upload if indexing fails - the document is still saved
       }
-    } catch (indexError) {
-      console.error('Error indexing document in semantic search server:', indexError.message);
-      // Don't fail the upload if indexing fails - the document is still saved
     }
 
     return res.status(201).json({
@@ -600,9 +724,6 @@ app.post('/api/search', async (req, res) => {
     
     console.log(`Processing search query: "${query}" for document: ${documentId}`);
     
-    // Generate embedding for the query
-    const queryEmbedding = await generateEmbeddings(query);
-    
     // Get document and its embeddings
     let document, embeddings;
     
@@ -634,11 +755,13 @@ app.post('/api/search', async (req, res) => {
     
     try {
       console.log('Sending search request to semantic search server...');
-      // Call the new simplified semantic search server
+      // Hybrid retrieval: FAISS and BM25 run side by side in the search
+      // service over precomputed indexes, and the rankings are fused there
       const response = await axios.post(`${SEMANTIC_SEARCH_URL}/search`, {
         documentId: documentId,
         query: query,
-        top_k: topK
+        top_k: topK,
+        mode: 'hybrid'
       }, {
         timeout: 5000 // 5 second timeout
       });
@@ -662,7 +785,7 @@ app.post('/api/search', async (req, res) => {
           documentName: document.name,
           total_chunks: document.chunks?.length || 0,
           query: query,
-          search_method: 'semantic'
+          search_method: response.data.search_mode || 'semantic'
         });
       } else {
         throw new Error('Invalid response from semantic search server');
@@ -671,8 +794,9 @@ app.post('/api/search', async (req, res) => {
       console.error('Error calling semantic search server:', error.message);
       console.log('Using fallback search method');
       
-      // Enhanced fallback search
-      const results = enhancedFallbackSearch(query, queryEmbedding, document.chunks, embeddings.chunkEmbeddings, queryTerms, topK);
+      // Enhanced fallback search; only this path needs the query embedding here
+      const queryEmbedding = await generateEmbeddings(query);
+      const results = enhancedFallbackSearch(query, queryEmbedding, document.chunks, decodeEmbeddings(embeddings.chunkEmbeddings), queryTerms, topK);
       
       return res.status(200).json({
         success: true,
@@ -993,7 +1117,7 @@ app.get('/api/documents/:id', async (req, res) => {
 // Enhanced question answering endpoint
 app.post('/api/qa', async (req, res) => {
   try {
-    const { documentId, question } = req.body;
+    const { documentId, question, stream = false } = req.body;
 
     if (!documentId || !question) {
       return res.status(400).json({ success: false, message: 'Document ID and question are required' });
@@ -1049,8 +1173,10 @@ app.post('/api/qa', async (req, res) => {
 
     // Step 2: Perform semantic search to get relevant chunks
     let relevantChunks = [];
+    let queryEmbedding = null;
     try {
-        const queryEmbedding = await generateEmbeddings(question);
+        // Scored server-side in one NumPy pass, even if the document was never indexed
+        queryEmbedding = await generateEmbeddings(question);
         const searchResponse = await axios.post(`${SEMANTIC_SEARCH_URL}/search`, {
             query: question,
             document_chunks: document.chunks,
@@ -1072,13 +1198,15 @@ app.post('/api/qa', async (req, res) => {
         if (!searchError.message.includes('ECONNREFUSED') && !searchError.message.includes('404')) {
             console.warn('Semantic search server not available, using fallback search');
         }
-        const queryEmbedding = await generateEmbeddings(question);
+        if (!queryEmbedding) {
+            queryEmbedding = await generateEmbeddings(question);
+        }
         const fallbackQueryTerms = queryTerms.length > 0 ? queryTerms : question.split(' ').filter(term => term.length > 2 && !['and', 'the', 'for', 'with', 'that', 'this', 'from', 'what', 'when', 'where', 'which', 'who', 'why', 'how'].includes(term.toLowerCase()));
         relevantChunks = enhancedFallbackSearch(
             question,
             queryEmbedding,
             document.chunks,
-            embeddings.chunkEmbeddings,
+            decodeEmbeddings(embeddings.chunkEmbeddings),
             fallbackQueryTerms,
             8 // Use a slightly smaller topK for fallback
         );
@@ -1107,10 +1235,43 @@ app.post('/api/qa', async (req, res) => {
     }));
     
     try {
+      if (stream) {
+        // Relay the RAG server's Server-Sent Events so the answer renders as
+        // it is generated; the retrieved context is sent up front
+        const ragStream = await axios.post(`${RAG_SERVER_URL}/answer`, {
+          question,
+          context_chunks: contextChunks,
+          stream: true,
+          timeout_ms: RAG_TIMEOUT_MS
+        }, {
+          responseType: 'stream',
+          timeout: RAG_TIMEOUT_MS + 5000 // until the stream starts
+        });
+        res.writeHead(200, {
+          'Content-Type': 'text/event-stream',
+          'Cache-Control': 'no-cache',
+          Connection: 'keep-alive'
+        });
+        res.write(`event: context\ndata: ${JSON.stringify({
+          context: relevantChunks.map(chunk => ({
+            ...chunk,
+            relevance_score: Math.round((chunk.similarity || 0) * 100),
+            preview: chunk.text.substring(0, 150) + (chunk.text.length > 150 ? '...' : '')
+          })),
+          document_name: document.name
+        })}\n\n`);
+        ragStream.data.pipe(res);
+        req.on('close', () => ragStream.data.destroy());
+        return;
+      }
+
       // Call enhanced RAG server
       const ragResponse = await axios.post(`${RAG_SERVER_URL}/answer`, {
         question,
-        context_chunks: contextChunks  // Send structured context
+        context_chunks: contextChunks,  // Send structured context
+        timeout_ms: RAG_TIMEOUT_MS
+      }, {
+        timeout: RAG_TIMEOUT_MS + 5000 // a little slack over the server-side deadline
       });
       
       // Enhanced response with better metadata
@@ -1127,7 +1288,11 @@ app.post('/api/qa', async (req, res) => {
         model_used: ragResponse.data.model_used || 'enhanced_rag_system'
       });
     } catch (error) {
-      console.error('Error calling RAG server, generating fallback answer:', error.message);
+      if (error.response && error.response.status === 503) {
+        console.warn(`RAG server overloaded (retry after ${error.response.headers['retry-after']}s), generating fallback answer`);
+      } else {
+        console.error('Error calling RAG server, generating fallback answer:', error.message);
+      }
       
       // Enhanced fallback response with structured context
       const fallbackAnswer = generateFallbackAnswer(question, contextChunks);
@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import logging
+import urllib.request
+import numpy as np
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Callable, Set
+
+from embedding_cache import normalize_text
+
+DEFAULT_MAX_ANSWERS = int(os.environ.get('ANSWER_CACHE_SIZE', 1000))
+DEFAULT_TTL_SECONDS = float(os.environ.get('ANSWER_CACHE_TTL', 3600))
+# Cosine similarity two questions need to share an answer
+DEFAULT_SIMILARITY_THRESHOLD = float(os.environ.get('ANSWER_CACHE_SIMILARITY', 0.92))
+# After a failed question embedding (e.g. the embedding model is not pulled)
+# the semantic tier is switched off for this long instead of failing per request
+SEMANTIC_RETRY_SECONDS = float(os.environ.get('ANSWER_CACHE_SEMANTIC_RETRY', 600))
+# RAG server holding the cache, told by the search servers when a document's
+# chunks change so answers built from the old text are dropped
+RAG_SERVER_URL = os.environ.get('RAG_SERVER_URL', 'http://localhost:5002')
+INVALIDATE_TIMEOUT_SECONDS = 2.0
+
+def context_key(context_chunks: List[Dict[str, Any]]) -> str:
+    """
+    Order-independent key for the set of chunks an answer was built from.
+
+    Each chunk contributes its IDs and a hash of its text, so a chunk whose
+    text changed under the same IDs never matches an older answer.
+    """
+    ids = sorted(f"{chunk.get('document_id', '')}:{chunk.get('chunk_id', '')}:"
+                 f"{hashlib.sha1(chunk.get('text', '').encode('utf-8')).hexdigest()}"
+                 for chunk in context_chunks)
+    return hashlib.sha256('|'.join(ids).encode('utf-8')).hexdigest()
+
+def notify_invalidation(document_id: str, rag_server_url: str = RAG_SERVER_URL):
+    """
+    Ask the RAG server to drop cached answers built from a document.
+
+    Called by the search servers after a document's chunks change. The
+    request runs on a background thread and failures are only logged: the
+    RAG server may not be running, and answers keyed by chunk text cannot
+    be served for changed chunks anyway.
+    """
+    def send():
+        try:
+            request = urllib.request.Request(
+                f'{rag_server_url}/invalidate',
+                data=json.dumps({'document_id': str(document_id)}).encode('utf-8'),
+                headers={'Content-Type': 'application/json'},
+                method='POST'
+            )
+            with urllib.request.urlopen(request, timeout=INVALIDATE_TIMEOUT_SECONDS) as response:
+                removed = json.loads(response.read() or b'{}').get('invalidated', 0)
+            if removed:
+                logging.info(f"Invalidated {removed} cached answers for document {document_id}")
+        except Exception as e:
+            logging.debug(f"Could not invalidate cached answers for document {document_id}: {e}")
+
+    threading.Thread(target=send, name=f'invalidate-{document_id}', daemon=True).start()
+
+class _Entry:
+    def __init__(self, answer: Dict[str, Any], context: str, document_ids: Set[str],
+                 embedding: Optional[np.ndarray], expires_at: float):
+        self.answer = answer
+        self.context = context
+        self.document_ids = document_ids
+        self.embedding = embedding
+        self.expires_at = expires_at
+
+class AnswerCache:
+    """
+    Two-tier cache of generated answers.
+
+    The exact tier is keyed by (model, normalized question, context chunk
+    IDs). On a miss, the semantic tier compares the question embedding with
+    cached questions that were answered from the same context chunks and
+    reuses the closest answer above a cosine threshold, so rephrasings of
+    the same question skip generation too.
+
+    Entries expire after a TTL and the least recently used entry is evicted
+    when the cache is full. The context key includes each chunk's text, so
+    edited chunks never match old answers, and invalidate_document() (the
+    /invalidate endpoint, called by the search servers whenever a document's
+    chunks change) frees the answers built from a document right away.
+
+    If embedding a question fails, the semantic tier is disabled for
+    SEMANTIC_RETRY_SECONDS and the cache serves exact matches only.
+    """
+    def __init__(self, embed_fn: Optional[Callable[[str], Any]] = None,
+                 max_items: int = DEFAULT_MAX_ANSWERS, ttl_seconds: float = DEFAULT_TTL_SECONDS,
+                 similarity_threshold: float = DEFAULT_SIMILARITY_THRESHOLD):
+        self.embed_fn = embed_fn
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._by_context: Dict[str, Set[str]] = {}
+        self._by_document: Dict[str, Set[str]] = {}
+        self._semantic_disabled_until = 0.0
+        self._lock = threading.Lock()
+        self.stats = {'exact_hits': 0, 'semantic_hits': 0, 'misses': 0,
+                      'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    def prepare(self, question: str, model_name: str, context_chunks: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Build the lookup for one question; pass it to get() and then put().
+        """
+        context = context_key(context_chunks)
+        exact = hashlib.sha256(f'{model_name}\n{normalize_text(question)}\n{context}'.encode('utf-8')).hexdigest()
+        return {
+            'key': exact,
+            'context': f'{model_name}:{context}',
+            'question': question,
+            'document_ids': {str(chunk.get('document_id', '')) for chunk in context_chunks},
+            'embedding': None
+        }
+
+    def _embed(self, lookup: Dict[str, Any]) -> Optional[np.ndarray]:
+        if lookup['embedding'] is None and self.embed_fn is not None:
+            if time.monotonic() < self._semantic_disabled_until:
+                return None
+            try:
+                vector = np.asarray(self.embed_fn(lookup['question']), dtype='float32')
+                norm = np.linalg.norm(vector)
+                lookup['embedding'] = vector / norm if norm > 0 else vector
+            except Exception as e:
+                # The semantic tier is an optimisation; fall back to exact
+                # matching rather than paying a failing call on every request
+                self._semantic_disabled_until = time.monotonic() + SEMANTIC_RETRY_SECONDS
+                logging.warning(f"Could not embed question for the answer cache, disabling semantic "
+                                f"matching for {SEMANTIC_RETRY_SECONDS:.0f}s: {e}")
+        return lookup['embedding']
+
+    def _drop(self, key: str):
+        # Callers hold self._lock
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        keys = self._by_context.get(entry.context)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_context[entry.context]
+        for document_id in entry.document_ids:
+            keys = self._by_document.get(document_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_document[document_id]
+
+    def _live(self, key: str, now: float) -> Optional[_Entry]:
+        # Callers hold self._lock
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= now:
+            self._drop(key)
+            self.stats['expirations'] += 1
+            return None
+        return entry
+
+    def get(self, lookup: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Return a cached answer for the lookup, or None.
+
+        The returned answer carries 'cache': 'exact' or 'semantic'.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._live(lookup['key'], now)
+            if entry is not None:
+                self._entries.move_to_end(lookup['key'])
+                self.stats['exact_hits'] += 1
+                return {**entry.answer, 'cache': 'exact'}
+            has_candidates = bool(self._by_context.get(lookup['context']))
+
+        if has_candidates:
+            # Embed outside the lock; it is a model call
+            embedding = self._embed(lookup)
+            if embedding is not None:
+                with self._lock:
+                    candidates = [(key, self._live(key, now)) for key in list(self._by_context.get(lookup['context'], ()))]
+                    candidates = [(key, entry) for key, entry in candidates
+                                  if entry is not None and entry.embedding is not None
+                                  and entry.embedding.shape == embedding.shape]
+                    if candidates:
+                        similarities = np.stack([entry.embedding for _, entry in candidates]) @ embedding
+                        best = int(np.argmax(similarities))
+                        if similarities[best] >= self.similarity_threshold:
+                            key, entry = candidates[best]
+                            self._entries.move_to_end(key)
+                            self.stats['semantic_hits'] += 1
+                            return {**entry.answer, 'cache': 'semantic',
+                                    'cache_similarity': round(float(similarities[best]), 4)}
+
+        with self._lock:
+            self.stats['misses'] += 1
+        return None
+
+    def put(self, lookup: Dict[str, Any], answer: Dict[str, Any]):
+        """
+        Store a generated answer under the lookup built by prepare().
+        """
+        embedding = self._embed(lookup)
+        with self._lock:
+            key = lookup['key']
+            self._drop(key)
+            self._entries[key] = _Entry(answer, lookup['context'], lookup['document_ids'], embedding,
+                                        time.monotonic() + self.ttl_seconds)
+            self._by_context.setdefault(lookup['context'], set()).add(key)
+            for document_id in lookup['document_ids']:
+                self._by_document.setdefault(document_id, set()).add(key)
+            while len(self._entries) > self.max_items:
+                self._drop(next(iter(self._entries)))
+                self.stats['evictions'] += 1
+
+    def invalidate_document(self, document_id: str) -> int:
+        """
+        Drop every answer built from a document's chunks.
+
+        Returns:
+            Number of answers removed
+        """
+        with self._lock:
+            keys = list(self._by_document.get(str(document_id), ()))
+            for key in keys:
+                self._drop(key)
+            self.stats['invalidations'] += len(keys)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_context.clear()
+            self._by_document.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            hits = self.stats['exact_hits'] + self.stats['semantic_hits']
+            lookups = hits + self.stats['misses']
+            return {
+                **self.stats,
+                'hits': hits,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'items': len(self._entries),
+                'semantic_enabled': self.embed_fn is not None and time.monotonic() >= self._semantic_disabled_until
+            }
@@ -0,0 +1,381 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from typing import List, Dict, Any, Optional, Tuple, Iterator
+
+from semantic_search import (
+    build_id_index, normalize_embeddings, semantic_chunk_text,
+    DEFAULT_METRIC, METRIC_COSINE, METRIC_L2, INDEX_AUTO, INDEX_TYPES,
+    DEFAULT_CHUNK_SIZE, DEFAULT_OVERLAP
+)
+from vector_store import VectorStore, DEFAULT_DATA_DIR
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+DEFAULT_MODEL = 'all-MiniLM-L6-v2'
+# Default scratch directory for a rebuild (backend/data/bulk_index)
+DEFAULT_WORK_DIR = os.environ.get(
+    'BULK_INDEX_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'bulk_index')
+)
+# Torch threads per worker process. Small MiniLM batches gain little from
+# intra-op threading, so several single-threaded processes beat one wide one
+DEFAULT_THREADS_PER_WORKER = int(os.environ.get('BULK_INDEX_THREADS', 1))
+# Chunks per shard: the unit of work handed to a worker and of checkpointing
+DEFAULT_SHARD_SIZE = int(os.environ.get('BULK_INDEX_SHARD_SIZE', 2048))
+DEFAULT_ENCODE_BATCH_SIZE = 64
+
+MANIFEST_FILE = 'manifest.json'
+EMBEDDINGS_FILE = 'embeddings.f32'
+CHECKPOINT_FILE = 'checkpoint.jsonl'
+
+# Environment variables that size the BLAS/OpenMP thread pools torch uses.
+# They must be set before a worker imports torch, so they are exported
+# before the pool spawns its processes
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+
+# Per-process state of a pool worker, set up by _init_worker
+_worker: Dict[str, Any] = {}
+
+def _init_worker(model_name: str, threads: int, core_sets: Optional[List[List[int]]],
+                 slots: Any, batch_size: int):
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    with slots.get_lock():
+        slot = slots.value
+        slots.value += 1
+    if core_sets:
+        # Give each worker its own cores so workers do not migrate and
+        # thrash each other's caches
+        os.sched_setaffinity(0, core_sets[slot % len(core_sets)])
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Only allowed before any parallel work has run
+        pass
+
+    _worker['model'] = SentenceTransformer(model_name, device='cpu')
+    _worker['batch_size'] = batch_size
+
+def _worker_dimension() -> int:
+    # Asked of a worker, whose model is already loaded, so the parent never
+    # loads a model of its own
+    return int(_worker['model'].get_sentence_embedding_dimension())
+
+def _embed_shard(task: Tuple[int, np.ndarray, List[str], str, Tuple[int, int]]) -> Tuple[int, float]:
+    shard_id, rows, texts, embeddings_path, shape = task
+    started = time.monotonic()
+    vectors = _worker['model'].encode(texts, batch_size=_worker['batch_size'],
+                                      convert_to_numpy=True, show_progress_bar=False)
+    if 'embeddings' not in _worker:
+        # Opened on the first shard: the file is created once a worker has
+        # reported the model's dimension
+        _worker['embeddings'] = np.memmap(embeddings_path, dtype='float32', mode='r+', shape=shape)
+    embeddings = _worker['embeddings']
+    embeddings[rows] = vectors.astype('float32', copy=False)
+    # Flushed before the shard is reported, so a checkpointed shard is on disk
+    embeddings.flush()
+    return shard_id, time.monotonic() - started
+
+def _chunk_dict(chunk: Any) -> Dict[str, Any]:
+    # Chunk lists may hold plain strings as well as chunk dictionaries
+    return {'text': chunk} if isinstance(chunk, str) else chunk
+
+def load_store_documents(store: VectorStore) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+    """
+    Yield (document_id, chunks) for every document in a vector store,
+    whatever model built it.
+    """
+    for document_id in sorted(store.list_documents()):
+        chunks = store.load_chunks(document_id)
+        if chunks:
+            yield document_id, chunks
+
+def load_jsonl_documents(path: str, target_size: int = DEFAULT_CHUNK_SIZE,
+                         overlap: int = DEFAULT_OVERLAP) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+    """
+    Yield (document_id, chunks) from a JSON-lines file, one document per line.
+
+    Lines may be exports of the backend's `documents` collection (`_id` and
+    `chunks`), or objects with `documentId` and either `chunks` or `text`;
+    plain text is chunked with semantic_chunk_text.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            document_id = record.get('documentId', record.get('_id'))
+            if isinstance(document_id, dict):
+                # mongoexport writes ObjectIds as {"$oid": "..."}
+                document_id = document_id.get('$oid')
+            if document_id is None:
+                logging.warning(f"Skipping line {line_number} of {path}: no document ID")
+                continue
+            chunks = record.get('chunks')
+            if not chunks and record.get('text'):
+                chunks = semantic_chunk_text(record['text'], target_size, overlap)
+            if chunks:
+                yield str(document_id), chunks
+
+def _fingerprint(model_name: str, documents: List[Tuple[str, List[Dict[str, Any]]]], shard_size: int) -> str:
+    digest = hashlib.sha1(f'{model_name}:{shard_size}'.encode('utf-8'))
+    for document_id, chunks in documents:
+        digest.update(b'\0' + str(document_id).encode('utf-8'))
+        for chunk in chunks:
+            digest.update(b'\1' + chunk.get('text', '').encode('utf-8'))
+    return digest.hexdigest()
+
+def plan_shards(texts: List[str], shard_size: int) -> List[np.ndarray]:
+    """
+    Split row numbers into shards of texts of similar length.
+
+    Rows are sorted by text length, longest first, so every encode batch
+    pads to about the same length and the slowest shards start first,
+    leaving short ones to even out the workers at the end.
+    """
+    lengths = np.fromiter((len(text) for text in texts), dtype='int64', count=len(texts))
+    order = np.argsort(-lengths, kind='stable')
+    return [order[start:start + shard_size] for start in range(0, len(order), shard_size)]
+
+def _core_sets(workers: int, threads: int) -> Optional[List[List[int]]]:
+    if not hasattr(os, 'sched_getaffinity'):
+        return None
+    cores = sorted(os.sched_getaffinity(0))
+    if workers * threads > len(cores):
+        # Oversubscribed; let the OS schedule rather than stack workers on shared cores
+        return None
+    return [cores[i * threads:(i + 1) * threads] for i in range(workers)]
+
+def _create_embeddings_file(manifest_path: str, embeddings_path: str, fingerprint: str, model_name: str,
+                            total: int, shard_size: int, dimension: int) -> Dict[str, Any]:
+    manifest = {
+        'fingerprint': fingerprint,
+        'model': model_name,
+        'dimension': dimension,
+        'total': total,
+        'shard_size': shard_size
+    }
+    # Preallocate the file; workers fill in their rows
+    np.memmap(embeddings_path, dtype='float32', mode='w+', shape=(total, dimension)).flush()
+    # The manifest marks a usable file, so it is written last
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    return manifest
+
+class _Checkpoint:
+    """
+    Append-only log of finished shards and indexed documents.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.shards = set()
+        self.documents = set()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A torn last line from a crash; that step is simply redone
+                        continue
+                    if 'shard' in entry:
+                        self.shards.add(entry['shard'])
+                    elif 'document' in entry:
+                        self.documents.add(entry['document'])
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def record(self, **entry: Any):
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+def bulk_index(documents: List[Tuple[str, List[Dict[str, Any]]]], store: VectorStore,
+               model_name: str = DEFAULT_MODEL, work_dir: str = DEFAULT_WORK_DIR,
+               workers: Optional[int] = None, threads_per_worker: int = DEFAULT_THREADS_PER_WORKER,
+               shard_size: int = DEFAULT_SHARD_SIZE, batch_size: int = DEFAULT_ENCODE_BATCH_SIZE,
+               metric: str = DEFAULT_METRIC, index_type: str = INDEX_AUTO) -> Dict[str, Any]:
+    """
+    Re-embed and re-index many documents using every core.
+
+    Chunks of all documents are sorted by length, split into shards and
+    encoded by a pool of worker processes, each with its own model copy and
+    a fixed number of torch threads (pinned to its own cores where the OS
+    allows). Workers write straight into a memory-mapped embedding file in
+    `work_dir`, and finished shards are checkpointed, so an interrupted run
+    started again with the same documents resumes where it stopped. Each
+    document's index is then built from its rows and saved to the store.
+
+    Args:
+        documents: (document_id, chunks) pairs; chunks are dictionaries
+            with 'text' or plain strings
+        store: Vector store receiving the rebuilt indexes
+        model_name: Sentence-transformers model to embed with
+        work_dir: Scratch directory for the embedding file and checkpoints
+        workers: Worker processes (defaults to cores / threads_per_worker)
+        threads_per_worker: Torch threads in each worker
+        shard_size: Chunks per unit of work
+        batch_size: Chunks per forward pass within a worker
+        metric: 'cosine' or 'l2', as used by the search servers
+        index_type: One of INDEX_TYPES
+
+    Returns:
+        Summary with document, chunk and shard counts and timings
+    """
+    started = time.monotonic()
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 1) // threads_per_worker)
+    documents = [(document_id, [_chunk_dict(chunk) for chunk in chunks]) for document_id, chunks in documents]
+    texts = [chunk.get('text', '') for _, chunks in documents for chunk in chunks]
+    total = len(texts)
+    if total == 0:
+        raise ValueError("No chunks to index")
+
+    os.makedirs(work_dir, exist_ok=True)
+    manifest_path = os.path.join(work_dir, MANIFEST_FILE)
+    embeddings_path = os.path.join(work_dir, EMBEDDINGS_FILE)
+    checkpoint_path = os.path.join(work_dir, CHECKPOINT_FILE)
+    fingerprint = _fingerprint(model_name, documents, shard_size)
+
+    manifest = None
+    if os.path.exists(manifest_path) and os.path.exists(embeddings_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('fingerprint') != fingerprint:
+            logging.info("Documents or settings changed since the last run; starting over")
+            manifest = None
+    if manifest is None:
+        for path in (manifest_path, embeddings_path, checkpoint_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    checkpoint = _Checkpoint(checkpoint_path)
+    shards = plan_shards(texts, shard_size)
+    pending = [shard_id for shard_id in range(len(shards)) if shard_id not in checkpoint.shards]
+    if len(pending) < len(shards):
+        logging.info(f"Resuming: {len(shards) - len(pending)} of {len(shards)} shards already embedded")
+
+    try:
+        encode_seconds = 0.0
+        if pending:
+            workers = min(workers, len(pending))
+            saved_env = {name: os.environ.get(name) for name in THREAD_ENV_VARS}
+            os.environ.update({name: str(threads_per_worker) for name in THREAD_ENV_VARS})
+            # Spawned rather than forked: forking a process that has touched
+            # torch's thread pools can deadlock the children
+            context = multiprocessing.get_context('spawn')
+            try:
+                # A worker that dies (e.g. out of memory) breaks the executor
+                # and fails the run, rather than hanging it like a Pool would
+                with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                                         initargs=(model_name, threads_per_worker,
+                                                   _core_sets(workers, threads_per_worker), context.Value('i', 0),
+                                                   batch_size)) as executor:
+                    if manifest is None:
+                        manifest = _create_embeddings_file(
+                            manifest_path, embeddings_path, fingerprint, model_name, total, shard_size,
+                            executor.submit(_worker_dimension).result())
+                    shape = (total, manifest['dimension'])
+                    logging.info(f"Embedding {total} chunks in {len(pending)} shards with {workers} workers "
+                                 f"x {threads_per_worker} threads")
+                    futures = [executor.submit(_embed_shard, (shard_id, shards[shard_id],
+                                                              [texts[row] for row in shards[shard_id]],
+                                                              embeddings_path, shape))
+                               for shard_id in pending]
+                    for done, future in enumerate(as_completed(futures), 1):
+                        shard_id, seconds = future.result()
+                        checkpoint.record(shard=shard_id)
+                        encode_seconds += seconds
+                        logging.info(f"Shard {shard_id} embedded in {seconds:.2f}s ({done}/{len(pending)})")
+            finally:
+                for name, value in saved_env.items():
+                    if value is None:
+                        os.environ.pop(name, None)
+                    else:
+                        os.environ[name] = value
+        embed_seconds = time.monotonic() - started
+
+        embeddings = np.memmap(embeddings_path, dtype='float32', mode='r', shape=(total, manifest['dimension']))
+        indexed = 0
+        offset = 0
+        for document_id, chunks in documents:
+            rows = slice(offset, offset + len(chunks))
+            offset += len(chunks)
+            if document_id in checkpoint.documents:
+                continue
+            vectors = np.array(embeddings[rows])
+            if metric == METRIC_COSINE:
+                vectors = normalize_embeddings(vectors)
+            ids = np.arange(len(chunks), dtype='int64')
+            index = build_id_index(vectors, ids, metric, index_type)
+            # Same layout Searcher persists, so the servers load it as-is
+            store.save(document_id, index, vectors, chunks, {'metric': metric, 'next_id': len(chunks)}, ids=ids)
+            checkpoint.record(document=document_id)
+            indexed += 1
+        del embeddings
+    finally:
+        checkpoint.close()
+
+    # Finished; the next run is a fresh rebuild rather than a no-op resume
+    for path in (checkpoint_path, manifest_path, embeddings_path):
+        os.remove(path)
+
+    return {
+        'documents': len(documents),
+        'documents_indexed': indexed,
+        'chunks': total,
+        'shards': len(shards),
+        'shards_embedded': len(pending),
+        'workers': workers if pending else 0,
+        'encode_seconds': round(encode_seconds, 3),
+        'embed_seconds': round(embed_seconds, 3),
+        'total_seconds': round(time.monotonic() - started, 3)
+    }
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Re-embed and re-index documents with a pool of worker processes.')
+    parser.add_argument('--input', help='JSON-lines file of documents (e.g. a mongoexport of '
+                                        'the documents collection); defaults to every stored document')
+    parser.add_argument('--store-dir', default=DEFAULT_DATA_DIR, help='Vector store directory')
+    parser.add_argument('--work-dir', default=DEFAULT_WORK_DIR, help='Scratch directory for embeddings and checkpoints')
+    parser.add_argument('--model', default=DEFAULT_MODEL, help='Sentence-transformers model')
+    parser.add_argument('--workers', type=int, help='Worker processes (default: cores / threads)')
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS_PER_WORKER, help='Torch threads per worker')
+    parser.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE, help='Chunks per shard')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_ENCODE_BATCH_SIZE, help='Chunks per forward pass')
+    parser.add_argument('--metric', default=DEFAULT_METRIC, choices=(METRIC_COSINE, METRIC_L2))
+    parser.add_argument('--index-type', default=os.environ.get('SEARCH_INDEX_TYPE', INDEX_AUTO), choices=INDEX_TYPES)
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Words per chunk for plain-text input')
+    parser.add_argument('--overlap', type=int, default=DEFAULT_OVERLAP, help='Overlap in words for plain-text input')
+    args = parser.parse_args(argv)
+
+    store = VectorStore(args.store_dir, model_name=args.model)
+    if args.input:
+        documents = list(load_jsonl_documents(args.input, args.chunk_size, args.overlap))
+    else:
+        documents = list(load_store_documents(store))
+    if not documents:
+        logging.error("No documents to index")
+        return 1
+
+    summary = bulk_index(documents, store, args.model, args.work_dir, args.workers, args.threads,
+                         args.shard_size, args.batch_size, args.metric, args.index_type)
+    logging.info(f"Bulk indexing finished: {json.dumps(summary)}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+import os
+import re
+import logging
+import threading
+from typing import List, Dict, Any, Optional, Set, Tuple
+
+try:
+    from transformers import AutoTokenizer
+    TRANSFORMERS_AVAILABLE = True
+except ImportError:
+    TRANSFORMERS_AVAILABLE = False
+
+from inverted_index import tokenize, STOP_WORDS
+
+# Hugging Face tokenizers for the Ollama model families used for generation,
+# so budgets are counted in the model's own tokens. Meta's repositories are
+# gated, so an ungated copy of the Llama 3.2 tokenizer is used
+GENERATION_TOKENIZERS = {
+    'llama3.2': 'unsloth/Llama-3.2-1B-Instruct'
+}
+# Overrides the tokenizer for every model, e.g. for a model family not above
+CONTEXT_TOKENIZER = os.environ.get('CONTEXT_TOKENIZER')
+# When no tokenizer can be loaded, estimated counts are inflated by this
+# fraction so packed context still fits the real budget
+ESTIMATE_SAFETY_MARGIN = 0.15
+# Prompt tokens available for context chunks
+DEFAULT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 1500))
+# Reduce chunks to the sentences that mention the question's terms
+DEFAULT_TRIM_SENTENCES = os.environ.get('CONTEXT_TRIM_SENTENCES', 'false').lower() in ('1', 'true', 'yes')
+
+# Word n-grams used to detect text repeated between chunks
+SHINGLE_SIZE = 8
+# Chunks mostly made of already-packed text are dropped outright
+DUPLICATE_THRESHOLD = 0.8
+
+SENTENCE_PATTERN = re.compile(r'(?<=[.!?])\s+|\n+')
+
+_tokenizers: Dict[str, Any] = {}
+_tokenizer_lock = threading.Lock()
+
+def tokenizer_name(model_name: Optional[str]) -> Optional[str]:
+    """
+    Hugging Face tokenizer to count tokens for an Ollama model, or None.
+    """
+    if CONTEXT_TOKENIZER:
+        return CONTEXT_TOKENIZER
+    if not model_name:
+        return None
+    return GENERATION_TOKENIZERS.get(model_name.split(':')[0])
+
+def _get_tokenizer(model_name: Optional[str]):
+    name = tokenizer_name(model_name)
+    if name is None or not TRANSFORMERS_AVAILABLE:
+        return None
+    if name not in _tokenizers:
+        with _tokenizer_lock:
+            if name not in _tokenizers:
+                try:
+                    _tokenizers[name] = AutoTokenizer.from_pretrained(name)
+                except Exception as e:
+                    logging.warning(f"Could not load tokenizer {name}, estimating token counts: {e}")
+                    # Remembered, so the download is not retried on every request
+                    _tokenizers[name] = None
+    return _tokenizers[name]
+
+def count_tokens(text: str, model_name: Optional[str] = None) -> int:
+    """
+    Count prompt tokens for text with the generation model's tokenizer,
+    or a conservative estimate when it is not available.
+    """
+    tokenizer = _get_tokenizer(model_name)
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False))
+    # Llama-style BPE averages about 1.3 tokens per English word
+    estimate = max(int(len(text.split()) * 1.3), len(text) // 4) + 1
+    return int(estimate * (1.0 + ESTIMATE_SAFETY_MARGIN)) + 1
+
+def _shingles(words: List[str]) -> List[Tuple[str, ...]]:
+    return [tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)]
+
+def _remove_overlap(text: str, seen: Set[Tuple[str, ...]]) -> Optional[str]:
+    """
+    Strip leading and trailing runs of text already packed.
+
+    Returns:
+        The remaining text, or None if the chunk is mostly a duplicate
+    """
+    words = text.split()
+    if len(words) < SHINGLE_SIZE:
+        return text
+    lowered = [word.lower() for word in words]
+    covered = [False] * len(words)
+    for i, shingle in enumerate(_shingles(lowered)):
+        if shingle in seen:
+            for j in range(i, i + SHINGLE_SIZE):
+                covered[j] = True
+    if sum(covered) >= DUPLICATE_THRESHOLD * len(words):
+        return None
+    if not covered[0] and not covered[-1]:
+        return text
+    start, end = 0, len(words)
+    while start < end and covered[start]:
+        start += 1
+    while end > start and covered[end - 1]:
+        end -= 1
+    return ' '.join(words[start:end])
+
+def _relevant_sentences(text: str, terms: Set[str], budget: Optional[int] = None,
+                        model_name: Optional[str] = None) -> str:
+    """
+    Keep the sentences that mention the most question terms, in their
+    original order, within an optional token budget.
+    """
+    sentences = [sentence.strip() for sentence in SENTENCE_PATTERN.split(text) if sentence.strip()]
+    scored = [(len(terms.intersection(tokenize(sentence))), i) for i, sentence in enumerate(sentences)]
+    ranked = sorted((item for item in scored if item[0] > 0), key=lambda item: (-item[0], item[1]))
+    if not ranked and budget is None:
+        return text
+
+    keep: List[int] = []
+    used = 0
+    for _, i in ranked:
+        cost = count_tokens(sentences[i], model_name)
+        if budget is not None and used + cost > budget:
+            continue
+        keep.append(i)
+        used += cost
+    return ' '.join(sentences[i] for i in sorted(keep))
+
+def pack_context(question: str, context_chunks: List[Dict[str, Any]],
+                 token_budget: int = DEFAULT_TOKEN_BUDGET,
+                 trim_sentences: bool = DEFAULT_TRIM_SENTENCES,
+                 model_name: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Select and trim context chunks to fit a prompt token budget.
+
+    Chunks are taken greedily by similarity. Text already packed (such as
+    the overlap between neighbouring chunks) is stripped, and near-duplicate
+    chunks are dropped. A chunk that does not fit the remaining budget is
+    cut down to its most relevant sentences.
+
+    Args:
+        question: The user's question
+        context_chunks: Candidate chunks with 'text' and 'similarity'
+        token_budget: Maximum tokens of context
+        trim_sentences: Reduce every chunk to its question-relevant sentences
+        model_name: Ollama generation model, whose tokenizer counts the tokens
+
+    Returns:
+        Tuple of (packed chunk copies, best first; info with 'tokens',
+        'budget', 'included' positions, 'dropped' and 'trimmed' counts, and
+        'counted_with': the tokenizer name or 'estimate')
+    """
+    terms = {term for term in tokenize(question) if len(term) > 2 and term not in STOP_WORDS}
+    order = sorted(range(len(context_chunks)), key=lambda i: context_chunks[i].get('similarity', 0), reverse=True)
+
+    packed: List[Dict[str, Any]] = []
+    included: List[int] = []
+    seen: Set[Tuple[str, ...]] = set()
+    used = 0
+    dropped = 0
+    trimmed = 0
+
+    for i in order:
+        chunk = context_chunks[i]
+        original = chunk.get('text', '')
+        text = _remove_overlap(original, seen)
+        if not text:
+            dropped += 1
+            continue
+        if trim_sentences and terms:
+            text = _relevant_sentences(text, terms, model_name=model_name)
+
+        cost = count_tokens(text, model_name)
+        remaining = token_budget - used
+        if cost > remaining:
+            # Too big for what is left: keep only its best sentences
+            text = _relevant_sentences(text, terms, remaining, model_name) if terms else ''
+            cost = count_tokens(text, model_name) if text else 0
+            if not text or cost > remaining:
+                dropped += 1
+                continue
+
+        if text != original:
+            trimmed += 1
+        seen.update(_shingles([word.lower() for word in text.split()]))
+        packed.append({**chunk, 'text': text})
+        included.append(i)
+        used += cost
+
+    return packed, {
+        'tokens': used,
+        'budget': token_budget,
+        'included': included,
+        'dropped': dropped,
+        'trimmed': trimmed,
+        'counted_with': tokenizer_name(model_name) if _get_tokenizer(model_name) is not None else 'estimate'
+    }
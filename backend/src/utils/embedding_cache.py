@@ -0,0 +1,184 @@
+import os
+import re
+import sqlite3
+import hashlib
+import threading
+import logging
+import numpy as np
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Callable
+
+# Default location for the on-disk cache (backend/data/embedding_cache.sqlite3)
+DEFAULT_CACHE_PATH = os.environ.get(
+    'EMBEDDING_CACHE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'embedding_cache.sqlite3')
+)
+DEFAULT_MEMORY_ITEMS = 10000
+DEFAULT_DISK_ITEMS = 500000
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize text before hashing so whitespace and case differences
+    do not produce separate cache entries.
+    """
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache keyed by (model name, normalized text hash).
+
+    An in-memory LRU sits in front of a SQLite table. Both tiers are size
+    bounded; the disk tier evicts the least recently used rows in batches.
+    """
+    def __init__(self, model_name: str, db_path: Optional[str] = DEFAULT_CACHE_PATH,
+                 max_memory_items: int = DEFAULT_MEMORY_ITEMS,
+                 max_disk_items: int = DEFAULT_DISK_ITEMS):
+        self.model_name = model_name
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._tick = 0
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+
+        self._db = None
+        if db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS embeddings ('
+                'key TEXT PRIMARY KEY, dtype TEXT, vector BLOB, last_used INTEGER)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS idx_last_used ON embeddings(last_used)')
+            row = self._db.execute('SELECT MAX(last_used) FROM embeddings').fetchone()
+            self._tick = row[0] or 0
+
+    def _key(self, text: str) -> str:
+        return f'{self.model_name}:{text_hash(text)}'
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def get_many(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        Look up cached embeddings. Missing entries are returned as None.
+        """
+        keys = [self._key(text) for text in texts]
+        results: List[Optional[np.ndarray]] = [None] * len(texts)
+        disk_lookups: Dict[str, List[int]] = {}
+
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    results[i] = vector
+                    self.stats['memory_hits'] += 1
+                else:
+                    disk_lookups.setdefault(key, []).append(i)
+
+            if disk_lookups and self._db is not None:
+                self._tick += 1
+                lookup_keys = list(disk_lookups)
+                # SQLite limits the number of bound parameters per statement
+                for start in range(0, len(lookup_keys), 500):
+                    batch = lookup_keys[start:start + 500]
+                    placeholders = ','.join('?' * len(batch))
+                    rows = self._db.execute(
+                        f'SELECT key, dtype, vector FROM embeddings WHERE key IN ({placeholders})', batch
+                    ).fetchall()
+                    for key, dtype, blob in rows:
+                        vector = np.frombuffer(blob, dtype=dtype)
+                        self._remember(key, vector)
+                        for i in disk_lookups.pop(key):
+                            results[i] = vector
+                            self.stats['disk_hits'] += 1
+                    self._db.executemany('UPDATE embeddings SET last_used = ? WHERE key = ?',
+                                         [(self._tick, key) for key, _, _ in rows])
+                self._db.commit()
+
+            self.stats['misses'] += sum(len(indices) for indices in disk_lookups.values())
+
+        return results
+
+    def put_many(self, texts: List[str], vectors: np.ndarray):
+        """
+        Store embeddings for the given texts in both tiers.
+        """
+        with self._lock:
+            rows = []
+            self._tick += 1
+            for text, vector in zip(texts, vectors):
+                key = self._key(text)
+                vector = np.array(vector, dtype='float32')
+                self._remember(key, vector)
+                rows.append((key, str(vector.dtype), vector.tobytes(), self._tick))
+
+            if self._db is not None and rows:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO embeddings (key, dtype, vector, last_used) VALUES (?, ?, ?, ?)', rows
+                )
+                self._evict_disk()
+                self._db.commit()
+
+    def _evict_disk(self):
+        count = self._db.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+        if count <= self.max_disk_items:
+            return
+        # Evict down to 90% of capacity so eviction does not run on every insert
+        excess = count - int(self.max_disk_items * 0.9)
+        self._db.execute(
+            'DELETE FROM embeddings WHERE key IN '
+            '(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)', (excess,)
+        )
+        self.stats['evictions'] += excess
+        logging.info(f"Evicted {excess} embeddings from the disk cache")
+
+    def encode(self, texts: List[str], encode_fn: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """
+        Return embeddings for texts, only calling encode_fn for cache misses.
+
+        Args:
+            texts: Texts to embed
+            encode_fn: Function that embeds a list of texts into a float32 matrix
+
+        Returns:
+            float32 matrix with one row per text, in input order
+        """
+        cached = self.get_many(texts)
+        missing = [i for i, vector in enumerate(cached) if vector is None]
+
+        if missing:
+            # Encode each distinct (normalized) missing text once
+            unique: "OrderedDict[str, str]" = OrderedDict()
+            for i in missing:
+                unique.setdefault(self._key(texts[i]), texts[i])
+            unique_texts = list(unique.values())
+            new_vectors = np.asarray(encode_fn(unique_texts), dtype='float32')
+            self.put_many(unique_texts, new_vectors)
+            by_key = dict(zip(unique.keys(), new_vectors))
+            for i in missing:
+                cached[i] = by_key[self._key(texts[i])]
+
+        if not cached:
+            return np.zeros((0, 0), dtype='float32')
+        return np.vstack(cached).astype('float32', copy=False)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            hits = self.stats['memory_hits'] + self.stats['disk_hits']
+            lookups = hits + self.stats['misses']
+            return {
+                **self.stats,
+                'hits': hits,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'memory_items': len(self._memory)
+            }
@@ -0,0 +1,67 @@
+import base64
+import numpy as np
+from typing import Any, Dict, List, Union
+
+# Wire formats for embeddings: plain JSON float lists, or base64-encoded
+# little-endian float32/float16 buffers carried inside the JSON body
+ENCODING_JSON = 'json'
+ENCODING_FLOAT32 = 'float32'
+ENCODING_FLOAT16 = 'float16'
+ENCODINGS = (ENCODING_JSON, ENCODING_FLOAT32, ENCODING_FLOAT16)
+
+_WIRE_DTYPES = {
+    ENCODING_FLOAT32: np.dtype('<f4'),
+    ENCODING_FLOAT16: np.dtype('<f2')
+}
+
+def encode_embeddings(embeddings: np.ndarray, encoding: str = ENCODING_JSON) -> Union[List[Any], Dict[str, Any]]:
+    """
+    Serialize a vector or matrix of embeddings for a JSON response.
+
+    Args:
+        embeddings: Vector or matrix of embeddings
+        encoding: 'json' for nested float lists, 'float32' or 'float16' for
+            a base64 buffer
+
+    Returns:
+        Nested lists for 'json', otherwise {'dtype', 'shape', 'data'}
+    """
+    if encoding == ENCODING_JSON:
+        return embeddings.tolist()
+    if encoding not in _WIRE_DTYPES:
+        raise ValueError(f"Unknown embedding encoding: {encoding}")
+    buffer = np.ascontiguousarray(embeddings, dtype=_WIRE_DTYPES[encoding])
+    return {
+        'dtype': encoding,
+        'shape': list(buffer.shape),
+        'data': base64.b64encode(buffer.tobytes()).decode('ascii')
+    }
+
+def decode_embeddings(payload: Any) -> np.ndarray:
+    """
+    Decode embeddings sent in either wire format.
+
+    Base64 buffers are viewed in place with np.frombuffer; only float16
+    input is converted, since the scoring code works in float32.
+
+    Returns:
+        float32 array (read-only when decoded from a float32 buffer)
+    """
+    if not isinstance(payload, dict):
+        return np.asarray(payload, dtype='float32')
+
+    encoding = payload.get('dtype', ENCODING_FLOAT32)
+    if encoding not in _WIRE_DTYPES:
+        raise ValueError(f"Unknown embedding encoding: {encoding}")
+    try:
+        raw = base64.b64decode(payload['data'], validate=True)
+    except (KeyError, ValueError) as e:
+        raise ValueError(f"Invalid embedding buffer: {e}")
+
+    array = np.frombuffer(raw, dtype=_WIRE_DTYPES[encoding])
+    if 'shape' in payload:
+        shape = tuple(int(size) for size in payload['shape'])
+        if int(np.prod(shape)) != array.size:
+            raise ValueError(f"Embedding buffer holds {array.size} values, expected shape {shape}")
+        array = array.reshape(shape)
+    return array.astype('float32', copy=False)
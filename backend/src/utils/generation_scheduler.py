@@ -0,0 +1,199 @@
+import os
+import time
+import heapq
+import itertools
+import threading
+from typing import Dict, Any, Optional
+
+# Request priorities; lower values are served first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+PRIORITIES = {'high': PRIORITY_HIGH, 'normal': PRIORITY_NORMAL, 'low': PRIORITY_LOW}
+
+# Requests allowed to wait for a generation slot; more are rejected outright
+DEFAULT_MAX_QUEUE = int(os.environ.get('GENERATION_MAX_QUEUE', 16))
+# Weight of the newest sample in the moving averages of wait and generation time
+SERVICE_TIME_SMOOTHING = 0.2
+# Shortest Retry-After sent with a rejection, in seconds
+MIN_RETRY_AFTER = 1
+
+class Overloaded(Exception):
+    """
+    Raised when a request cannot be scheduled within its deadline.
+    """
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = max(MIN_RETRY_AFTER, int(retry_after + 0.999))
+
+class _Waiter:
+    def __init__(self, priority: int, deadline: float):
+        self.priority = priority
+        self.deadline = deadline
+        self.granted = False
+        self.cancelled = False
+        self.evicted = False
+        self.event = threading.Event()
+
+class GenerationScheduler:
+    """
+    Admission control for LLM generations.
+
+    At most `max_concurrency` generations run at once. Further requests wait
+    in a priority queue (FIFO within a priority) for at most their deadline.
+    A request is rejected up front when the expected wait plus a typical
+    generation would overrun its deadline, so callers can back off instead
+    of queueing behind work they will never see finish. When the queue is
+    full, a new request displaces the lowest-priority waiter if it
+    outranks it, and is rejected otherwise.
+
+    The expected wait is estimated from a moving average of recent
+    generation times and the number of requests ahead in the queue.
+    """
+    def __init__(self, max_concurrency: int, max_queue: int = DEFAULT_MAX_QUEUE,
+                 default_deadline: float = 120.0):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.default_deadline = default_deadline
+        self._queue = []
+        self._sequence = itertools.count()
+        self._running = 0
+        self._queued = 0
+        self._service_seconds: Optional[float] = None
+        self._wait_seconds = 0.0
+        self._lock = threading.Lock()
+        self.stats = {'admitted': 0, 'rejected_queue_full': 0, 'rejected_deadline': 0, 'expired': 0,
+                      'evicted': 0}
+
+    def _expected_wait(self, ahead: int) -> float:
+        # Callers hold self._lock
+        if self._service_seconds is None or self._running < self.max_concurrency:
+            return 0.0
+        return self._service_seconds * (ahead // self.max_concurrency + 1)
+
+    def _reject(self, reason: str, message: str, retry_after: float) -> Overloaded:
+        # Callers hold self._lock
+        self.stats[reason] += 1
+        return Overloaded(message, retry_after)
+
+    def _evict_below(self, priority: int) -> bool:
+        """
+        Cancel the most recent waiter among those with the lowest priority,
+        if that priority is below `priority`. Its acquire() raises Overloaded.
+        """
+        # Callers hold self._lock
+        victim = None
+        for entry_priority, sequence, waiter in self._queue:
+            if waiter.cancelled or entry_priority <= priority:
+                continue
+            if victim is None or (entry_priority, sequence) > victim[:2]:
+                victim = (entry_priority, sequence, waiter)
+        if victim is None:
+            return False
+        waiter = victim[2]
+        waiter.cancelled = True
+        waiter.evicted = True
+        self._queued -= 1
+        self.stats['evicted'] += 1
+        waiter.event.set()
+        return True
+
+    def acquire(self, priority: int = PRIORITY_NORMAL, timeout: Optional[float] = None) -> float:
+        """
+        Wait for a generation slot.
+
+        Args:
+            priority: PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW
+            timeout: Seconds the whole request may take (defaults to default_deadline)
+
+        Returns:
+            Seconds spent waiting
+
+        Raises:
+            Overloaded: If the request cannot start in time to meet its deadline
+        """
+        started = time.monotonic()
+        budget = self.default_deadline if timeout is None else timeout
+        deadline = started + budget
+
+        with self._lock:
+            if self._running < self.max_concurrency and self._queued == 0:
+                self._running += 1
+                self.stats['admitted'] += 1
+                # No wait still counts toward the average
+                self._wait_seconds -= SERVICE_TIME_SMOOTHING * self._wait_seconds
+                return 0.0
+            ahead = sum(1 for entry in self._queue if not entry[2].cancelled and entry[0] <= priority)
+            expected = self._expected_wait(ahead)
+            service = self._service_seconds or 0.0
+            if expected + service > budget:
+                raise self._reject('rejected_deadline', 'Generation cannot start before the request deadline, please retry',
+                                   expected)
+            if self._queued >= self.max_queue and not self._evict_below(priority):
+                raise self._reject('rejected_queue_full', 'Generation queue is full, please retry',
+                                   self._expected_wait(self._queued))
+            waiter = _Waiter(priority, deadline - service)
+            heapq.heappush(self._queue, (priority, next(self._sequence), waiter))
+            self._queued += 1
+
+        waiter.event.wait(max(0.0, waiter.deadline - time.monotonic()))
+        with self._lock:
+            if not waiter.granted:
+                if not waiter.cancelled:
+                    # Gave up; release() skips cancelled entries
+                    waiter.cancelled = True
+                    self._queued -= 1
+                    self.stats['expired'] += 1
+                if waiter.evicted:
+                    raise Overloaded('Displaced from the generation queue by a higher-priority request, please retry',
+                                     self._expected_wait(self._queued))
+                raise Overloaded('Timed out waiting for a generation slot, please retry',
+                                 self._expected_wait(self._queued))
+            waited = time.monotonic() - started
+            self._wait_seconds += SERVICE_TIME_SMOOTHING * (waited - self._wait_seconds)
+            return waited
+
+    def release(self, service_seconds: Optional[float] = None):
+        """
+        Free a slot and hand it to the most urgent waiter still within its deadline.
+
+        Args:
+            service_seconds: How long the finished generation took, for wait estimates
+        """
+        now = time.monotonic()
+        with self._lock:
+            if service_seconds is not None:
+                if self._service_seconds is None:
+                    self._service_seconds = service_seconds
+                else:
+                    self._service_seconds += SERVICE_TIME_SMOOTHING * (service_seconds - self._service_seconds)
+            self._running -= 1
+            while self._queue and self._running < self.max_concurrency:
+                _, _, waiter = heapq.heappop(self._queue)
+                if waiter.cancelled:
+                    continue
+                if waiter.deadline <= now:
+                    # Too late to finish in time; wake it to fail instead
+                    waiter.cancelled = True
+                    self._queued -= 1
+                    self.stats['expired'] += 1
+                    waiter.event.set()
+                    continue
+                waiter.granted = True
+                self._queued -= 1
+                self._running += 1
+                self.stats['admitted'] += 1
+                waiter.event.set()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self.stats,
+                'running': self._running,
+                'queue_depth': self._queued,
+                'max_concurrency': self.max_concurrency,
+                'max_queue': self.max_queue,
+                'avg_wait_ms': round(self._wait_seconds * 1000.0, 1),
+                'avg_generation_ms': round(self._service_seconds * 1000.0, 1) if self._service_seconds is not None else None,
+                'expected_wait_ms': round(self._expected_wait(self._queued) * 1000.0, 1)
+            }
@@ -0,0 +1,168 @@
+import os
+import time
+import queue
+import threading
+import logging
+import numpy as np
+from typing import Any, Callable, Dict, Iterable, Iterator, List
+
+from semantic_search import Searcher, iter_semantic_chunks, DEFAULT_CHUNK_SIZE, DEFAULT_OVERLAP
+
+# Chunks encoded per model call
+DEFAULT_INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', 64))
+# Batches allowed to wait between two stages; a fast stage blocks once its
+# output queue is full, so memory stays bounded whatever the document size
+DEFAULT_INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', 4))
+# How often a blocked stage checks whether the pipeline was cancelled
+_POLL_SECONDS = 0.1
+
+_END = object()
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+def _put(target: queue.Queue, item: Any, cancelled: threading.Event) -> bool:
+    while not cancelled.is_set():
+        try:
+            target.put(item, timeout=_POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _get(source: queue.Queue, cancelled: threading.Event) -> Any:
+    while not cancelled.is_set():
+        try:
+            return source.get(timeout=_POLL_SECONDS)
+        except queue.Empty:
+            continue
+    return _END
+
+def _batched(chunks: Iterable[Dict[str, Any]], batch_size: int) -> Iterator[List[Dict[str, Any]]]:
+    batch = []
+    for chunk in chunks:
+        batch.append(chunk)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _run_stage(name: str, work: Callable[[], None], output: queue.Queue, cancelled: threading.Event):
+    # Stage threads always end their output with _END, after a _Failure if work() raised
+    try:
+        work()
+    except Exception as e:
+        logging.error(f"Ingest {name} stage failed: {e}", exc_info=True)
+        _put(output, _Failure(e), cancelled)
+    finally:
+        _put(output, _END, cancelled)
+
+def ingest_document(searcher: Searcher, document_id: str, lines: Iterable[str],
+                    target_size: int = DEFAULT_CHUNK_SIZE, overlap: int = DEFAULT_OVERLAP,
+                    batch_size: int = DEFAULT_INGEST_BATCH_SIZE,
+                    queue_size: int = DEFAULT_INGEST_QUEUE_SIZE) -> Iterator[Dict[str, Any]]:
+    """
+    Chunk, embed and index a document as a pipeline.
+
+    Chunking and encoding each run on their own thread and indexing runs on
+    the caller's, connected by bounded queues, so the three stages overlap
+    and the total time approaches that of the slowest stage. Every chunk is
+    encoded exactly once; the same embeddings are indexed and returned for
+    storage. Closing the generator early cancels the pipeline.
+
+    Args:
+        searcher: Searcher whose index receives the document
+        document_id: Document to (re)index
+        lines: Lines of the document text, e.g. an open file
+        target_size: Target chunk size in words
+        overlap: Overlap between chunks in words
+        batch_size: Chunks encoded per model call
+        queue_size: Batches buffered between stages
+
+    Yields:
+        {'type': 'progress', 'chunked', 'embedded', 'indexed'} after each
+        indexed batch, then one {'type': 'done', ...} event carrying the
+        chunks, their embeddings (float32 matrix), index details and the
+        busy time of each stage in seconds
+
+    Raises:
+        ValueError: If the document yields no chunks
+    """
+    started = time.monotonic()
+    cancelled = threading.Event()
+    chunk_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    embedding_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    counts = {'chunked': 0, 'embedded': 0, 'indexed': 0}
+    busy = {'chunk': 0.0, 'embed': 0.0, 'index': 0.0}
+
+    def chunk_stage():
+        chunks = _batched(iter_semantic_chunks(lines, target_size, overlap), batch_size)
+        while True:
+            stage_started = time.monotonic()
+            batch = next(chunks, None)
+            busy['chunk'] += time.monotonic() - stage_started
+            if batch is None:
+                return
+            counts['chunked'] += len(batch)
+            if not _put(chunk_queue, batch, cancelled):
+                return
+
+    def embed_stage():
+        while True:
+            batch = _get(chunk_queue, cancelled)
+            if batch is _END:
+                return
+            if isinstance(batch, _Failure):
+                _put(embedding_queue, batch, cancelled)
+                return
+            stage_started = time.monotonic()
+            embeddings = searcher.encode([chunk['text'] for chunk in batch])
+            busy['embed'] += time.monotonic() - stage_started
+            counts['embedded'] += len(batch)
+            if not _put(embedding_queue, (batch, embeddings), cancelled):
+                return
+
+    threads = [
+        threading.Thread(target=_run_stage, args=('chunk', chunk_stage, chunk_queue, cancelled),
+                         name=f'ingest-chunk-{document_id}', daemon=True),
+        threading.Thread(target=_run_stage, args=('embed', embed_stage, embedding_queue, cancelled),
+                         name=f'ingest-embed-{document_id}', daemon=True)
+    ]
+    for thread in threads:
+        thread.start()
+
+    try:
+        builder = searcher.document_builder(document_id)
+        parts: List[np.ndarray] = []
+        while True:
+            item = _get(embedding_queue, cancelled)
+            if item is _END:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+            batch, embeddings = item
+            stage_started = time.monotonic()
+            builder.add(batch, embeddings)
+            busy['index'] += time.monotonic() - stage_started
+            parts.append(embeddings)
+            counts['indexed'] += len(batch)
+            yield {'type': 'progress', **counts}
+
+        stage_started = time.monotonic()
+        document = builder.finish()
+        busy['index'] += time.monotonic() - stage_started
+        yield {
+            'type': 'done',
+            'document_id': document_id,
+            'chunks': document.chunks,
+            'embeddings': np.concatenate(parts) if len(parts) > 1 else parts[0],
+            'index_type': document.index_type,
+            'embedding_dimension': int(document.index.d),
+            'stage_seconds': {stage: round(seconds, 3) for stage, seconds in busy.items()},
+            'total_seconds': round(time.monotonic() - started, 3)
+        }
+    finally:
+        # Stops the stage threads if the consumer went away or a stage failed
+        cancelled.set()
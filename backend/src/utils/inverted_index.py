@@ -0,0 +1,150 @@
+import re
+import math
+import bisect
+from collections import defaultdict
+from typing import List, Dict, Tuple, Optional
+
+# BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Partial (prefix) matches count for this fraction of an exact match
+PARTIAL_MATCH_WEIGHT = 0.5
+# Shortest word or prefix that takes part in partial matching
+PREFIX_LENGTH = 3
+# Cap on the vocabulary terms one query word can expand to
+MAX_PARTIAL_TERMS = 50
+# Query terms shorter than this are ignored
+MIN_TERM_LENGTH = 2
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+# Words ignored when extracting keywords from questions
+STOP_WORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can', 'could', 'did', 'do', 'does',
+    'for', 'from', 'has', 'have', 'how', 'in', 'into', 'is', 'it', 'its', 'of', 'on', 'or',
+    'should', 'that', 'the', 'their', 'there', 'these', 'this', 'those', 'to', 'was', 'were',
+    'what', 'when', 'where', 'which', 'who', 'whom', 'why', 'will', 'with', 'would', 'you', 'your'
+}
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercase word tokens, shared by indexing and querying.
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+class InvertedIndex:
+    """
+    Lexical index over a list of chunk texts, built once at index time.
+
+    Holds postings (term -> [(chunk position, term frequency)]), chunk
+    lengths, document frequencies and a sorted vocabulary for prefix lookups,
+    so a query touches only the postings of its own terms instead of
+    re-tokenizing every chunk.
+    """
+    def __init__(self, texts: List[str], k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        self.doc_lengths: List[int] = []
+
+        for position, text in enumerate(texts):
+            tokens = tokenize(text)
+            self.doc_lengths.append(len(tokens))
+            frequencies: Dict[str, int] = {}
+            for token in tokens:
+                frequencies[token] = frequencies.get(token, 0) + 1
+            for term, tf in frequencies.items():
+                self.postings[term].append((position, tf))
+
+        self.postings = dict(self.postings)
+        self.num_docs = len(texts)
+        self.avg_doc_length = (sum(self.doc_lengths) / self.num_docs) if self.num_docs else 0.0
+
+        # Lucene-style BM25 IDF, which stays positive even for very common terms
+        self.idf: Dict[str, float] = {
+            term: math.log(1.0 + (self.num_docs - len(plist) + 0.5) / (len(plist) + 0.5))
+            for term, plist in self.postings.items()
+        }
+
+        # Sorted vocabulary doubles as a prefix index: all terms starting
+        # with a prefix form one contiguous, bisectable range
+        self.vocabulary: List[str] = sorted(self.postings)
+
+        # Per-chunk BM25 length normalisation, precomputed once
+        self._length_norms = [
+            k1 * (1.0 - b + b * (length / self.avg_doc_length)) if self.avg_doc_length else k1
+            for length in self.doc_lengths
+        ]
+
+    def partial_terms(self, word: str) -> List[str]:
+        """
+        Vocabulary terms that extend `word` or that `word` extends
+        (e.g. 'organ' -> 'organization', 'cells' -> 'cell').
+        """
+        matches = []
+        if len(word) >= PREFIX_LENGTH:
+            start = bisect.bisect_right(self.vocabulary, word)
+            for term in self.vocabulary[start:start + MAX_PARTIAL_TERMS]:
+                if not term.startswith(word):
+                    break
+                matches.append(term)
+        for end in range(max(PREFIX_LENGTH, MIN_TERM_LENGTH), len(word)):
+            if word[:end] in self.postings:
+                matches.append(word[:end])
+        return matches
+
+    def _term_scores(self, term: str, weight: float, scores: Dict[int, float]):
+        idf = self.idf[term] * weight
+        k1_plus_1 = self.k1 + 1.0
+        for position, tf in self.postings[term]:
+            score = idf * tf * k1_plus_1 / (tf + self._length_norms[position])
+            if score > scores.get(position, 0.0):
+                scores[position] = score
+
+    def max_score(self, query: str) -> float:
+        """
+        Upper bound of score() for this query, used to normalise scores to [0, 1].
+        """
+        total = 0.0
+        for word in set(tokenize(query)):
+            if len(word) < MIN_TERM_LENGTH:
+                continue
+            best = self.idf.get(word, 0.0)
+            for term in self.partial_terms(word):
+                best = max(best, self.idf[term] * PARTIAL_MATCH_WEIGHT)
+            total += best * (self.k1 + 1.0)
+        return total
+
+    def score(self, query: str) -> Dict[int, float]:
+        """
+        BM25 scores for the chunks that contain at least one query term.
+
+        Each query term contributes its best exact or partial match per
+        chunk; partial matches are discounted by PARTIAL_MATCH_WEIGHT.
+
+        Returns:
+            Mapping of chunk position to score (chunks without a match are absent)
+        """
+        totals: Dict[int, float] = {}
+        for word in set(tokenize(query)):
+            if len(word) < MIN_TERM_LENGTH:
+                continue
+            term_scores: Dict[int, float] = {}
+            if word in self.postings:
+                self._term_scores(word, 1.0, term_scores)
+            for term in self.partial_terms(word):
+                self._term_scores(term, PARTIAL_MATCH_WEIGHT, term_scores)
+            for position, score in term_scores.items():
+                totals[position] = totals.get(position, 0.0) + score
+        return totals
+
+    def search(self, query: str, top_k: Optional[int] = None) -> List[Tuple[int, float]]:
+        """
+        Rank matching chunks by BM25 score.
+
+        Returns:
+            List of (chunk position, score) tuples, best first
+        """
+        ranked = sorted(self.score(query).items(), key=lambda item: item[1], reverse=True)
+        return ranked[:top_k] if top_k is not None else ranked
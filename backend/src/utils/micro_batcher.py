@@ -0,0 +1,103 @@
+import os
+import time
+import queue
+import threading
+import logging
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+# Collection window and batch size, configurable per deployment
+DEFAULT_BATCH_WINDOW_MS = float(os.environ.get('BATCH_WINDOW_MS', 5))
+DEFAULT_MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 64))
+
+class MicroBatcher:
+    """
+    Dynamic batcher that merges work from concurrent callers.
+
+    Callers submit a list of items and block until their results are ready.
+    A single worker thread collects submissions for at most `max_wait_ms`
+    (or until `max_batch_size` items are queued), runs `process_fn` once
+    over all of them, and routes each slice of the output back to its
+    caller. The window bounds the extra latency any request can see, while
+    concurrent requests share one forward pass instead of many tiny ones.
+    """
+    def __init__(self, process_fn: Callable[[List[Any]], Sequence[Any]],
+                 max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                 max_wait_ms: float = DEFAULT_BATCH_WINDOW_MS,
+                 name: str = 'batcher'):
+        self.process_fn = process_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.name = name
+        self._queue: "queue.Queue" = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._latencies = deque(maxlen=1000)  # recent submit-to-result times, in seconds
+        self._worker = threading.Thread(target=self._run, name=f'{name}-worker', daemon=True)
+        self._worker.start()
+
+    def submit(self, items: List[Any], timeout: Optional[float] = None) -> Sequence[Any]:
+        """
+        Process items as part of the next batch.
+
+        Returns:
+            The slice of process_fn's output that corresponds to `items`
+        """
+        if not items:
+            return []
+        future: Future = Future()
+        self._queue.put((list(items), future, time.monotonic()))
+        return future.result(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            count = len(batch[0][0])
+            deadline = time.monotonic() + self.max_wait
+
+            while count < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                count += len(request[0])
+
+            flat_items = [item for items, _, _ in batch for item in items]
+            try:
+                results = self.process_fn(flat_items)
+            except Exception as e:
+                logging.error(f"{self.name}: batch of {len(flat_items)} items failed: {e}")
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            now = time.monotonic()
+            offset = 0
+            for items, future, submitted_at in batch:
+                future.set_result(results[offset:offset + len(items)])
+                offset += len(items)
+                self._latencies.append(now - submitted_at)
+
+            with self._stats_lock:
+                self._batches += 1
+                self._items += len(flat_items)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            batches, items = self._batches, self._items
+        latencies = sorted(self._latencies)
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0.0
+        return {
+            'batches': batches,
+            'items': items,
+            'mean_batch_size': items / batches if batches else 0.0,
+            'queue_depth': self._queue.qsize(),
+            'p99_latency_ms': p99 * 1000.0,
+            'max_wait_ms': self.max_wait * 1000.0
+        }
@@ -1,8 +1,11 @@
 import os
 import sys
 import json
+import time
+import threading
 import numpy as np
-from typing import List, Dict, Any
+from collections import deque
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 
 try:
     import ollama
@@ -12,31 +15,115 @@ except ImportError:
 
 import logging
 
+from answer_cache import AnswerCache
+from context_packer import pack_context, count_tokens, DEFAULT_TOKEN_BUDGET, DEFAULT_TRIM_SENTENCES
+from generation_scheduler import GenerationScheduler, Overloaded, PRIORITY_NORMAL, DEFAULT_MAX_QUEUE
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Constants
 EMBEDDING_MODEL = 'nomic-embed-text'
 DEFAULT_MODEL = 'llama3.2:1b'
+# Ollama server (None uses OLLAMA_HOST or the client default)
+OLLAMA_HOST = os.environ.get('OLLAMA_HOST')
+# How long Ollama keeps the model loaded after a request ('-1' = forever)
+DEFAULT_KEEP_ALIVE = os.environ.get('OLLAMA_KEEP_ALIVE', '30m')
+# Generations allowed to run against Ollama at once; the rest wait
+DEFAULT_MAX_CONCURRENCY = int(os.environ.get('OLLAMA_MAX_CONCURRENCY', 2))
+# Default deadline for a generation request (queueing included), in seconds
+DEFAULT_SLOT_TIMEOUT = float(os.environ.get('OLLAMA_SLOT_TIMEOUT', 120))
+# A load_duration above this marks a cold start (model loaded for the request)
+COLD_START_MS = 500.0
+
+def _percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
 
 class RAGSystem:
     """
     A simplified RAG system based on the logic in docs/demo_rag.py.
     """
-    def __init__(self, model_name: str = DEFAULT_MODEL):
+    def __init__(self, model_name: str = DEFAULT_MODEL, cache: Optional[AnswerCache] = None,
+                 token_budget: int = DEFAULT_TOKEN_BUDGET, trim_sentences: bool = DEFAULT_TRIM_SENTENCES,
+                 keep_alive: str = DEFAULT_KEEP_ALIVE, max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 max_queue: int = DEFAULT_MAX_QUEUE, host: Optional[str] = OLLAMA_HOST):
         self.model_name = model_name
         self.ollama_available = OLLAMA_AVAILABLE
+        self.cache = cache
+        self.token_budget = token_budget
+        self.trim_sentences = trim_sentences
+        self.keep_alive = keep_alive
+        # One client for the life of the process, so its HTTP connection
+        # pool (and keep-alive connections) are reused across requests
+        self.client = ollama.Client(host=host) if OLLAMA_AVAILABLE else None
+        # Bounds concurrent generations and queues the rest by priority and deadline
+        self.scheduler = GenerationScheduler(max_concurrency, max_queue, DEFAULT_SLOT_TIMEOUT)
+        self._stats_lock = threading.Lock()
+        self._timings = deque(maxlen=1000)
+        self._cold_starts = 0
 
-    def generate_answer(self, question: str, context_chunks: List[Dict[str, Any]]) -> Dict[str, Any]:
-        if not self.ollama_available:
-            return {
-                "answer": "Ollama is not available. Please install the 'ollama' package and ensure the server is running.",
-                "sources": [],
-                "model_used": "mock_llm",
+    def warm_up(self) -> bool:
+        """
+        Load the generation and embedding models into Ollama ahead of the
+        first request, so nobody pays the model load time.
+        """
+        if self.client is None:
+            return False
+        try:
+            started = time.monotonic()
+            # An empty prompt loads the model without generating anything
+            self.client.generate(model=self.model_name, prompt='', keep_alive=self.keep_alive)
+            if self.cache is not None and self.cache.embed_fn is not None:
+                self.embed_question('warm up')
+            # Loads (and on first run downloads) the tokenizer for context packing
+            count_tokens('warm up', self.model_name)
+            logging.info(f"Warmed up {self.model_name} in {(time.monotonic() - started) * 1000.0:.0f} ms")
+            return True
+        except Exception as e:
+            logging.warning(f"Could not warm up {self.model_name}: {e}")
+            return False
+
+    def embed_question(self, text: str) -> List[float]:
+        """
+        Embed a question with Ollama's embedding model, for the answer cache.
+        """
+        return self.client.embeddings(model=EMBEDDING_MODEL, prompt=text, keep_alive=self.keep_alive)['embedding']
+
+    def _record(self, timings: Dict[str, Any]):
+        with self._stats_lock:
+            self._timings.append(timings)
+            if timings.get("load_ms", 0.0) > COLD_START_MS:
+                self._cold_starts += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Generation metrics over recent calls, in milliseconds.
+        """
+        with self._stats_lock:
+            recent = list(self._timings)
+            stats = {
+                'generations': len(recent),
+                'cold_starts': self._cold_starts,
+                'keep_alive': self.keep_alive
             }
+        for name in ('total_ms', 'first_token_ms', 'queue_ms', 'load_ms', 'prompt_eval_ms', 'eval_ms'):
+            values = [timing[name] for timing in recent if timing.get(name) is not None]
+            stats[name] = {'p50': _percentile(values, 0.5), 'p95': _percentile(values, 0.95)}
+        return stats
+
+    def _build_messages(self, question: str, context_chunks: List[Dict[str, Any]]) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+        # Fit the context to the token budget so prompt evaluation time stays
+        # bounded and nothing is silently cut off by the context window
+        packed_chunks, packing = pack_context(question, context_chunks, self.token_budget, self.trim_sentences,
+                                              self.model_name)
+        logging.info(f"Packed {len(packed_chunks)} of {len(context_chunks)} chunks into "
+                     f"{packing['tokens']}/{packing['budget']} tokens")
 
         # Format the context for the prompt
-        formatted_context = self._format_context(context_chunks)
+        formatted_context = self._format_context(packed_chunks)
 
         # Create the instruction prompt
         instruction_prompt = f"""You are a helpful chatbot.
@@ -44,35 +131,155 @@ Use only the following pieces of context to answer the question. Don't make up a
 {formatted_context}
 """
         logging.info(f"Instruction prompt for Ollama: {instruction_prompt}")
+        return [
+            {'role': 'system', 'content': instruction_prompt},
+            {'role': 'user', 'content': question},
+        ], packing
+
+    def stream_answer(self, question: str, context_chunks: List[Dict[str, Any]],
+                      priority: int = PRIORITY_NORMAL, timeout: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Generate an answer, yielding tokens as Ollama produces them.
+
+        Args:
+            question: The user's question
+            context_chunks: Context chunks for the prompt
+            priority: Scheduling priority while waiting for a generation slot
+            timeout: Deadline for the request in seconds (defaults to DEFAULT_SLOT_TIMEOUT)
+
+        Yields:
+            {'type': 'token', 'content': str} for each piece of the answer,
+            then one {'type': 'done', ...} event carrying sources, the model
+            used and timings (or {'type': 'error', ...} if generation fails;
+            a request rejected by the scheduler also carries 'retry_after')
+        """
+        started = time.monotonic()
+
+        if not self.ollama_available:
+            yield {"type": "token", "content": "Ollama is not available. Please install the 'ollama' package and ensure the server is running."}
+            yield {"type": "done", "sources": [], "model_used": "mock_llm", "timings": {"total_ms": 0.0}}
+            return
 
+        # Answers to the same (or a near-identical) question over the same
+        # context chunks are served from the cache
+        lookup = None
+        if self.cache is not None:
+            lookup = self.cache.prepare(question, self.model_name, context_chunks)
+            cached = self.cache.get(lookup)
+            if cached is not None:
+                elapsed_ms = round((time.monotonic() - started) * 1000.0, 1)
+                yield {"type": "token", "content": cached["answer"]}
+                yield {
+                    "type": "done",
+                    "sources": cached["sources"],
+                    "model_used": cached["model_used"],
+                    "cache": cached["cache"],
+                    "timings": {"first_token_ms": elapsed_ms, "total_ms": elapsed_ms, "chunks": 1}
+                }
+                return
+
+        messages, packing = self._build_messages(question, context_chunks)
+        first_token_ms = None
+        parts = []
+        final_chunk: Dict[str, Any] = {}
+
+        # Bound concurrent generations; extra requests queue here by priority
+        # instead of piling onto Ollama, or are turned away if they would
+        # miss their deadline
         try:
-            stream = ollama.chat(
-                model=self.model_name,
-                messages=[
-                    {'role': 'system', 'content': instruction_prompt},
-                    {'role': 'user', 'content': question},
-                ],
-                stream=True,
-            )
-
-            answer = ""
-            for chunk in stream:
-                answer += chunk['message']['content']
-
-            logging.info(f"Full answer from Ollama: {answer}")
-
-            return {
-                "answer": answer,
-                "sources": self._extract_sources(context_chunks),
-                "model_used": f"ollama_{self.model_name}",
-            }
+            self.scheduler.acquire(priority, timeout)
+        except Overloaded as e:
+            yield {"type": "error", "message": str(e), "retry_after": e.retry_after}
+            return
+        generation_started = time.monotonic()
+        queue_ms = (generation_started - started) * 1000.0
+
+        try:
+            stream = self.client.chat(model=self.model_name, messages=messages, stream=True,
+                                      keep_alive=self.keep_alive)
+            try:
+                for chunk in stream:
+                    content = chunk['message']['content']
+                    if content:
+                        if first_token_ms is None:
+                            first_token_ms = (time.monotonic() - started) * 1000.0
+                        parts.append(content)
+                        yield {"type": "token", "content": content}
+                    if chunk.get('done'):
+                        final_chunk = chunk
+            finally:
+                # Stops generation early if the consumer goes away
+                close = getattr(stream, 'close', None)
+                if close is not None:
+                    close()
         except Exception as e:
             logging.error(f"Error during Ollama chat: {e}", exc_info=True)
-            return {
-                "answer": f"Error generating answer with Ollama: {e}",
-                "sources": [],
-                "model_used": "error",
-            }
+            yield {"type": "error", "message": f"Error generating answer with Ollama: {e}"}
+            return
+        finally:
+            self.scheduler.release(time.monotonic() - generation_started)
+
+        timings = {
+            "queue_ms": round(queue_ms, 1),
+            "first_token_ms": round(first_token_ms, 1) if first_token_ms is not None else None,
+            "total_ms": round((time.monotonic() - started) * 1000.0, 1),
+            "chunks": len(parts),
+            "context_tokens": packing['tokens']
+        }
+        # Ollama reports its own counters (nanoseconds) on the final chunk
+        if final_chunk.get('eval_count') is not None:
+            timings["eval_count"] = final_chunk['eval_count']
+        for field, name in (('load_duration', 'load_ms'), ('prompt_eval_duration', 'prompt_eval_ms'),
+                            ('eval_duration', 'eval_ms')):
+            if final_chunk.get(field):
+                timings[name] = round(final_chunk[field] / 1e6, 1)
+        self._record(timings)
+
+        # Sources are the chunks that actually made it into the prompt
+        sources = self._extract_sources([context_chunks[i] for i in packing['included']])
+        model_used = f"ollama_{self.model_name}"
+        if lookup is not None:
+            self.cache.put(lookup, {"answer": "".join(parts), "sources": sources, "model_used": model_used})
+
+        yield {
+            "type": "done",
+            "sources": sources,
+            "model_used": model_used,
+            "timings": timings
+        }
+
+    def generate_answer(self, question: str, context_chunks: List[Dict[str, Any]],
+                        priority: int = PRIORITY_NORMAL, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Generate a complete answer.
+
+        Raises:
+            Overloaded: If the scheduler rejects the request
+        """
+        parts = []
+        for event in self.stream_answer(question, context_chunks, priority, timeout):
+            if event["type"] == "token":
+                parts.append(event["content"])
+            elif event["type"] == "error":
+                if "retry_after" in event:
+                    raise Overloaded(event["message"], event["retry_after"])
+                return {
+                    "answer": event["message"],
+                    "sources": [],
+                    "model_used": "error",
+                }
+            else:
+                answer = "".join(parts)
+                logging.info(f"Full answer from Ollama: {answer}")
+                result = {
+                    "answer": answer,
+                    "sources": event["sources"],
+                    "model_used": event["model_used"],
+                    "timings": event["timings"],
+                }
+                if "cache" in event:
+                    result["cache"] = event["cache"]
+                return result
 
     def _format_context(self, context_chunks: List[Dict[str, Any]]) -> str:
         logging.info(f"Formatting {len(context_chunks)} context chunks.")
@@ -105,8 +312,11 @@ Use only the following pieces of context to answer the question. Don't make up a
             })
         return sources
 
-def get_rag_system(model_name: str = DEFAULT_MODEL) -> RAGSystem:
-    return RAGSystem(model_name=model_name)
+def get_rag_system(model_name: str = DEFAULT_MODEL, use_cache: bool = True) -> RAGSystem:
+    rag_system = RAGSystem(model_name=model_name)
+    if use_cache:
+        rag_system.cache = AnswerCache(embed_fn=rag_system.embed_question if OLLAMA_AVAILABLE else None)
+    return rag_system
 
 if __name__ == "__main__":
     rag = get_rag_system()
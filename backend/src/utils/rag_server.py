@@ -1,8 +1,8 @@
 import os
 import sys
 import json
+import itertools
 import http.server
-import socketserver
 from urllib.parse import urlparse, parse_qs
 from typing import Dict, Any, List, Optional
 
@@ -11,6 +11,9 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 # Import the RAG module
 from rag_module import get_rag_system, RAGSystem
+from generation_scheduler import Overloaded, PRIORITIES
+from threaded_server import ThreadPoolTCPServer, DEFAULT_WORKERS, DEFAULT_QUEUE_SIZE
+from single_flight import SingleFlight, request_key
 
 # Default port for the server
 DEFAULT_PORT = 5002
@@ -18,21 +21,27 @@ DEFAULT_PORT = 5002
 # Initialize the RAG system
 rag_system = get_rag_system()
 
+# Identical questions arriving while one is being answered share that generation
+answer_flight = SingleFlight("answer")
+
 class RAGHandler(http.server.BaseHTTPRequestHandler):
     """
     HTTP request handler for the RAG server.
     """
     
-    def _set_headers(self, status_code=200, content_type="application/json"):
+    def _set_headers(self, status_code=200, content_type="application/json", retry_after=None):
         """
         Set the response headers.
         
         Args:
             status_code: HTTP status code
             content_type: Content type of the response
+            retry_after: Seconds for the client to wait before retrying (503 responses)
         """
         self.send_response(status_code)
         self.send_header("Content-type", content_type)
+        if retry_after is not None:
+            self.send_header("Retry-After", str(retry_after))
         self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
         self.send_header("Access-Control-Allow-Headers", "Content-Type")
@@ -56,6 +65,11 @@ class RAGHandler(http.server.BaseHTTPRequestHandler):
         if path == "/health":
             self._set_headers()
             response = {"status": "ok", "message": "RAG server is running"}
+            response["generation"] = rag_system.get_stats()
+            if rag_system.cache is not None:
+                response["answer_cache"] = rag_system.cache.get_stats()
+            response["coalescing"] = answer_flight.get_stats()
+            response["scheduler"] = rag_system.scheduler.get_stats()
             self.wfile.write(json.dumps(response).encode())
         else:
             self._set_headers(404)
@@ -83,6 +97,8 @@ class RAGHandler(http.server.BaseHTTPRequestHandler):
         # Answer generation endpoint
         if path == "/answer":
             self._handle_answer_request(request_data)
+        elif path == "/invalidate":
+            self._handle_invalidate_request(request_data)
         else:
             self._set_headers(404)
             response = {"error": "Not found"}
@@ -106,28 +122,130 @@ class RAGHandler(http.server.BaseHTTPRequestHandler):
         question = request_data["question"]
         context = request_data.get("context_chunks", [])
         
+        # Scheduling: priority ('high', 'normal' or 'low') and an optional
+        # deadline for the whole request in milliseconds
+        priority = PRIORITIES.get(request_data.get("priority", "normal"))
+        if priority is None:
+            self._set_headers(400)
+            response = {"error": f"Unknown priority: {request_data['priority']}"}
+            self.wfile.write(json.dumps(response).encode())
+            return
+        timeout = float(request_data["timeout_ms"]) / 1000.0 if request_data.get("timeout_ms") else None
+        
+        # Requests only share a generation when they would be scheduled alike
+        key_fields = {
+            "question": question,
+            "context_chunks": context,
+            "priority": priority,
+            "timeout_ms": request_data.get("timeout_ms")
+        }
+        
+        # Streaming mode: forward tokens as Server-Sent Events
+        if request_data.get("stream") or "text/event-stream" in self.headers.get("Accept", ""):
+            self._stream_answer(question, context, request_key("answer:stream", key_fields), priority, timeout)
+            return
+        
         try:
-            # Generate the answer using the RAG system
-            result = rag_system.generate_answer(question, context)
+            # Generate the answer using the RAG system, once for all identical in-flight requests
+            result = answer_flight.do(request_key("answer", key_fields),
+                                      lambda: rag_system.generate_answer(question, context, priority, timeout))
             
             # Return the result
             self._set_headers()
             self.wfile.write(json.dumps(result).encode())
+        except Overloaded as e:
+            self._set_headers(503, retry_after=e.retry_after)
+            response = {"error": str(e), "retry_after": e.retry_after}
+            self.wfile.write(json.dumps(response).encode())
         except Exception as e:
             self._set_headers(500)
             response = {"error": str(e)}
             self.wfile.write(json.dumps(response).encode())
 
+    def _handle_invalidate_request(self, request_data: Dict[str, Any]):
+        """
+        Handle requests to the /invalidate endpoint, dropping cached answers
+        built from a document. The search servers call it whenever a
+        document's chunks are replaced, appended, removed or cleared.
+        
+        Args:
+            request_data: The request data
+        """
+        if "document_id" not in request_data:
+            self._set_headers(400)
+            response = {"error": "Missing required field: document_id"}
+            self.wfile.write(json.dumps(response).encode())
+            return
+        
+        removed = rag_system.cache.invalidate_document(request_data["document_id"]) if rag_system.cache else 0
+        self._set_headers()
+        self.wfile.write(json.dumps({"status": "success", "invalidated": removed}).encode())
 
-def run_server(port: int = DEFAULT_PORT):
+    def _stream_answer(self, question: str, context: List[Dict[str, Any]], key: str,
+                       priority: int, timeout: Optional[float]):
+        """
+        Stream an answer as Server-Sent Events.
+        
+        Each 'token' event carries a piece of the answer as it is generated;
+        a final 'done' event carries sources and timings, or an 'error'
+        event reports a failed generation. The response has no length, so
+        the connection is closed after the last event. Concurrent identical
+        requests subscribe to the same generation. A request the scheduler
+        turns away gets a plain 503 with Retry-After instead of a stream.
+        
+        Args:
+            question: The user's question
+            context: Context chunks for the prompt
+            key: Coalescing key for the request
+            priority: Scheduling priority
+            timeout: Request deadline in seconds, or None for the default
+        """
+        events = answer_flight.stream(key, lambda: rag_system.stream_answer(question, context, priority, timeout))
+        # Wait for the first event before committing to a 200 stream
+        first = next(events, None)
+        if first is not None and first["type"] == "error" and "retry_after" in first:
+            events.close()
+            self._set_headers(503, retry_after=first["retry_after"])
+            response = {"error": first["message"], "retry_after": first["retry_after"]}
+            self.wfile.write(json.dumps(response).encode())
+            return
+        
+        self.send_response(200)
+        self.send_header("Content-type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.close_connection = True
+        
+        try:
+            for event in itertools.chain([first] if first is not None else [], events):
+                payload = {name: value for name, value in event.items() if name != "type"}
+                self.wfile.write(f"event: {event['type']}\ndata: {json.dumps(payload)}\n\n".encode())
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away; the shared generation carries on for
+            # other subscribers and still fills the answer cache
+            events.close()
+
+
+def run_server(port: int = DEFAULT_PORT, workers: int = DEFAULT_WORKERS, queue_size: int = DEFAULT_QUEUE_SIZE):
     """
     Run the RAG server on the specified port.
     
+    Requests are handled on a pool of worker threads, so a slow generation
+    does not block /health or other /answer calls.
+    
     Args:
         port: The port to run the server on
+        workers: Number of worker threads
+        queue_size: Number of connections allowed to wait for a worker
     """
-    with socketserver.TCPServer(("0.0.0.0", port), RAGHandler) as httpd:
-        print(f"Starting RAG server on port {port}...")
+    # Load the model before accepting requests so the first question is not a cold start
+    rag_system.warm_up()
+    
+    with ThreadPoolTCPServer(("0.0.0.0", port), RAGHandler, workers, queue_size) as httpd:
+        print(f"Starting RAG server on port {port} with {workers} workers...")
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
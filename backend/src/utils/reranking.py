@@ -0,0 +1,195 @@
+import os
+import time
+import threading
+import logging
+from typing import List, Dict, Any, Optional, Tuple
+from sentence_transformers import CrossEncoder
+
+from micro_batcher import MicroBatcher, DEFAULT_BATCH_WINDOW_MS, DEFAULT_MAX_BATCH_SIZE
+
+RERANK_MODEL = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+FAST_RERANK_MODEL = os.environ.get('RERANK_FAST_MODEL', 'cross-encoder/ms-marco-TinyBERT-L-2-v2')
+
+# Passages are cut to this many tokens before scoring
+DEFAULT_MAX_PASSAGE_TOKENS = int(os.environ.get('RERANK_MAX_PASSAGE_TOKENS', 256))
+# Skip reranking when the cosine gap between rank k and rank k+1 is at least this
+DEFAULT_MARGIN_THRESHOLD = float(os.environ.get('RERANK_MARGIN_THRESHOLD', 0.15))
+
+# Rerank paths reported back to callers
+PATH_FULL = 'full'
+PATH_FAST = 'fast'
+PATH_TRUNCATED = 'truncated'
+PATH_SKIPPED_MARGIN = 'skipped_margin'
+PATH_SKIPPED_BUDGET = 'skipped_budget'
+PATH_SKIPPED = 'skipped'
+
+# Request modes
+MODE_AUTO = 'auto'
+MODE_FULL = 'full'
+MODE_FAST = 'fast'
+MODE_NONE = 'none'
+
+class _Tier:
+    """
+    One CrossEncoder, its batcher and a running estimate of cost per pair.
+    """
+    def __init__(self, model_name: str, max_passage_tokens: int, batch_window_ms: float, max_batch_size: int):
+        self.model_name = model_name
+        self.model = CrossEncoder(model_name, max_length=max_passage_tokens)
+        self.batcher = MicroBatcher(
+            lambda pairs: self.model.predict(pairs, show_progress_bar=False),
+            max_batch_size=max_batch_size,
+            max_wait_ms=batch_window_ms,
+            name=f'reranker-{model_name.rsplit("/", 1)[-1]}'
+        )
+        self.seconds_per_pair: Optional[float] = None
+
+    def estimate(self, num_pairs: int) -> Optional[float]:
+        if self.seconds_per_pair is None:
+            return None
+        return self.seconds_per_pair * num_pairs
+
+    def score(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        started = time.monotonic()
+        scores = self.batcher.submit(pairs)
+        per_pair = (time.monotonic() - started) / max(len(pairs), 1)
+        # Exponentially weighted so the estimate follows load changes
+        if self.seconds_per_pair is None:
+            self.seconds_per_pair = per_pair
+        else:
+            self.seconds_per_pair = 0.8 * self.seconds_per_pair + 0.2 * per_pair
+        return [float(score) for score in scores]
+
+class AdaptiveReranker:
+    """
+    CrossEncoder reranking that does only as much work as a query needs.
+
+    Reranking is skipped when the bi-encoder ranking is already decisive
+    (a large similarity margin between rank k and k+1). Passages are cut to
+    a token cap, and under a per-request latency budget the reranker falls
+    back to a cheaper distilled model or reranks only the leading
+    candidates. Every call reports which path was taken.
+
+    The distilled model loads on a background thread at construction;
+    until it is ready, requests fall back to the full model or to
+    truncation rather than waiting for it.
+    """
+    def __init__(self, model_name: str = RERANK_MODEL, fast_model_name: Optional[str] = FAST_RERANK_MODEL,
+                 max_passage_tokens: int = DEFAULT_MAX_PASSAGE_TOKENS,
+                 margin_threshold: float = DEFAULT_MARGIN_THRESHOLD,
+                 batch_window_ms: float = DEFAULT_BATCH_WINDOW_MS,
+                 max_batch_size: int = DEFAULT_MAX_BATCH_SIZE):
+        self.max_passage_tokens = max_passage_tokens
+        self.margin_threshold = margin_threshold
+        self.fast_model_name = fast_model_name
+        self._batch_window_ms = batch_window_ms
+        self._max_batch_size = max_batch_size
+        self.full = _Tier(model_name, max_passage_tokens, batch_window_ms, max_batch_size)
+        self._fast: Optional[_Tier] = None
+        self._stats_lock = threading.Lock()
+        self.path_counts: Dict[str, int] = {}
+        if fast_model_name:
+            threading.Thread(target=self._load_fast, name='fast-reranker-loader', daemon=True).start()
+
+    def _load_fast(self):
+        try:
+            self._fast = _Tier(self.fast_model_name, self.max_passage_tokens,
+                               self._batch_window_ms, self._max_batch_size)
+            logging.info(f"Fast reranker {self.fast_model_name} loaded")
+        except Exception as e:
+            logging.warning(f"Could not load fast reranker {self.fast_model_name}: {e}")
+            self.fast_model_name = None
+
+    @property
+    def fast(self) -> Optional[_Tier]:
+        # None until the background load has finished
+        return self._fast
+
+    def _truncate(self, text: str) -> str:
+        # Cheap word-level cut before tokenization; the CrossEncoder's
+        # max_length enforces the exact token limit
+        words = text.split()
+        if len(words) <= self.max_passage_tokens:
+            return text
+        return ' '.join(words[:self.max_passage_tokens])
+
+    def rerank(self, query: str, results: List[Dict[str, Any]], top_k: int,
+               latency_budget_ms: Optional[float] = None,
+               mode: str = MODE_AUTO) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        Rerank first-stage results.
+
+        Args:
+            query: Search query
+            results: Candidates with a 'similarity' score, best first
+            top_k: Number of results to return
+            latency_budget_ms: Optional time budget for the rerank stage
+            mode: 'auto', 'full', 'fast' or 'none'
+
+        Returns:
+            Tuple of (top_k results, info dict describing the path taken)
+        """
+        started = time.monotonic()
+        info: Dict[str, Any] = {'candidates': len(results), 'reranked': 0}
+
+        def finish(path: str, ranked: List[Dict[str, Any]]):
+            info['path'] = path
+            info['elapsed_ms'] = round((time.monotonic() - started) * 1000.0, 2)
+            with self._stats_lock:
+                self.path_counts[path] = self.path_counts.get(path, 0) + 1
+            return ranked[:top_k], info
+
+        if mode == MODE_NONE or len(results) <= 1:
+            return finish(PATH_SKIPPED, results)
+
+        # The margin test relies on cosine scores, so fused hybrid rankings always rerank
+        if mode == MODE_AUTO and len(results) > top_k > 0 and 'hybrid_score' not in results[0]:
+            margin = results[top_k - 1].get('similarity', 0.0) - results[top_k].get('similarity', 0.0)
+            info['margin'] = round(float(margin), 4)
+            if margin >= self.margin_threshold:
+                return finish(PATH_SKIPPED_MARGIN, results)
+
+        tier = self.fast if mode == MODE_FAST else self.full
+        if tier is None:
+            tier = self.full
+        path = PATH_FAST if tier is not self.full else PATH_FULL
+        candidates = results
+
+        if latency_budget_ms is not None and mode == MODE_AUTO:
+            budget = latency_budget_ms / 1000.0
+            estimate = tier.estimate(len(candidates))
+            if estimate is not None and estimate > budget:
+                fast = self.fast
+                fast_estimate = fast.estimate(len(candidates)) if fast is not None else None
+                if fast is not None and (fast_estimate is None or fast_estimate <= budget):
+                    tier, path = fast, PATH_FAST
+                else:
+                    # Rerank only as many leading candidates as the budget allows
+                    cheapest = fast if fast is not None and fast.seconds_per_pair is not None else tier
+                    affordable = int(budget / cheapest.seconds_per_pair)
+                    if affordable < 2:
+                        return finish(PATH_SKIPPED_BUDGET, results)
+                    tier, path = cheapest, PATH_TRUNCATED
+                    candidates = results[:affordable]
+
+        scores = tier.score([(query, self._truncate(result['text'])) for result in candidates])
+        for result, score in zip(candidates, scores):
+            result['rerank_score'] = score
+        info['model'] = tier.model_name
+        info['reranked'] = len(candidates)
+
+        # Reranked candidates first, then any that did not fit the budget
+        reranked = sorted(candidates, key=lambda x: x['rerank_score'], reverse=True)
+        return finish(path, reranked + results[len(candidates):])
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            paths = dict(self.path_counts)
+        stats = {
+            'paths': paths,
+            'full': self.full.batcher.get_stats(),
+            'fast_ready': self._fast is not None
+        }
+        if self._fast is not None:
+            stats['fast'] = self._fast.batcher.get_stats()
+        return stats
@@ -1,240 +1,1311 @@
 import numpy as np
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Optional, Tuple, Iterable, Iterator, Deque
+import io
 import re
+import atexit
+import logging
+import threading
+from collections import deque
+from functools import lru_cache
 from sentence_transformers import SentenceTransformer
 import faiss
 
+from vector_store import VectorStore
+from embedding_cache import EmbeddingCache, text_hash
+from micro_batcher import MicroBatcher, DEFAULT_MAX_BATCH_SIZE
+from inverted_index import InvertedIndex, STOP_WORDS
+from embedding_codec import decode_embeddings
+
 # Constants for semantic chunking
 DEFAULT_CHUNK_SIZE = 300
 DEFAULT_OVERLAP = 50
 MIN_CHUNK_SIZE = 100
+HEADER_PATTERN = re.compile(r'^(#{1,6})\s+(.+)$')
+WORD_PATTERN = re.compile(r'\S+')
+
+DEFAULT_DOCUMENT_ID = 'default'
+
+# Similarity metrics. 'cosine' uses an inner-product index over L2-normalized
+# embeddings, so scores are true cosine similarities in [-1, 1].
+METRIC_COSINE = 'cosine'
+METRIC_L2 = 'l2'
+DEFAULT_METRIC = METRIC_COSINE
+
+def normalize_embeddings(embeddings: np.ndarray) -> np.ndarray:
+    """
+    Return an L2-normalized float32 copy of the embeddings.
+    """
+    normalized = np.array(embeddings, dtype='float32', copy=True)
+    faiss.normalize_L2(normalized)
+    return normalized
+
+# FAISS index types. 'auto' picks one from the number of vectors: exact
+# search for small documents, HNSW for medium ones and IVF-PQ for large ones.
+# Every document has its own index, so the thresholds below are per
+# document: a corpus of many ordinary documents stays on exact search,
+# which is fast at that size. Set SEARCH_INDEX_TYPE on the servers to
+# force a compressed index for every document.
+INDEX_AUTO = 'auto'
+INDEX_FLAT = 'flat'
+INDEX_FLAT_FP16 = 'flat_fp16'
+INDEX_HNSW = 'hnsw'
+INDEX_IVF_FLAT = 'ivf_flat'
+INDEX_IVF_PQ = 'ivf_pq'
+INDEX_TYPES = (INDEX_AUTO, INDEX_FLAT, INDEX_FLAT_FP16, INDEX_HNSW, INDEX_IVF_FLAT, INDEX_IVF_PQ)
+
+AUTO_HNSW_THRESHOLD = 20000  # vectors in one document
+AUTO_IVF_PQ_THRESHOLD = 200000  # vectors in one document
+# Index types that store compressed vectors; documents using them keep
+# their raw embeddings in fp16 (or memory-mapped from the store) instead
+# of a second full float32 copy
+QUANTIZED_INDEX_TYPES = (INDEX_FLAT_FP16, INDEX_IVF_PQ)
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+DEFAULT_EF_SEARCH = 64
+DEFAULT_NPROBE = 16
+IVF_TRAIN_SIZE = 100000
+
+# Stateless scoring of caller-supplied embeddings: cosine similarity is
+# blended with a term-match signal made of term coverage and phrase match
+STATELESS_EMBEDDING_WEIGHT = 0.6
+TERM_COVERAGE_WEIGHT = 0.7
+
+# Retrieval modes: FAISS only, BM25 only, or both fused
+SEARCH_DENSE = 'dense'
+SEARCH_SPARSE = 'sparse'
+SEARCH_HYBRID = 'hybrid'
+SEARCH_MODES = (SEARCH_DENSE, SEARCH_SPARSE, SEARCH_HYBRID)
+FUSION_RRF = 'rrf'
+FUSION_WEIGHTED = 'weighted'
+RRF_K = 60  # rank offset from the original RRF paper
+DEFAULT_DENSE_WEIGHT = 0.5
+# Each retriever contributes this many candidates per requested result
+HYBRID_CANDIDATE_FACTOR = 4
+
+# Highlighting: characters of text allowed before the first highlight
+# without a [...] marker, and compiled keyword patterns kept around
+HIGHLIGHT_CONTEXT_CHARS = 100
+HIGHLIGHT_PATTERN_CACHE_SIZE = 256
+
+# Encoding: texts are grouped by token length so a batch pads little, and
+# each batch is sized to hold about this many (padded) tokens
+ENCODE_TOKEN_BUDGET = 16384
+MAX_ENCODE_BATCH_SIZE = 256
+
+def choose_index_type(num_vectors: int) -> str:
+    """
+    Pick an index type for a collection of the given size.
+    """
+    if num_vectors < AUTO_HNSW_THRESHOLD:
+        return INDEX_FLAT
+    if num_vectors < AUTO_IVF_PQ_THRESHOLD:
+        return INDEX_HNSW
+    return INDEX_IVF_PQ
+
+def _pq_subquantizers(dimension: int) -> int:
+    # Roughly 8 dimensions per sub-quantizer; the count must divide the dimension
+    for m in range(max(1, dimension // 8), 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+def create_faiss_index(embeddings: np.ndarray, metric: str = DEFAULT_METRIC,
+                       index_type: str = INDEX_FLAT, train_size: int = IVF_TRAIN_SIZE) -> faiss.Index:
+    """
+    Create an empty (but trained) FAISS index suited to the given vectors.
+    Embeddings must already be normalized for the cosine metric.
+    
+    Args:
+        embeddings: float32 matrix of vectors the index will hold
+        metric: 'cosine' or 'l2'
+        index_type: One of INDEX_TYPES; 'auto' chooses from the vector count
+        train_size: Number of leading vectors used to train IVF indexes
+        
+    Returns:
+        Empty FAISS index, ready for add()
+    """
+    if metric == METRIC_COSINE:
+        faiss_metric = faiss.METRIC_INNER_PRODUCT
+    elif metric == METRIC_L2:
+        faiss_metric = faiss.METRIC_L2
+    else:
+        raise ValueError(f"Unknown metric: {metric}")
+    
+    embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+    num_vectors, dimension = embeddings.shape
+    if index_type == INDEX_AUTO:
+        index_type = choose_index_type(num_vectors)
+    
+    nlist = int(4 * np.sqrt(max(num_vectors, 1)))
+    if index_type in (INDEX_IVF_FLAT, INDEX_IVF_PQ) and num_vectors < nlist * 39:
+        # Too few vectors to train the coarse quantizer reliably
+        index_type = INDEX_HNSW
+    
+    if index_type == INDEX_FLAT:
+        index = faiss.IndexFlat(dimension, faiss_metric)
+    elif index_type == INDEX_FLAT_FP16:
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_fp16, faiss_metric)
+    elif index_type == INDEX_HNSW:
+        index = faiss.IndexHNSWFlat(dimension, HNSW_M, faiss_metric)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = DEFAULT_EF_SEARCH
+    elif index_type in (INDEX_IVF_FLAT, INDEX_IVF_PQ):
+        quantizer = faiss.IndexFlat(dimension, faiss_metric)
+        if index_type == INDEX_IVF_FLAT:
+            index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss_metric)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dimension, nlist, _pq_subquantizers(dimension), 8, faiss_metric)
+        index.nprobe = DEFAULT_NPROBE
+        # FAISS does not take ownership of the quantizer unless told to
+        index.own_fields = True
+        quantizer.this.disown()
+    else:
+        raise ValueError(f"Unknown index type: {index_type}")
+    
+    if not index.is_trained:
+        index.train(embeddings[:train_size])
+    return index
+
+def build_faiss_index(embeddings: np.ndarray, metric: str = DEFAULT_METRIC,
+                      index_type: str = INDEX_FLAT, train_size: int = IVF_TRAIN_SIZE) -> faiss.Index:
+    """
+    Build a populated FAISS index for the given metric. Embeddings must
+    already be normalized for the cosine metric.
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+    index = create_faiss_index(embeddings, metric, index_type, train_size)
+    index.add(embeddings)
+    return index
+
+def build_id_index(embeddings: np.ndarray, ids: np.ndarray, metric: str = DEFAULT_METRIC,
+                   index_type: str = INDEX_FLAT, train_size: int = IVF_TRAIN_SIZE) -> faiss.Index:
+    """
+    Build a FAISS index whose search results are the given int64 IDs
+    rather than row positions, so vectors can later be removed by ID.
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+    base = create_faiss_index(embeddings, metric, index_type, train_size)
+    index = faiss.IndexIDMap(base)
+    # Let the wrapper own the base index so it is freed with it
+    index.own_fields = True
+    base.this.disown()
+    index.add_with_ids(embeddings, np.ascontiguousarray(ids, dtype='int64'))
+    return index
+
+def unwrap_index(index: faiss.Index) -> faiss.Index:
+    """
+    Return the underlying index of an IndexIDMap, or the index itself.
+    """
+    index = faiss.downcast_index(index)
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.downcast_index(index.index)
+    return index
+
+def index_type_of(index: faiss.Index) -> str:
+    """
+    Return the INDEX_TYPES name for a built index.
+    """
+    index = unwrap_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return INDEX_HNSW
+    if isinstance(index, faiss.IndexIVFPQ):
+        return INDEX_IVF_PQ
+    if isinstance(index, faiss.IndexIVF):
+        return INDEX_IVF_FLAT
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        return INDEX_FLAT_FP16
+    return INDEX_FLAT
+
+def search_faiss_index(index: faiss.Index, queries: np.ndarray, k: int,
+                       nprobe: Optional[int] = None,
+                       ef_search: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Search an index, applying per-request recall/latency parameters.
+    
+    Parameters are passed per call rather than set on the shared index, so
+    concurrent requests with different settings do not interfere.
+    """
+    params = None
+    index_type = index_type_of(index)
+    if index_type == INDEX_HNSW and ef_search:
+        params = faiss.SearchParametersHNSW()
+        params.efSearch = max(int(ef_search), k)
+    elif index_type in (INDEX_IVF_FLAT, INDEX_IVF_PQ) and nprobe:
+        params = faiss.SearchParametersIVF()
+        params.nprobe = int(nprobe)
+    
+    queries = np.ascontiguousarray(queries, dtype='float32')
+    if params is None:
+        return index.search(queries, k)
+    return index.search(queries, k, params=params)
+
+def index_memory_bytes(index: faiss.Index) -> int:
+    """
+    Approximate memory used by an index, in bytes.
+    
+    Estimated from the vector count and index parameters rather than by
+    serializing the index, which would copy all of it.
+    """
+    base = unwrap_index(index)
+    num_vectors, dimension = int(index.ntotal), int(index.d)
+    id_map_bytes = 8 * num_vectors if base is not faiss.downcast_index(index) else 0
+    index_type = index_type_of(index)
+    if index_type == INDEX_FLAT:
+        size = num_vectors * dimension * 4
+    elif index_type == INDEX_FLAT_FP16:
+        size = num_vectors * dimension * 2
+    elif index_type == INDEX_HNSW:
+        # Stored vectors, neighbor lists (int32) and per-vector level and offset
+        size = num_vectors * dimension * 4 + int(base.hnsw.neighbors.size()) * 4 + num_vectors * 12
+    else:
+        # Inverted lists hold a code and an int64 ID per vector, plus the
+        # coarse centroids and, for PQ, the sub-quantizer codebooks
+        size = num_vectors * (int(base.code_size) + 8) + int(base.nlist) * dimension * 4
+        if index_type == INDEX_IVF_PQ:
+            size += int(base.pq.M) * int(base.pq.ksub) * int(base.pq.dsub) * 4
+    return size + id_map_bytes
+
+def distances_to_similarity(distances: np.ndarray, metric: str = DEFAULT_METRIC) -> np.ndarray:
+    """
+    Convert FAISS search distances into similarity scores.
+    
+    Cosine scores are clipped to [-1, 1] to absorb float rounding; L2
+    distances are mapped to (0, 1] with 1 / (1 + d).
+    """
+    if metric == METRIC_COSINE:
+        return np.clip(distances, -1.0, 1.0)
+    return 1.0 / (1.0 + np.maximum(distances, 0.0))
+
+class DocumentIndex:
+    """
+    FAISS index, embeddings and chunk metadata for a single document.
+    
+    Rows of `chunks`, `embeddings` and `ids` line up; the FAISS index maps
+    each vector to its int64 ID so chunks can be removed without rebuilding.
+    Instances are treated as immutable: updates build a new DocumentIndex and
+    swap it into the registry, so in-flight searches never see a half-applied
+    change. With a quantized index, in-memory embeddings are held as fp16;
+    embeddings loaded from the store stay memory-mapped.
+    """
+    def __init__(self, document_id: str, chunks: List[Dict[str, Any]], embeddings: np.ndarray,
+                 index: faiss.Index, metric: str = DEFAULT_METRIC, ids: Optional[np.ndarray] = None):
+        self.document_id = document_id
+        self.chunks = chunks
+        self.index = index
+        self.metric = metric
+        self.index_type = index_type_of(index)
+        if self.index_type in QUANTIZED_INDEX_TYPES and not isinstance(embeddings, np.memmap):
+            embeddings = np.asarray(embeddings, dtype='float16')
+        self.embeddings = embeddings
+        self.ids = np.arange(len(chunks), dtype='int64') if ids is None else np.asarray(ids, dtype='int64')
+        self.positions = {int(vector_id): position for position, vector_id in enumerate(self.ids)}
+        self.next_id = int(self.ids.max()) + 1 if len(self.ids) else 0
+        self._index_bytes: Optional[int] = None
+        self._text_hashes: Optional[List[str]] = None
+        self._lexical: Optional[InvertedIndex] = None
+
+    @property
+    def size(self) -> int:
+        return self.index.ntotal
+
+    @property
+    def index_bytes(self) -> int:
+        # Only needed for memory stats, so not computed on every update
+        if self._index_bytes is None:
+            self._index_bytes = index_memory_bytes(self.index)
+        return self._index_bytes
+
+    @property
+    def text_hashes(self) -> List[str]:
+        if self._text_hashes is None:
+            self._text_hashes = [text_hash(chunk.get('text', '')) for chunk in self.chunks]
+        return self._text_hashes
+
+    @property
+    def lexical(self) -> InvertedIndex:
+        # Built once per document version, on the first sparse or hybrid search
+        if self._lexical is None:
+            self._lexical = InvertedIndex([chunk.get('text', '') for chunk in self.chunks])
+        return self._lexical
+
+    def chunk_for_id(self, vector_id: int) -> Optional[Dict[str, Any]]:
+        position = self.positions.get(int(vector_id))
+        return None if position is None else self.chunks[position]
+
+    def memory_usage(self) -> Dict[str, int]:
+        """
+        Approximate memory held by this document, in bytes. Memory-mapped
+        embeddings are paged in by the OS on demand, so they are reported
+        as 'mapped' and left out of the total.
+        """
+        mapped_bytes = int(self.embeddings.nbytes) if isinstance(self.embeddings, np.memmap) else 0
+        vector_bytes = int(self.embeddings.nbytes) - mapped_bytes
+        index_bytes = self.index_bytes
+        text_bytes = sum(len(chunk.get('text', '')) for chunk in self.chunks)
+        return {
+            'vectors': vector_bytes,
+            'mapped': mapped_bytes,
+            'index': index_bytes,
+            'text': text_bytes,
+            'total': vector_bytes + index_bytes + text_bytes
+        }
+
+class DocumentBuilder:
+    """
+    Builds one document's index batch by batch, for ingestion pipelines.
+    
+    Each embedded batch is added to the FAISS index as it arrives, so
+    indexing overlaps with encoding of the batches behind it. With the
+    'auto' index type, vectors go into an exact index and are rebuilt into
+    an approximate one by finish() only if the final size calls for it;
+    IVF indexes, which are trained on the data, are built by finish().
+    Searches see nothing until finish() installs the document.
+    """
+    def __init__(self, searcher: 'Searcher', document_id: str):
+        self.searcher = searcher
+        self.document_id = document_id
+        self.chunks: List[Dict[str, Any]] = []
+        self.index: Optional[faiss.Index] = None
+        self._parts: List[np.ndarray] = []
+        if searcher.index_type == INDEX_AUTO:
+            self._incremental_type = INDEX_FLAT
+        elif searcher.index_type in (INDEX_FLAT, INDEX_FLAT_FP16, INDEX_HNSW):
+            self._incremental_type = searcher.index_type
+        else:
+            self._incremental_type = None
+
+    @property
+    def size(self) -> int:
+        return len(self.chunks)
+
+    def add(self, chunks: List[Dict[str, Any]], embeddings: np.ndarray):
+        """
+        Add a batch of chunks with their (unnormalized) embeddings.
+        """
+        prepared = self.searcher._prepare(np.asarray(embeddings, dtype='float32'))
+        if self._incremental_type is not None:
+            ids = np.arange(self.size, self.size + len(chunks), dtype='int64')
+            if self.index is None:
+                self.index = build_id_index(prepared, ids, self.searcher.metric, self._incremental_type)
+            else:
+                self.index.add_with_ids(np.ascontiguousarray(prepared), ids)
+        self._parts.append(prepared)
+        self.chunks.extend(chunks)
+
+    def finish(self) -> DocumentIndex:
+        """
+        Install the document, replacing any previous index under its ID.
+        """
+        if not self.chunks:
+            raise ValueError(f"No chunks to index for document {self.document_id}")
+        embeddings = np.concatenate(self._parts) if len(self._parts) > 1 else self._parts[0]
+        ids = np.arange(len(self.chunks), dtype='int64')
+        final_type = self.searcher.index_type
+        if final_type == INDEX_AUTO:
+            final_type = choose_index_type(len(self.chunks))
+        if self.index is None or final_type != self._incremental_type:
+            self.index = build_id_index(embeddings, ids, self.searcher.metric, final_type)
+        document = DocumentIndex(self.document_id, self.chunks, embeddings, self.index, self.searcher.metric, ids)
+        return self.searcher._install(document)
+
+class _FairLock:
+    """
+    Mutex granted in arrival order.
+
+    A thread that releases and immediately re-acquires a plain Lock usually
+    gets it back before any waiter wakes up. Handing the lock to the oldest
+    waiter instead lets a query encode run between the batches of a large
+    document.
+    """
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._locked = False
+        self._waiters: Deque[threading.Event] = deque()
+
+    def acquire(self):
+        with self._mutex:
+            if not self._locked:
+                self._locked = True
+                return
+            granted = threading.Event()
+            self._waiters.append(granted)
+        # release() hands the lock over by setting the event
+        granted.wait()
+
+    def release(self):
+        with self._mutex:
+            if self._waiters:
+                self._waiters.popleft().set()
+            else:
+                self._locked = False
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+class _Persister:
+    """
+    Writes documents to a VectorStore on a background thread.
+
+    Only the latest pending version of each document is written, so a burst
+    of edits costs one save. Deletes take the same write lock as saves, so
+    a save already in flight cannot bring back a removed document.
+    """
+    def __init__(self, store: VectorStore, metric: str):
+        self.store = store
+        self.metric = metric
+        self._pending: Dict[str, 'DocumentIndex'] = {}
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def save(self, document: 'DocumentIndex'):
+        with self._condition:
+            self._pending[document.document_id] = document
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='vector-store-writer', daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+            with self._write_lock:
+                with self._condition:
+                    if not self._pending:
+                        # Discarded by delete() or clear() while we waited
+                        continue
+                    document_id = next(iter(self._pending))
+                    document = self._pending.pop(document_id)
+                    self._condition.notify_all()
+                try:
+                    self.store.save(document_id, document.index, document.embeddings, document.chunks,
+                                    {'metric': self.metric, 'next_id': document.next_id}, ids=document.ids)
+                except Exception as e:
+                    logging.error(f"Failed to persist index for document {document_id}: {e}")
+
+    def delete(self, document_id: str) -> bool:
+        with self._condition:
+            self._pending.pop(document_id, None)
+        with self._write_lock:
+            return self.store.delete(document_id)
+
+    def clear(self):
+        with self._condition:
+            self._pending.clear()
+        with self._write_lock:
+            self.store.clear()
+
+    def flush(self):
+        """
+        Block until every pending document has been written.
+        """
+        with self._condition:
+            while self._pending:
+                self._condition.wait()
+        # Wait out the save that may still be in flight
+        with self._write_lock:
+            pass
+
+def _chunk_key(chunk: Dict[str, Any], position: int) -> str:
+    return str(chunk.get('chunk_id', f'chunk_{position}'))
 
 class Searcher:
-    def __init__(self, model_name: str = 'all-MiniLM-L6-v2'):
+    """
+    Semantic searcher holding one FAISS index per document.
+
+    Documents are added and removed independently, so indexing a new
+    document never re-embeds the others and a search only touches the
+    vectors of the requested document. Within a document, chunks can be
+    appended, removed or diffed against a new version, re-encoding only
+    text that changed. When a VectorStore is given, every indexed document
+    is persisted and loaded back lazily on first use, and an EmbeddingCache
+    lets repeated text skip the transformer entirely.
+    
+    Searcher is safe to share between request threads: the registry is
+    guarded by a lock and model calls are serialized, since the tokenizer
+    does not support concurrent use. Long encodes take the model one batch
+    at a time, in arrival order, so queries are not stuck behind them.
+    Updates to one document are serialized by a per-document lock and
+    built outside the registry lock, then swapped in; writes to the store
+    happen on a background thread. With `batch_window_ms` set, queries
+    from concurrent searches are encoded together in one forward pass.
+    """
+    def __init__(self, model_name: str = 'all-MiniLM-L6-v2', store: Optional[VectorStore] = None,
+                 cache: Optional[EmbeddingCache] = None, metric: str = DEFAULT_METRIC,
+                 index_type: str = INDEX_AUTO, batch_window_ms: Optional[float] = None,
+                 max_batch_size: int = DEFAULT_MAX_BATCH_SIZE):
+        if metric not in (METRIC_COSINE, METRIC_L2):
+            raise ValueError(f"Unknown metric: {metric}")
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type: {index_type}")
+        self.model_name = model_name
+        self.metric = metric
+        self.index_type = index_type
         self.model = SentenceTransformer(model_name)
-        self.index = None
-        self.document_chunks = []
+        self.store = store
+        self.cache = cache
+        self.documents: Dict[str, DocumentIndex] = {}
+        self._lock = threading.RLock()
+        self._model_lock = _FairLock()
+        self._update_locks: Dict[str, threading.RLock] = {}
+        # Bumped by clear() so updates built before it are not installed
+        self._generation = 0
+        self._persister = None
+        if store is not None:
+            self._persister = _Persister(store, metric)
+            atexit.register(self._persister.flush)
+        self.query_batcher = None
+        if batch_window_ms is not None:
+            self.query_batcher = MicroBatcher(self.encode, max_batch_size=max_batch_size,
+                                              max_wait_ms=batch_window_ms, name='query-encoder')
 
-    def build_index(self, chunks: List[Dict[str, Any]]):
-        self.document_chunks = chunks
-        embeddings = self.model.encode([chunk['text'] for chunk in chunks], convert_to_tensor=True)
-        self.index = faiss.IndexFlatL2(embeddings.shape[1])
-        self.index.add(embeddings.cpu().detach().numpy())
+    def _token_lengths(self, texts: List[str]) -> np.ndarray:
+        # Callers hold self._model_lock
+        tokenizer = getattr(self.model, 'tokenizer', None)
+        max_length = getattr(self.model, 'max_seq_length', None) or 512
+        if tokenizer is None:
+            # Rough estimate for models without a Hugging Face tokenizer
+            return np.array([min(max_length, len(text.split()) * 4 // 3 + 2) for text in texts], dtype='int64')
+        input_ids = tokenizer(texts, truncation=True, max_length=max_length)['input_ids']
+        return np.array([len(ids) for ids in input_ids], dtype='int64')
 
-    def search(self, query: str, top_k: int = 5) -> List[Dict[str, Any]]:
-        if self.index is None:
-            return []
+    def _encode_uncached(self, texts: List[str]) -> np.ndarray:
+        """
+        Encode texts in length-bucketed batches.
+
+        Texts are sorted by token length and cut into batches of about
+        ENCODE_TOKEN_BUDGET padded tokens, so short headers are not padded
+        to the length of a long chunk and short texts go in larger batches.
+        Each batch is written into a preallocated float32 matrix at the rows
+        of its texts, which keeps the caller's order.
+        """
+        if not texts:
+            return np.zeros((0, self.model.get_sentence_embedding_dimension()), dtype='float32')
+        if len(texts) == 1:
+            # Nothing to bucket; skip the extra tokenization
+            with self._model_lock:
+                vectors = self.model.encode(texts, convert_to_numpy=True, show_progress_bar=False)
+            return np.asarray(vectors, dtype='float32')
+        with self._model_lock:
+            lengths = self._token_lengths(texts)
+        order = np.argsort(-lengths, kind='stable')
+        embeddings = None
+        start = 0
+        while start < len(order):
+            # The first text is the longest, so it sets the padded length
+            batch_size = max(1, min(MAX_ENCODE_BATCH_SIZE, ENCODE_TOKEN_BUDGET // int(lengths[order[start]])))
+            rows = order[start:start + batch_size]
+            # The model is locked per batch, so queries waiting on it run in between
+            with self._model_lock:
+                vectors = self.model.encode([texts[row] for row in rows], batch_size=len(rows),
+                                            convert_to_numpy=True, show_progress_bar=False)
+            if embeddings is None:
+                embeddings = np.empty((len(texts), vectors.shape[1]), dtype='float32')
+            embeddings[rows] = vectors
+            start += len(rows)
+        return embeddings
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed texts in one batched call, returning a float32 matrix.
+        """
+        if self.cache is None:
+            return self._encode_uncached(texts)
+        return self.cache.encode(texts, self._encode_uncached)
+
+    def encode_queries(self, queries: List[str]) -> np.ndarray:
+        """
+        Embed search queries, merging concurrent callers into one batch when
+        a query batcher is configured.
+        """
+        if self.query_batcher is None:
+            return self.encode(queries)
+        return np.asarray(self.query_batcher.submit(queries), dtype='float32')
+
+    def _prepare(self, embeddings: np.ndarray) -> np.ndarray:
+        if self.metric == METRIC_COSINE:
+            return normalize_embeddings(embeddings)
+        return embeddings
+
+    def _update_lock(self, document_id: str) -> threading.RLock:
+        with self._lock:
+            lock = self._update_locks.get(document_id)
+            if lock is None:
+                lock = self._update_locks[document_id] = threading.RLock()
+            return lock
+
+    def _install(self, document: DocumentIndex, generation: Optional[int] = None) -> DocumentIndex:
+        """
+        Swap a new version of a document into the registry and queue it
+        for persisting. A version built before the last clear() is dropped.
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return document
+            self.documents[document.document_id] = document
+            if self._persister is not None:
+                self._persister.save(document)
+        return document
+
+    def flush(self):
+        """
+        Wait until every indexed document has been written to the store.
+        """
+        if self._persister is not None:
+            self._persister.flush()
+
+    def add_document(self, document_id: str, chunks: List[Dict[str, Any]],
+                     embeddings: Optional[np.ndarray] = None) -> DocumentIndex:
+        """
+        Embed and index the chunks of one document, replacing any previous
+        index stored under the same document ID.
+        
+        Args:
+            document_id: Document to (re)index
+            chunks: Chunks with 'text'
+            embeddings: Embeddings already computed for the chunks, in order;
+                when given the chunks are not encoded again
+        """
+        generation = self._generation
+        with self._update_lock(document_id):
+            if embeddings is None:
+                embeddings = self.encode([chunk['text'] for chunk in chunks])
+            embeddings = self._prepare(np.asarray(embeddings, dtype='float32'))
+            ids = np.arange(len(chunks), dtype='int64')
+            index = build_id_index(embeddings, ids, self.metric, self.index_type)
+            return self._install(DocumentIndex(document_id, chunks, embeddings, index, self.metric, ids), generation)
+
+    def _apply_update(self, document: DocumentIndex, chunks: List[Dict[str, Any]],
+                      reused_ids: List[Optional[int]], embeddings: Optional[np.ndarray] = None) -> DocumentIndex:
+        """
+        Build the next version of a document.
+        
+        Args:
+            document: Current version
+            chunks: New ordered chunk list
+            reused_ids: For each new chunk, the vector ID whose embedding it
+                reuses, or None if its text must be encoded
+            embeddings: Optional precomputed embeddings aligned with chunks,
+                used instead of encoding the chunks that are not reused
+                
+        Returns:
+            New DocumentIndex (not yet installed)
+        """
+        new_positions = [i for i, vector_id in enumerate(reused_ids) if vector_id is None]
+        dimension = document.index.d
+        if new_positions and embeddings is not None:
+            new_embeddings = self._prepare(np.asarray(embeddings, dtype='float32')[new_positions])
+        elif new_positions:
+            new_embeddings = self._prepare(self.encode([chunks[i]['text'] for i in new_positions]))
+        else:
+            new_embeddings = np.zeros((0, dimension), dtype='float32')
+        new_ids = np.arange(document.next_id, document.next_id + len(new_positions), dtype='int64')
+
+        # Assemble the aligned arrays: reused rows are gathered, new rows filled in
+        ids = np.empty(len(chunks), dtype='int64')
+        embeddings = np.empty((len(chunks), dimension), dtype='float32')
+        reused_positions = [i for i, vector_id in enumerate(reused_ids) if vector_id is not None]
+        if reused_positions:
+            old_rows = [document.positions[reused_ids[i]] for i in reused_positions]
+            ids[reused_positions] = document.ids[old_rows]
+            embeddings[reused_positions] = document.embeddings[old_rows]
+        if new_positions:
+            ids[new_positions] = new_ids
+            embeddings[new_positions] = new_embeddings
+
+        removed_ids = np.setdiff1d(document.ids, ids[reused_positions] if reused_positions else [])
+        index = faiss.clone_index(document.index)
+        try:
+            if len(removed_ids):
+                index.remove_ids(np.ascontiguousarray(removed_ids, dtype='int64'))
+            if len(new_ids):
+                index.add_with_ids(new_embeddings, new_ids)
+        except RuntimeError:
+            # Some index types (e.g. HNSW) cannot remove vectors; rebuild from
+            # the stored embeddings, which still avoids re-encoding
+            index = build_id_index(embeddings, ids, self.metric, self.index_type)
+
+        updated = DocumentIndex(document.document_id, chunks, embeddings, index, self.metric, ids)
+        updated.next_id = max(updated.next_id, document.next_id + len(new_ids))
+        return updated
+
+    def append_chunks(self, document_id: str, chunks: List[Dict[str, Any]]) -> Dict[str, int]:
+        """
+        Add chunks to a document. A chunk whose chunk_id already exists
+        replaces the stored one, and is only re-encoded if its text changed.
         
-        query_embedding = self.model.encode([query], convert_to_tensor=True)
-        distances, indices = self.index.search(query_embedding.cpu().detach().numpy(), top_k)
+        Returns:
+            Counts of added, updated and unchanged chunks
+        """
+        generation = self._generation
+        with self._update_lock(document_id):
+            document = self.get_document(document_id)
+            if document is None:
+                self.add_document(document_id, chunks)
+                return {'added': len(chunks), 'updated': 0, 'unchanged': 0}
+
+            merged = list(document.chunks)
+            reused_ids: List[Optional[int]] = [int(vector_id) for vector_id in document.ids]
+            key_positions = {_chunk_key(chunk, i): i for i, chunk in enumerate(merged)}
+            counts = {'added': 0, 'updated': 0, 'unchanged': 0}
+
+            for chunk in chunks:
+                key = _chunk_key(chunk, len(merged))
+                position = key_positions.get(key)
+                if position is None:
+                    key_positions[key] = len(merged)
+                    merged.append(chunk)
+                    reused_ids.append(None)
+                    counts['added'] += 1
+                elif position >= len(document.chunks):
+                    # Repeated within this batch; the last occurrence wins
+                    merged[position] = chunk
+                elif text_hash(chunk.get('text', '')) == document.text_hashes[position]:
+                    merged[position] = chunk
+                    counts['unchanged'] += 1
+                else:
+                    merged[position] = chunk
+                    reused_ids[position] = None
+                    counts['updated'] += 1
+
+            self._install(self._apply_update(document, merged, reused_ids), generation)
+            return counts
+
+    def remove_chunks(self, document_id: str, chunk_ids: List[str]) -> int:
+        """
+        Remove chunks from a document by chunk_id.
+        
+        Returns:
+            Number of chunks removed
+        """
+        generation = self._generation
+        with self._update_lock(document_id):
+            document = self.get_document(document_id)
+            if document is None:
+                return 0
+
+            to_remove = set(str(chunk_id) for chunk_id in chunk_ids)
+            kept = [(chunk, int(vector_id)) for i, (chunk, vector_id) in enumerate(zip(document.chunks, document.ids))
+                    if _chunk_key(chunk, i) not in to_remove]
+            removed = len(document.chunks) - len(kept)
+            if removed:
+                self._install(self._apply_update(document, [chunk for chunk, _ in kept],
+                                                 [vector_id for _, vector_id in kept]), generation)
+            return removed
+
+    def replace_document(self, document_id: str, chunks: List[Dict[str, Any]],
+                         embeddings: Optional[np.ndarray] = None) -> Dict[str, int]:
+        """
+        Replace a document with a new version, re-encoding only chunks whose
+        text does not appear in the stored version.
+        
+        Args:
+            document_id: Document to replace
+            chunks: New ordered chunk list
+            embeddings: Optional embeddings already computed for the chunks,
+                so new text is not encoded a second time
+        
+        Returns:
+            Counts of added, removed and unchanged chunks
+        """
+        generation = self._generation
+        with self._update_lock(document_id):
+            document = self.get_document(document_id)
+            if document is None:
+                self.add_document(document_id, chunks, embeddings)
+                return {'added': len(chunks), 'removed': 0, 'unchanged': 0}
+
+            # Stored vector IDs by text hash; duplicates are consumed in order
+            available: Dict[str, List[int]] = {}
+            for vector_id, digest in zip(document.ids, document.text_hashes):
+                available.setdefault(digest, []).append(int(vector_id))
+
+            reused_ids: List[Optional[int]] = []
+            for chunk in chunks:
+                candidates = available.get(text_hash(chunk.get('text', '')))
+                reused_ids.append(candidates.pop(0) if candidates else None)
+
+            unchanged = sum(1 for vector_id in reused_ids if vector_id is not None)
+            self._install(self._apply_update(document, chunks, reused_ids, embeddings), generation)
+            return {
+                'added': len(chunks) - unchanged,
+                'removed': len(document.chunks) - unchanged,
+                'unchanged': unchanged
+            }
+
+    def get_document(self, document_id: str) -> Optional[DocumentIndex]:
+        """
+        Return the index for a document, loading it from the store on first use.
+        """
+        document = self.documents.get(document_id)
+        if document is None and self.store is not None:
+            with self._lock:
+                # Another thread may have loaded it while we waited
+                document = self.documents.get(document_id)
+                if document is None:
+                    document = self._load(document_id)
+        return document
+
+    def _load(self, document_id: str) -> Optional[DocumentIndex]:
+        stored = self.store.load(document_id)
+        if stored is None:
+            return None
+
+        index, embeddings, ids, chunks, meta = stored
+        if ids is None or meta.get('metric', METRIC_L2) != self.metric:
+            # Older stores lack vector IDs or used another metric; rebuild from
+            # the stored embeddings rather than re-encoding
+            embeddings = self._prepare(embeddings)
+            ids = np.arange(len(chunks), dtype='int64')
+            index = build_id_index(embeddings, ids, self.metric, self.index_type)
+            document = self._install(DocumentIndex(document_id, chunks, embeddings, index, self.metric, ids))
+        else:
+            document = DocumentIndex(document_id, chunks, embeddings, index, self.metric, ids)
+            document.next_id = max(document.next_id, int(meta.get('next_id', 0)))
+            self.documents[document_id] = document
+        return document
+
+    def remove_document(self, document_id: str) -> bool:
+        """
+        Drop the index for a document. Returns False if it was not indexed.
+        """
+        with self._update_lock(document_id):
+            removed = False
+            if self._persister is not None:
+                removed = self._persister.delete(document_id)
+            # Unregister after deleting, so a lazy load cannot bring it back
+            with self._lock:
+                removed = self.documents.pop(document_id, None) is not None or removed
+        return removed
+
+    def clear(self):
+        """
+        Drop every document index, including persisted ones.
+        """
+        with self._lock:
+            self._generation += 1
+            self.documents.clear()
+            if self._persister is not None:
+                self._persister.clear()
+
+    def has_document(self, document_id: str) -> bool:
+        if document_id in self.documents:
+            return True
+        return self.store is not None and self.store.has(document_id)
+
+    def document_builder(self, document_id: str) -> DocumentBuilder:
+        """
+        Start building a document's index incrementally; see DocumentBuilder.
+        """
+        return DocumentBuilder(self, document_id)
+
+    def build_index(self, chunks: List[Dict[str, Any]], document_id: str = DEFAULT_DOCUMENT_ID):
+        self.add_document(document_id, chunks)
+
+    def memory_usage(self) -> Dict[str, Dict[str, int]]:
+        """
+        Per-document memory accounting, in bytes.
+        """
+        with self._lock:
+            documents = list(self.documents.items())
+        return {document_id: document.memory_usage() for document_id, document in documents}
+
+    def _dense_candidates(self, document: DocumentIndex, query_embedding: np.ndarray, k: int,
+                          nprobe: Optional[int], ef_search: Optional[int]) -> List[Tuple[int, float]]:
+        distances, indices = search_faiss_index(document.index, query_embedding, min(k, document.size),
+                                                nprobe=nprobe, ef_search=ef_search)
+        similarities = distances_to_similarity(distances[0], document.metric)
+        candidates = []
+        for similarity, vector_id in zip(similarities, indices[0]):
+            position = document.positions.get(int(vector_id))
+            if position is not None:
+                candidates.append((position, float(similarity)))
+        return candidates
+
+    def _exact_similarities(self, document: DocumentIndex, query_embedding: np.ndarray,
+                            positions: List[int]) -> np.ndarray:
+        # Scores chunks the index did not return, straight from the stored embeddings
+        vectors = np.asarray(document.embeddings[positions], dtype='float32')
+        if document.metric == METRIC_COSINE:
+            distances = vectors @ query_embedding[0]
+        else:
+            distances = ((vectors - query_embedding[0]) ** 2).sum(axis=1)
+        return distances_to_similarity(distances, document.metric)
+
+    def _hybrid(self, document: DocumentIndex, query: str, top_k: int, mode: str, fusion: str,
+                dense_weight: float, nprobe: Optional[int], ef_search: Optional[int]) -> List[Tuple[int, float, float, float]]:
+        """
+        Run the sparse or hybrid retrieval path.
+
+        Returns:
+            List of (position, dense similarity, normalized BM25 score, fused score), best first.
+            Sparse mode never encodes the query, so its dense similarity is
+            the normalized BM25 score
+        """
+        depth = max(top_k * HYBRID_CANDIDATE_FACTOR, top_k)
+        lexical = document.lexical
+        bm25_scores = lexical.score(query)
+        upper_bound = lexical.max_score(query) or 1.0
+        sparse_ranked = sorted(bm25_scores.items(), key=lambda item: item[1], reverse=True)[:depth]
+
+        if mode == SEARCH_SPARSE:
+            return [(position, score / upper_bound, score / upper_bound, score / upper_bound)
+                    for position, score in sparse_ranked[:top_k]]
+
+        query_embedding = self._prepare(self.encode_queries([query]))
+        dense = dict(self._dense_candidates(document, query_embedding, depth, nprobe, ef_search))
+
+        # Fill in the dense score of lexical-only candidates so every
+        # candidate carries both signals
+        missing = [position for position, _ in sparse_ranked if position not in dense]
+        if missing:
+            dense.update(zip(missing, self._exact_similarities(document, query_embedding, missing).tolist()))
+
+        candidates = set(dense) | {position for position, _ in sparse_ranked}
+        sparse = {position: bm25_scores.get(position, 0.0) / upper_bound for position in candidates}
+
+        if fusion == FUSION_WEIGHTED:
+            fused = {position: dense_weight * dense[position] + (1.0 - dense_weight) * sparse[position]
+                     for position in candidates}
+        else:
+            # Reciprocal rank fusion over the two candidate lists
+            fused = {}
+            dense_ranked = sorted(dense.items(), key=lambda item: item[1], reverse=True)[:depth]
+            for ranked in (dense_ranked, sparse_ranked):
+                for rank, (position, _) in enumerate(ranked):
+                    fused[position] = fused.get(position, 0.0) + 1.0 / (RRF_K + rank + 1)
+
+        best = sorted(fused, key=lambda position: fused[position], reverse=True)[:top_k]
+        return [(position, dense[position], sparse[position], fused[position]) for position in best]
+
+    def search(self, query: str, top_k: int = 5, document_id: str = DEFAULT_DOCUMENT_ID,
+               min_similarity: Optional[float] = None, nprobe: Optional[int] = None,
+               ef_search: Optional[int] = None, mode: str = SEARCH_DENSE,
+               fusion: str = FUSION_RRF, dense_weight: float = DEFAULT_DENSE_WEIGHT) -> List[Dict[str, Any]]:
+        """
+        Search one document's index.
+        
+        Args:
+            query: Search query
+            top_k: Maximum number of results
+            document_id: Document to search
+            min_similarity: Drop results scoring below this similarity (dense mode only)
+            nprobe: IVF lists to visit (higher = better recall, slower)
+            ef_search: HNSW candidate list size (higher = better recall, slower)
+            mode: 'dense' (FAISS), 'sparse' (BM25) or 'hybrid' (both, fused)
+            fusion: 'rrf' (reciprocal rank fusion) or 'weighted' for hybrid mode
+            dense_weight: Weight of the dense score under weighted fusion
+            
+        Returns:
+            Chunks with a 'similarity' score, best first. Sparse and hybrid
+            results also carry 'lexical_score' and 'hybrid_score' and are
+            ordered by the latter. Sparse mode skips the embedding model, so
+            its 'similarity' is the normalized BM25 score.
+        """
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode: {mode}")
+        if fusion not in (FUSION_RRF, FUSION_WEIGHTED):
+            raise ValueError(f"Unknown fusion method: {fusion}")
+        document = self.get_document(document_id)
+        if document is None or document.size == 0:
+            return []
         
         results = []
-        for i, idx in enumerate(indices[0]):
-            chunk = self.document_chunks[idx].copy()
-            chunk['similarity'] = 1 - distances[0][i]  # Convert distance to similarity
+        if mode == SEARCH_DENSE:
+            query_embedding = self._prepare(self.encode_queries([query]))
+            for position, similarity in self._dense_candidates(document, query_embedding, top_k, nprobe, ef_search):
+                if min_similarity is not None and similarity < min_similarity:
+                    break  # results are sorted, so the rest score lower
+                chunk = document.chunks[position].copy()
+                chunk['similarity'] = similarity
+                results.append(chunk)
+            return results
+
+        for position, similarity, lexical_score, hybrid_score in self._hybrid(
+                document, query, top_k, mode, fusion, dense_weight, nprobe, ef_search):
+            chunk = document.chunks[position].copy()
+            chunk['similarity'] = float(similarity)
+            chunk['lexical_score'] = float(lexical_score)
+            chunk['hybrid_score'] = float(hybrid_score)
             results.append(chunk)
-            
         return results
 
-def semantic_chunk_text(text: str, target_size: int = DEFAULT_CHUNK_SIZE, 
-                       overlap: int = DEFAULT_OVERLAP) -> List[Dict[str, Any]]:
+def _finish_chunk(lines: List[Tuple[str, int, int, int]], word_count: int, header: Optional[str],
+                  section: Optional[str], chunk_id: int) -> Dict[str, Any]:
+    return {
+        'text': '\n'.join(line for line, _, _, _ in lines),
+        'header': header,
+        'section': section,
+        'word_count': word_count,
+        'chunk_id': f'chunk_{chunk_id}',
+        'start_idx': lines[0][2],
+        'end_idx': lines[-1][3]
+    }
+
+def _overlap_lines(lines: List[Tuple[str, int, int, int]],
+                   overlap: int) -> Tuple[List[Tuple[str, int, int, int]], int]:
     """
-    Chunk text with semantic awareness (headers, paragraphs, lists).
+    Trailing lines of a finished chunk, up to `overlap` words, that start the
+    next chunk. A line that does not fit whole contributes its last words.
+    
+    Returns:
+        Tuple of (kept lines, words in the lines kept whole). Words of a
+        partial line do not count toward the next chunk's size, as in the
+        original chunker, so chunk boundaries stay where they were
+    """
+    kept = []
+    count = 0
+    for line, words, start, end in reversed(lines):
+        if count + words <= overlap:
+            kept.append((line, words, start, end))
+            count += words
+            continue
+        remaining = overlap - count
+        if remaining > 0:
+            spans = list(WORD_PATTERN.finditer(line))[-remaining:]
+            kept.append((' '.join(span.group(0) for span in spans), remaining, start + spans[0].start(), end))
+        break
+    kept.reverse()
+    return kept, count
+
+def iter_semantic_chunks(lines: Iterable[str], target_size: int = DEFAULT_CHUNK_SIZE,
+                         overlap: int = DEFAULT_OVERLAP) -> Iterator[Dict[str, Any]]:
+    """
+    Chunk a stream of lines with semantic awareness (headers, paragraphs, lists).
+    
+    Chunks are yielded as soon as they are complete, so a large document
+    (an open file, for instance) is never held in memory at once. Work per
+    line is constant apart from carrying `overlap` words into the next chunk.
     
     Args:
-        text: Text to chunk
+        lines: Lines of text, with or without their trailing newlines
         target_size: Target chunk size in words
         overlap: Overlap between chunks in words
         
-    Returns:
-        List of chunk dictionaries with text and metadata
+    Yields:
+        Chunk dictionaries with text and metadata. 'start_idx' and 'end_idx'
+        are character offsets of the span the chunk covers in the source text
     """
     # Ensure minimum chunk size
     target_size = max(target_size, MIN_CHUNK_SIZE)
     
-    # Split text into lines
-    lines = text.split('\n')
-    
-    # Initialize variables
-    chunks = []
-    current_chunk = []
+    # Lines of the chunk being built: (text, word count, start offset, end offset)
+    current: List[Tuple[str, int, int, int]] = []
+    # Words that decide chunk boundaries, and words of a partial overlap line
+    # carried into the chunk, which only count toward the reported word_count
     current_word_count = 0
+    carried_words = 0
     current_header = None
     current_section = None
     chunk_id = 0
+    offset = 0
     
-    # Process each line
-    for line in lines:
+    for raw_line in lines:
+        line = raw_line[:-1] if raw_line.endswith('\n') else raw_line
+        start = offset
+        offset += len(raw_line) if raw_line.endswith('\n') else len(raw_line) + 1
+        
         # Skip empty lines
         if not line.strip():
             continue
-            
-        # Check if line is a header
-        header_match = re.match(r'^(#{1,6})\s+(.+)$', line)
+        
+        words_in_line = len(line.split())
+        header_match = HEADER_PATTERN.match(line)
+        if header_match:
+            # A header always starts a new chunk, once the current one is big enough
+            counted = len(header_match.group(2).split())
+            finish = current_word_count >= MIN_CHUNK_SIZE
+        else:
+            # Regular line: start a new chunk if this one would exceed the target size
+            counted = words_in_line
+            finish = current_word_count + words_in_line > target_size and current_word_count >= MIN_CHUNK_SIZE
+        
+        if finish:
+            yield _finish_chunk(current, current_word_count + carried_words, current_header,
+                                current_section, chunk_id)
+            chunk_id += 1
+            # Start the new chunk with the tail of the previous one
+            current, current_word_count = _overlap_lines(current, overlap)
+            carried_words = sum(words for _, words, _, _ in current) - current_word_count
+        
         if header_match:
-            # If we have content in the current chunk, finalize it
-            if current_chunk and current_word_count >= MIN_CHUNK_SIZE:
-                chunk_text = '\n'.join(current_chunk)
-                chunks.append({
-                    'text': chunk_text,
-                    'header': current_header,
-                    'section': current_section,
-                    'word_count': current_word_count,
-                    'chunk_id': f'chunk_{chunk_id}'
-                })
-                chunk_id += 1
-                
-                # Start new chunk with overlap
-                overlap_words = []
-                overlap_count = 0
-                
-                # Add overlap from previous chunk
-                for prev_line in reversed(current_chunk):
-                    prev_words = prev_line.split()
-                    if overlap_count + len(prev_words) <= overlap:
-                        overlap_words.insert(0, prev_line)
-                        overlap_count += len(prev_words)
-                    else:
-                        # Take partial line to reach overlap
-                        remaining = overlap - overlap_count
-                        if remaining > 0:
-                            partial = ' '.join(prev_words[-remaining:])
-                            overlap_words.insert(0, partial)
-                        break
-                        
-                current_chunk = overlap_words
-                current_word_count = overlap_count
-            
-            # Update header information
-            header_level = len(header_match.group(1))
             header_text = header_match.group(2)
-            
-            if header_level <= 2:
+            if len(header_match.group(1)) <= 2:
                 current_section = header_text
-                
             current_header = header_text
-            
-            # Add header to current chunk
-            current_chunk.append(line)
-            current_word_count += len(header_text.split())
-        else:
-            # Regular line - add to current chunk
-            words_in_line = len(line.split())
-            
-            # Check if adding this line would exceed target size
-            if current_word_count + words_in_line > target_size and current_word_count >= MIN_CHUNK_SIZE:
-                # Finalize current chunk
-                chunk_text = '\n'.join(current_chunk)
-                chunks.append({
-                    'text': chunk_text,
-                    'header': current_header,
-                    'section': current_section,
-                    'word_count': current_word_count,
-                    'chunk_id': f'chunk_{chunk_id}'
-                })
-                chunk_id += 1
-                
-                # Start new chunk with overlap
-                overlap_words = []
-                overlap_count = 0
-                
-                # Add overlap from previous chunk
-                for prev_line in reversed(current_chunk):
-                    prev_words = prev_line.split()
-                    if overlap_count + len(prev_words) <= overlap:
-                        overlap_words.insert(0, prev_line)
-                        overlap_count += len(prev_words)
-                    else:
-                        # Take partial line to reach overlap
-                        remaining = overlap - overlap_count
-                        if remaining > 0:
-                            partial = ' '.join(prev_words[-remaining:])
-                            overlap_words.insert(0, partial)
-                        break
-                
-                current_chunk = overlap_words
-                current_word_count = overlap_count
-            
-            # Add line to current chunk
-            current_chunk.append(line)
-            current_word_count += words_in_line
+        
+        current.append((line, words_in_line, start, start + len(line)))
+        current_word_count += counted
     
     # Add final chunk if not empty
-    if current_chunk and current_word_count > 0:
-        chunk_text = '\n'.join(current_chunk)
-        chunks.append({
-            'text': chunk_text,
-            'header': current_header,
-            'section': current_section,
-            'word_count': current_word_count,
-            'chunk_id': f'chunk_{chunk_id}'
-        })
-    
-    return chunks
+    if current and current_word_count > 0:
+        yield _finish_chunk(current, current_word_count + carried_words, current_header, current_section, chunk_id)
 
-def highlight_text(text: str, keywords: List[str]) -> str:
+def semantic_chunk_text(text: str, target_size: int = DEFAULT_CHUNK_SIZE, 
+                       overlap: int = DEFAULT_OVERLAP) -> List[Dict[str, Any]]:
     """
-    Highlight keywords in text with improved context.
+    Chunk text with semantic awareness (headers, paragraphs, lists).
+    
+    Args:
+        text: Text to chunk
+        target_size: Target chunk size in words
+        overlap: Overlap between chunks in words
+        
+    Returns:
+        List of chunk dictionaries with text and metadata
+    """
+    return list(iter_semantic_chunks(io.StringIO(text), target_size, overlap))
+
+def chunk_file(path: str, target_size: int = DEFAULT_CHUNK_SIZE, overlap: int = DEFAULT_OVERLAP,
+               encoding: str = 'utf-8') -> Iterator[Dict[str, Any]]:
+    """
+    Lazily chunk a text file, reading it one line at a time.
+    
+    Offsets index into the file's text as read with universal newlines.
+    """
+    with open(path, encoding=encoding) as handle:
+        yield from iter_semantic_chunks(handle, target_size, overlap)
+
+def extract_keywords(text: str, max_keywords: int = 10) -> List[str]:
+    """
+    Extract search keywords from a question or passage.
     
     Args:
         text: Input text
-        keywords: List of keywords to highlight
+        max_keywords: Maximum number of keywords to return
         
     Returns:
-        Text with keywords highlighted using <mark> tags
+        Keywords ordered by frequency, then by first occurrence
     """
-    # First, escape any HTML to prevent injection
-    highlighted = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    words = re.findall(r"[a-z0-9][a-z0-9'-]*", text.lower())
+    counts: Dict[str, int] = {}
+    for word in words:
+        word = word.strip("'-")
+        if len(word) > 2 and word not in STOP_WORDS:
+            counts[word] = counts.get(word, 0) + 1
     
-    # Sort keywords by length (descending) to highlight longer phrases first
-    sorted_keywords = sorted(keywords, key=len, reverse=True)
+    # dicts keep insertion order, so ties stay in order of first occurrence
+    ranked = sorted(counts, key=lambda word: counts[word], reverse=True)
+    return ranked[:max_keywords]
+
+def score_embeddings(query: str, query_embedding: Any, chunk_embeddings: Any, chunks: List[Any],
+                     query_terms: Optional[List[str]] = None, top_k: int = 5,
+                     embedding_weight: float = STATELESS_EMBEDDING_WEIGHT) -> List[Dict[str, Any]]:
+    """
+    Score caller-supplied chunks and embeddings without an index.
     
-    # Track positions of highlights to avoid overlapping
-    highlight_positions = []
+    All chunks are scored with one matrix-vector product for cosine
+    similarity, blended with a term-match signal (query term coverage and
+    exact phrase match) computed with vectorized string counts, and the
+    best `top_k` are selected with argpartition.
     
-    for keyword in sorted_keywords:
-        if len(keyword) < 3:
-            continue
-            
-        # Use word boundaries for more accurate matching
-        pattern = re.compile(f'\\b({re.escape(keyword)})\\b', re.IGNORECASE)
+    Args:
+        query: Search query
+        query_embedding: Query vector, as a float list or base64 buffer
+        chunk_embeddings: One vector per chunk, as nested lists or a base64 buffer
+        chunks: Chunk dicts (or plain strings), aligned with chunk_embeddings
+        query_terms: Terms for the term-match signal (extracted from the query if omitted)
+        top_k: Number of results to return
+        embedding_weight: Weight of cosine similarity; the term signal gets the rest
         
-        # Find all matches
-        for match in pattern.finditer(highlighted):
-            start, end = match.span()
-            
-            # Check if this match overlaps with existing highlights
-            overlaps = False
-            for hs, he in highlight_positions:
-                if (start <= he and end >= hs):
-                    overlaps = True
-                    break
-                    
-            if not overlaps:
-                # Add highlight tags
-                highlighted = highlighted[:start] + f'<mark>{highlighted[start:end]}</mark>' + highlighted[end:]
-                
-                # Update positions (accounting for added tags)
-                highlight_positions.append((start, end))
-                
-                # Adjust positions for subsequent matches (tags add 13 characters: <mark></mark>)
-                highlight_positions = [(s + 13 if s > end else s, e + 13 if e > end else e) 
-                                     for s, e in highlight_positions]
-    
-    # Add context indicators for better readability
-    if highlight_positions:
-        # Find the first highlight position
-        first_highlight = min(highlight_positions, key=lambda x: x[0])[0]
-        
-        # If the first highlight is not at the beginning, add context indicator
-        context_before = 100  # Characters of context to show before first highlight
-        if first_highlight > context_before:
-            # Find the start of the sentence or paragraph containing the first highlight
-            sentence_start = highlighted.rfind('.', 0, first_highlight)
-            paragraph_start = highlighted.rfind('\n', 0, first_highlight)
-            context_start = max(sentence_start, paragraph_start)
-            
-            if context_start > 0:
-                highlighted = highlighted[:context_start] + ' [...] ' + highlighted[context_start:]
+    Returns:
+        Chunks with 'similarity', 'embedding_similarity' and 'term_score', best first
+    """
+    if not chunks:
+        return []
+    matrix = decode_embeddings(chunk_embeddings)
+    query_vector = decode_embeddings(query_embedding).reshape(-1)
+    if matrix.ndim != 2 or matrix.shape[0] != len(chunks) or matrix.shape[1] != query_vector.shape[0]:
+        raise ValueError(f"Expected {len(chunks)} chunk embeddings of dimension {query_vector.shape[0]}, "
+                         f"got shape {matrix.shape}")
+    
+    # Cosine similarity for every chunk in one product
+    query_vector = normalize_embeddings(query_vector.reshape(1, -1))[0]
+    embedding_scores = np.clip(normalize_embeddings(matrix) @ query_vector, -1.0, 1.0)
+    
+    texts = [chunk.get('text', '') if isinstance(chunk, dict) else str(chunk) for chunk in chunks]
+    lowered = np.array([text.lower() for text in texts])
+    terms = [term.lower() for term in (query_terms if query_terms else extract_keywords(query)) if len(term) > 1]
+    term_scores = np.zeros(len(chunks), dtype='float32')
+    if terms:
+        counts = np.stack([np.char.count(lowered, term) for term in terms])
+        coverage = (counts > 0).mean(axis=0)
+        term_scores += TERM_COVERAGE_WEIGHT * coverage
+    phrase = query.lower().strip()
+    if phrase:
+        term_scores += (1.0 - TERM_COVERAGE_WEIGHT) * (np.char.find(lowered, phrase) >= 0)
+    
+    scores = embedding_weight * embedding_scores + (1.0 - embedding_weight) * term_scores
+    
+    k = min(top_k, len(chunks))
+    best = np.argpartition(-scores, k - 1)[:k]
+    best = best[np.argsort(-scores[best])]
+    
+    results = []
+    for position in best.tolist():
+        chunk = chunks[position]
+        result = dict(chunk) if isinstance(chunk, dict) else {'text': texts[position]}
+        result.setdefault('chunk_id', f'chunk_{position}')
+        result['similarity'] = float(scores[position])
+        result['embedding_similarity'] = float(embedding_scores[position])
+        result['term_score'] = float(term_scores[position])
+        results.append(result)
+    return results
+
+def _escape_html(text: str) -> str:
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+@lru_cache(maxsize=HIGHLIGHT_PATTERN_CACHE_SIZE)
+def _highlight_pattern(keywords: Tuple[str, ...]) -> Optional[re.Pattern]:
+    """
+    One case-insensitive alternation over all keywords, longest first so a
+    phrase wins over the words inside it. Cached per keyword set, since
+    every result of a query is highlighted with the same keywords.
+    """
+    if not keywords:
+        return None
+    return re.compile(r'\b(?:' + '|'.join(re.escape(keyword) for keyword in keywords) + r')\b', re.IGNORECASE)
+
+def highlight_text(text: str, keywords: List[str]) -> str:
+    """
+    Highlight keywords in text with improved context.
     
-    return highlighted
\ No newline at end of file
+    All keywords are matched in a single left-to-right pass over the text,
+    giving non-overlapping highlights, and the output is assembled with one
+    join, so the cost is linear in the text length.
+    
+    Args:
+        text: Input text
+        keywords: List of keywords to highlight
+        
+    Returns:
+        HTML-escaped text with keywords highlighted using <mark> tags
+    """
+    terms = sorted({keyword.lower() for keyword in keywords if len(keyword) >= 3}, key=lambda term: (-len(term), term))
+    pattern = _highlight_pattern(tuple(terms))
+    if pattern is None:
+        return _escape_html(text)
+    
+    parts = []
+    last = 0
+    for match in pattern.finditer(text):
+        start, end = match.span()
+        if not parts and start > HIGHLIGHT_CONTEXT_CHARS:
+            # The first highlight is far in: mark where its sentence or
+            # paragraph starts so the reader knows text comes before it
+            context_start = max(text.rfind('.', 0, start), text.rfind('\n', 0, start))
+            if context_start > 0:
+                parts.append(_escape_html(text[:context_start]))
+                parts.append(' [...] ')
+                last = context_start
+        parts.append(_escape_html(text[last:start]))
+        parts.append(f'<mark>{_escape_html(match.group(0))}</mark>')
+        last = end
+    parts.append(_escape_html(text[last:]))
+    return ''.join(parts)
\ No newline at end of file
@@ -4,14 +4,36 @@ Simplified Semantic Search Server for AI Education Tool
 Based on the travel app example - handles document indexing and search operations.
 """
 
+import io
+import os
 import json
 import logging
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
-from sentence_transformers import SentenceTransformer, CrossEncoder
 import numpy as np
 from typing import Dict, Any, List, Optional
-import faiss
+
+from semantic_search import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_OVERLAP,
+    INDEX_AUTO,
+    SEARCH_DENSE,
+    SEARCH_MODES,
+    FUSION_RRF,
+    DEFAULT_DENSE_WEIGHT,
+    Searcher,
+    score_embeddings,
+    semantic_chunk_text,
+    extract_keywords
+)
+from vector_store import VectorStore
+from embedding_cache import EmbeddingCache
+from embedding_codec import ENCODING_JSON, ENCODINGS, encode_embeddings, decode_embeddings
+from micro_batcher import DEFAULT_BATCH_WINDOW_MS, DEFAULT_MAX_BATCH_SIZE
+from reranking import AdaptiveReranker, MODE_AUTO, PATH_SKIPPED
+from single_flight import SingleFlight, request_key
+from ingest_pipeline import ingest_document, DEFAULT_INGEST_BATCH_SIZE
+from answer_cache import notify_invalidation
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -23,23 +45,32 @@ CORS(app)
 # Configuration
 EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
 RERANK_MODEL = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+INDEX_TYPE = os.environ.get('SEARCH_INDEX_TYPE', INDEX_AUTO)  # flat, flat_fp16, hnsw, ivf_flat, ivf_pq or auto
 
 # Global variables for models and indices
 model = None
-reranker = None
-document_indices = {}  # documentId -> faiss index
-document_chunks = {}   # documentId -> list of chunks
+reranker = None  # AdaptiveReranker; batches pairs across concurrent requests
+searcher = None  # per-document indices, see semantic_search.Searcher
+vector_store = VectorStore(model_name=EMBEDDING_MODEL)  # persisted indices, loaded lazily
+embedding_cache = EmbeddingCache(EMBEDDING_MODEL)      # embeddings keyed by text hash
+search_flight = SingleFlight('search')                 # coalesces identical in-flight searches
 
 def initialize_models():
     """Initialize the sentence transformer and reranker models."""
-    global model, reranker
+    global model, reranker, searcher
     
     try:
         logging.info(f"Loading SentenceTransformer model: {EMBEDDING_MODEL}")
-        model = SentenceTransformer(EMBEDDING_MODEL)
+        searcher = Searcher(EMBEDDING_MODEL, store=vector_store, cache=embedding_cache, index_type=INDEX_TYPE,
+                            batch_window_ms=DEFAULT_BATCH_WINDOW_MS, max_batch_size=DEFAULT_MAX_BATCH_SIZE)
+        model = searcher.model
         
         logging.info(f"Loading CrossEncoder model: {RERANK_MODEL}")
-        reranker = CrossEncoder(RERANK_MODEL)
+        reranker = AdaptiveReranker(
+            RERANK_MODEL,
+            batch_window_ms=DEFAULT_BATCH_WINDOW_MS,
+            max_batch_size=DEFAULT_MAX_BATCH_SIZE
+        )
         
         logging.info("Models loaded successfully")
         return True
@@ -47,6 +78,22 @@ def initialize_models():
         logging.error(f"Failed to load models: {e}")
         return False
 
+def encode_texts(texts: List[str]) -> np.ndarray:
+    """Encode texts through the embedding cache, running the model only on misses."""
+    return searcher.encode(texts)
+
+def normalize_chunks(chunks: List[Any]) -> List[Dict[str, Any]]:
+    """Convert incoming chunks (dicts or plain strings) to chunk dicts, dropping invalid ones."""
+    normalized = []
+    for i, chunk in enumerate(chunks):
+        if isinstance(chunk, dict) and 'text' in chunk:
+            normalized.append(chunk if 'chunk_id' in chunk else {**chunk, 'chunk_id': f'chunk_{i}'})
+        elif isinstance(chunk, str):
+            normalized.append({'text': chunk, 'chunk_id': f'chunk_{i}'})
+        else:
+            logging.warning(f"Invalid chunk format: {chunk}")
+    return normalized
+
 def cosine_similarity(vec1: np.ndarray, vec2: np.ndarray) -> float:
     """Calculate cosine similarity between two vectors."""
     try:
@@ -68,7 +115,14 @@ def health_check():
         'status': 'ok',
         'message': 'Semantic search server is running',
         'model': EMBEDDING_MODEL,
-        'indexed_documents': len(document_indices)
+        'indexed_documents': len(searcher.documents) if searcher else 0,
+        'stored_documents': len(vector_store.list_documents()),
+        'embedding_cache': embedding_cache.get_stats(),
+        'batching': {
+            'query_encoder': searcher.query_batcher.get_stats(),
+        } if searcher else {},
+        'reranker': reranker.get_stats() if reranker else {},
+        'coalescing': search_flight.get_stats()
     })
 
 @app.route('/index', methods=['POST'])
@@ -92,46 +146,93 @@ def index_document():
         
         logging.info(f"Indexing document {document_id} with {len(chunks)} chunks")
         
-        # Extract text from chunks
-        chunk_texts = []
-        for chunk in chunks:
-            if isinstance(chunk, dict) and 'text' in chunk:
-                chunk_texts.append(chunk['text'])
-            elif isinstance(chunk, str):
-                chunk_texts.append(chunk)
-            else:
-                logging.warning(f"Invalid chunk format: {chunk}")
-                continue
-        
-        if not chunk_texts:
-            return jsonify({'status': 'error', 'message': 'No valid chunks found'}), 400
+        chunks = normalize_chunks(chunks)
         
-        # Generate embeddings for all chunks
-        logging.info(f"Generating embeddings for {len(chunk_texts)} chunks")
-        embeddings = model.encode(chunk_texts, convert_to_tensor=False, show_progress_bar=False)
+        if not chunks:
+            return jsonify({'status': 'error', 'message': 'No valid chunks found'}), 400
         
-        # Create FAISS index
-        dimension = embeddings.shape[1]
-        index = faiss.IndexFlatL2(dimension)  # L2 distance for similarity
-        index.add(embeddings.astype('float32'))
+        # Embeddings the caller already computed (e.g. via /embed) are indexed
+        # as they are instead of encoding the chunks a second time
+        embeddings = None
+        if data.get('embeddings') is not None:
+            embeddings = decode_embeddings(data['embeddings'])
+            if embeddings.ndim != 2 or len(embeddings) != len(chunks):
+                return jsonify({'status': 'error', 'message': 'embeddings must hold one row per chunk'}), 400
         
-        # Store the index and chunks
-        document_indices[document_id] = index
-        document_chunks[document_id] = chunks
+        # A re-upload of a known document only re-encodes chunks whose text changed
+        changes = searcher.replace_document(document_id, chunks, embeddings)
+        # Cached answers built from the old chunks are stale now
+        notify_invalidation(document_id)
         
-        logging.info(f"Successfully indexed document {document_id}")
+        document = searcher.get_document(document_id)
+        logging.info(f"Successfully indexed document {document_id}: {changes}")
         
         return jsonify({
             'status': 'success',
-            'message': f'Indexed {len(chunk_texts)} chunks for document {document_id}',
-            'chunks_indexed': len(chunk_texts),
-            'embedding_dimension': dimension
+            'message': f'Indexed {len(chunks)} chunks for document {document_id}',
+            'chunks_indexed': len(chunks),
+            'embedding_dimension': int(document.index.d),
+            'index_type': document.index_type,
+            'changes': changes
         })
         
     except Exception as e:
         logging.error(f"Error indexing document: {e}", exc_info=True)
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@app.route('/append', methods=['POST'])
+def append_chunks():
+    """Add or update chunks of an indexed document without re-encoding the rest."""
+    try:
+        data = request.get_json()
+        
+        if not data:
+            return jsonify({'status': 'error', 'message': 'No JSON data provided'}), 400
+        
+        document_id = data.get('documentId')
+        chunks = normalize_chunks(data.get('chunks', []))
+        
+        if not document_id or not chunks:
+            return jsonify({'status': 'error', 'message': 'documentId and chunks are required'}), 400
+        
+        changes = searcher.append_chunks(document_id, chunks)
+        notify_invalidation(document_id)
+        logging.info(f"Appended to document {document_id}: {changes}")
+        
+        return jsonify({'status': 'success', 'document_id': document_id, 'changes': changes})
+        
+    except Exception as e:
+        logging.error(f"Error appending chunks: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/remove_chunks', methods=['POST'])
+def remove_chunks():
+    """Remove chunks from an indexed document by chunk_id."""
+    try:
+        data = request.get_json()
+        
+        if not data:
+            return jsonify({'status': 'error', 'message': 'No JSON data provided'}), 400
+        
+        document_id = data.get('documentId')
+        chunk_ids = data.get('chunk_ids', [])
+        
+        if not document_id or not chunk_ids:
+            return jsonify({'status': 'error', 'message': 'documentId and chunk_ids are required'}), 400
+        
+        if not searcher.has_document(document_id):
+            return jsonify({'status': 'error', 'message': f'Document {document_id} not indexed'}), 404
+        
+        removed = searcher.remove_chunks(document_id, chunk_ids)
+        if removed:
+            notify_invalidation(document_id)
+        
+        return jsonify({'status': 'success', 'document_id': document_id, 'removed': removed})
+        
+    except Exception as e:
+        logging.error(f"Error removing chunks: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
 @app.route('/search', methods=['POST'])
 def search_document():
     """Search within a specific document using semantic similarity."""
@@ -145,106 +246,283 @@ def search_document():
         query = data.get('query')
         top_k = data.get('top_k', 5)
         
+        # Stateless scoring of caller-supplied embeddings, no index needed
+        if 'query_embedding' in data and 'chunk_embeddings' in data:
+            return search_embeddings(data, query or '', top_k)
+        
         if not document_id or not query:
             return jsonify({'status': 'error', 'message': 'documentId and query are required'}), 400
         
-        if document_id not in document_indices:
+        if not searcher.has_document(document_id):
             return jsonify({'status': 'error', 'message': f'Document {document_id} not indexed'}), 404
         
-        logging.info(f"Searching document {document_id} with query: '{query}'")
-        
-        # Get the index and chunks for this document
-        index = document_indices[document_id]
-        chunks = document_chunks[document_id]
-        
-        # Generate query embedding
-        query_embedding = model.encode([query], convert_to_tensor=False, show_progress_bar=False)
-        
-        # Search in the index
-        distances, indices = index.search(query_embedding.astype('float32'), min(top_k * 2, len(chunks)))
-        
-        # Prepare initial results
-        initial_results = []
-        for i, (distance, idx) in enumerate(zip(distances[0], indices[0])):
-            if idx < len(chunks):
-                chunk = chunks[idx]
-                # Convert L2 distance to similarity (0-1 range)
-                similarity = 1 / (1 + distance)
-                
-                result = {
-                    'text': chunk.get('text', '') if isinstance(chunk, dict) else str(chunk),
-                    'similarity': float(similarity),
-                    'chunk_id': chunk.get('chunk_id', f'chunk_{idx}') if isinstance(chunk, dict) else f'chunk_{idx}',
-                    'header': chunk.get('header', '') if isinstance(chunk, dict) else '',
-                    'word_count': chunk.get('word_count', 0) if isinstance(chunk, dict) else len(str(chunk).split()),
-                    'start_idx': 0,  # Placeholder
-                    'end_idx': len(chunk.get('text', '') if isinstance(chunk, dict) else str(chunk))
-                }
-                initial_results.append(result)
-        
-        # Reranking with CrossEncoder
-        if initial_results and len(initial_results) > 1:
-            try:
-                logging.info(f"Reranking {len(initial_results)} results")
-                passages = [result['text'] for result in initial_results]
-                pairs = [(query, passage) for passage in passages]
-                
-                rerank_scores = reranker.predict(pairs, show_progress_bar=False)
-                
-                # Add rerank scores and sort
-                for result, score in zip(initial_results, rerank_scores):
-                    result['rerank_score'] = float(score)
-                
-                # Sort by rerank score
-                initial_results.sort(key=lambda x: x['rerank_score'], reverse=True)
-                
-            except Exception as rerank_error:
-                logging.warning(f"Reranking failed: {rerank_error}")
-                # Continue with original similarity scores
-        
-        # Take top_k results
+        # Retrieval mode: dense (FAISS), sparse (BM25) or hybrid (both, fused)
+        mode = data.get('mode', SEARCH_DENSE)
+        if mode not in SEARCH_MODES:
+            return jsonify({'status': 'error', 'message': f'Unknown search mode: {mode}'}), 400
+        
+        logging.info(f"Searching document {document_id} ({mode}) with query: '{query}'")
+        
+        # Identical searches already in flight share one retrieval and rerank
+        response = search_flight.do(request_key('search', data),
+                                    lambda: run_search(data, document_id, query, top_k, mode))
+        return jsonify(response)
+        
+    except Exception as e:
+        logging.error(f"Error searching document: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+def run_search(data: Dict[str, Any], document_id: str, query: str, top_k: int, mode: str) -> Dict[str, Any]:
+    """Retrieve, rerank and highlight results for one document's index."""
+    # Search this document's index
+    min_similarity = data.get('min_similarity')
+    matches = searcher.search(
+        query,
+        top_k=top_k * 2,
+        document_id=document_id,
+        min_similarity=float(min_similarity) if min_similarity is not None else None,
+        nprobe=data.get('nprobe'),
+        ef_search=data.get('ef_search'),
+        mode=mode,
+        fusion=data.get('fusion', FUSION_RRF),
+        dense_weight=float(data.get('dense_weight', DEFAULT_DENSE_WEIGHT))
+    )
+
+    # Prepare initial results
+    initial_results = []
+    for chunk in matches:
+        result = {
+            'text': chunk.get('text', ''),
+            'similarity': chunk['similarity'],
+            'chunk_id': chunk.get('chunk_id', ''),
+            'header': chunk.get('header', ''),
+            'word_count': chunk.get('word_count', len(chunk.get('text', '').split())),
+            'start_idx': chunk.get('start_idx', 0),
+            'end_idx': chunk.get('end_idx', len(chunk.get('text', '')))
+        }
+        for key in ('lexical_score', 'hybrid_score'):
+            if key in chunk:
+                result[key] = chunk[key]
+        initial_results.append(result)
+
+    # Adaptive reranking with CrossEncoder
+    try:
+        final_results, rerank_info = reranker.rerank(
+            query,
+            initial_results,
+            top_k,
+            latency_budget_ms=data.get('latency_budget_ms'),
+            mode=data.get('rerank', MODE_AUTO)
+        )
+        logging.info(f"Rerank path: {rerank_info['path']} ({rerank_info['reranked']} of {len(initial_results)} reranked)")
+    except Exception as rerank_error:
+        logging.warning(f"Reranking failed: {rerank_error}")
+        # Continue with original similarity scores
         final_results = initial_results[:top_k]
+        rerank_info = {'path': PATH_SKIPPED, 'error': str(rerank_error)}
+
+    # Add highlighting (simple version)
+    query_terms = query.lower().split()
+    for result in final_results:
+        text = result['text']
+        highlighted_text = text
+
+        # Simple highlighting - replace query terms with marked versions
+        for term in query_terms:
+            if len(term) > 2:  # Only highlight terms longer than 2 characters
+                highlighted_text = highlighted_text.replace(
+                    term, f'<mark>{term}</mark>'
+                )
+                # Also try capitalized version
+                highlighted_text = highlighted_text.replace(
+                    term.capitalize(), f'<mark>{term.capitalize()}</mark>'
+                )
+
+        result['highlighted_text'] = highlighted_text
+
+    logging.info(f"Returning {len(final_results)} search results")
+
+    return {
+        'status': 'success',
+        'results': final_results,
+        'query': query,
+        'document_id': document_id,
+        'total_results': len(final_results),
+        'search_mode': mode,
+        'rerank': rerank_info
+    }
+
+def search_embeddings(data: Dict[str, Any], query: str, top_k: int):
+    """Score chunks sent with the request against its query embedding."""
+    try:
+        results = score_embeddings(
+            query,
+            data['query_embedding'],
+            data['chunk_embeddings'],
+            data.get('document_chunks') or data.get('chunks') or [],
+            query_terms=data.get('query_terms'),
+            top_k=top_k
+        )
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    
+    for result in results:
+        text = result.get('text', '')
+        result.setdefault('start_idx', 0)
+        result.setdefault('end_idx', len(text))
+        result.setdefault('word_count', len(text.split()))
+    
+    return jsonify({
+        'status': 'success',
+        'results': results,
+        'query': query,
+        'total_results': len(results),
+        'search_mode': 'embeddings'
+    })
+
+@app.route('/embed', methods=['POST'])
+def embed_texts():
+    """Embed a batch of texts (or a single text) in one encode call."""
+    try:
+        data = request.get_json()
         
-        # Add highlighting (simple version)
-        query_terms = query.lower().split()
-        for result in final_results:
-            text = result['text']
-            highlighted_text = text
-            
-            # Simple highlighting - replace query terms with marked versions
-            for term in query_terms:
-                if len(term) > 2:  # Only highlight terms longer than 2 characters
-                    highlighted_text = highlighted_text.replace(
-                        term, f'<mark>{term}</mark>'
-                    )
-                    # Also try capitalized version
-                    highlighted_text = highlighted_text.replace(
-                        term.capitalize(), f'<mark>{term.capitalize()}</mark>'
-                    )
+        if not data:
+            return jsonify({'status': 'error', 'message': 'No JSON data provided'}), 400
+        
+        # 'float32' / 'float16' return a base64 buffer instead of float lists
+        encoding = data.get('encoding', ENCODING_JSON)
+        if encoding not in ENCODINGS:
+            return jsonify({'status': 'error', 'message': f'Unknown encoding: {encoding}'}), 400
+        
+        if 'texts' in data:
+            texts = data['texts']
+            if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+                return jsonify({'status': 'error', 'message': 'texts must be a list of strings'}), 400
             
-            result['highlighted_text'] = highlighted_text
+            embeddings = encode_texts(texts) if texts else np.zeros((0, 0), dtype='float32')
+            return jsonify({
+                'status': 'success',
+                'embeddings': encode_embeddings(embeddings, encoding),
+                'dimension': int(embeddings.shape[1]) if texts else 0,
+                'dtype': 'float32',
+                'encoding': encoding
+            })
+        
+        if 'text' in data:
+            embedding = encode_texts([data['text']])[0]
+            return jsonify({
+                'status': 'success',
+                'embedding': encode_embeddings(embedding, encoding),
+                'dimension': int(embedding.shape[0]),
+                'encoding': encoding
+            })
         
-        logging.info(f"Returning {len(final_results)} search results")
+        return jsonify({'status': 'error', 'message': 'texts or text is required'}), 400
+        
+    except Exception as e:
+        logging.error(f"Error embedding texts: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/chunk', methods=['POST'])
+def chunk_text():
+    """Split text into semantic chunks."""
+    try:
+        data = request.get_json()
+        
+        if not data or 'text' not in data:
+            return jsonify({'status': 'error', 'message': 'text is required'}), 400
+        
+        chunks = semantic_chunk_text(
+            data['text'],
+            target_size=int(data.get('chunk_size', DEFAULT_CHUNK_SIZE)),
+            overlap=int(data.get('overlap', DEFAULT_OVERLAP))
+        )
+        
+        return jsonify({'status': 'success', 'chunks': chunks, 'total_chunks': len(chunks)})
+        
+    except Exception as e:
+        logging.error(f"Error chunking text: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/ingest', methods=['POST'])
+def ingest():
+    """
+    Chunk, embed and index a document in one pipelined pass.
+    
+    The response is a stream of Server-Sent Events: 'progress' events with
+    chunk counts per stage, then a 'done' event carrying the chunks and
+    their embeddings (so the caller can store them without re-encoding),
+    or an 'error' event.
+    """
+    data = request.get_json()
+    
+    if not data or not data.get('documentId') or 'text' not in data:
+        return jsonify({'status': 'error', 'message': 'documentId and text are required'}), 400
+    
+    encoding = data.get('encoding', ENCODING_JSON)
+    if encoding not in ENCODINGS:
+        return jsonify({'status': 'error', 'message': f'Unknown encoding: {encoding}'}), 400
+    
+    document_id = data['documentId']
+    logging.info(f"Ingesting document {document_id} ({len(data['text'])} characters)")
+    
+    def events():
+        try:
+            for event in ingest_document(
+                searcher,
+                document_id,
+                io.StringIO(data['text']),
+                target_size=int(data.get('chunk_size', DEFAULT_CHUNK_SIZE)),
+                overlap=int(data.get('overlap', DEFAULT_OVERLAP)),
+                batch_size=int(data.get('batch_size', DEFAULT_INGEST_BATCH_SIZE))
+            ):
+                if event['type'] == 'done':
+                    notify_invalidation(document_id)
+                    logging.info(f"Ingested document {document_id}: {len(event['chunks'])} chunks "
+                                 f"in {event['total_seconds']}s, stages {event['stage_seconds']}")
+                    event = {**event, 'embeddings': encode_embeddings(event['embeddings'], encoding),
+                             'total_chunks': len(event['chunks']), 'encoding': encoding}
+                payload = {key: value for key, value in event.items() if key != 'type'}
+                yield f"event: {event['type']}\ndata: {json.dumps(payload)}\n\n"
+        except Exception as e:
+            logging.error(f"Error ingesting document {document_id}: {e}", exc_info=True)
+            yield f"event: error\ndata: {json.dumps({'message': str(e)})}\n\n"
+    
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+@app.route('/keywords', methods=['POST'])
+def keywords():
+    """Extract keywords from a question."""
+    try:
+        data = request.get_json()
+        
+        if not data or 'text' not in data:
+            return jsonify({'status': 'error', 'message': 'text is required'}), 400
         
         return jsonify({
             'status': 'success',
-            'results': final_results,
-            'query': query,
-            'document_id': document_id,
-            'total_results': len(final_results)
+            'keywords': extract_keywords(data['text'], max_keywords=int(data.get('max_keywords', 10)))
         })
         
     except Exception as e:
-        logging.error(f"Error searching document: {e}", exc_info=True)
+        logging.error(f"Error extracting keywords: {e}", exc_info=True)
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 @app.route('/clear', methods=['POST'])
 def clear_indices():
-    """Clear all document indices (for testing/debugging)."""
-    global document_indices, document_chunks
+    """Clear one document's index, or all indices when no documentId is given."""
+    data = request.get_json(silent=True) or {}
+    document_id = data.get('documentId')
+    
+    if document_id:
+        if not searcher.remove_document(document_id):
+            return jsonify({'status': 'error', 'message': f'Document {document_id} not indexed'}), 404
+        notify_invalidation(document_id)
+        logging.info(f"Cleared index for document {document_id}")
+        return jsonify({'status': 'success', 'message': f'Index for document {document_id} cleared'})
     
-    document_indices.clear()
-    document_chunks.clear()
+    searcher.clear()
     
     logging.info("Cleared all document indices")
     
@@ -1,19 +1,37 @@
+import io
 import http.server
-import socketserver
 import json
 import sys
 import numpy as np
 from typing import Dict, Any, List, Optional
 import os
 import logging
-from sentence_transformers import CrossEncoder
 
 # Import semantic search utilities
 from semantic_search import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_DOCUMENT_ID,
+    DEFAULT_OVERLAP,
+    INDEX_AUTO,
+    SEARCH_DENSE,
+    SEARCH_MODES,
+    FUSION_RRF,
+    DEFAULT_DENSE_WEIGHT,
     Searcher,
+    score_embeddings,
     semantic_chunk_text,
+    extract_keywords,
     highlight_text
 )
+from vector_store import VectorStore
+from embedding_cache import EmbeddingCache
+from embedding_codec import ENCODING_JSON, ENCODINGS, encode_embeddings, decode_embeddings
+from threaded_server import ThreadPoolTCPServer, DEFAULT_WORKERS, DEFAULT_QUEUE_SIZE
+from micro_batcher import DEFAULT_BATCH_WINDOW_MS, DEFAULT_MAX_BATCH_SIZE
+from reranking import AdaptiveReranker, MODE_AUTO
+from single_flight import SingleFlight, request_key
+from ingest_pipeline import ingest_document, DEFAULT_INGEST_BATCH_SIZE
+from answer_cache import notify_invalidation
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -22,12 +40,32 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 DEFAULT_PORT = 5004
 EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
 RERANK_MODEL = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+INDEX_TYPE = os.environ.get('SEARCH_INDEX_TYPE', INDEX_AUTO)
+# Cosine scores are comparable across queries, so fewer candidates are needed
+# before reranking and low-scoring candidates can be cut off outright
+RERANK_CANDIDATE_FACTOR = 2
+DEFAULT_MIN_SIMILARITY = 0.0
 
-# Load the reranker model
-reranker = CrossEncoder(RERANK_MODEL)
+# Load the reranker. Pairs from concurrent searches are scored together in
+# one forward pass, and reranking is skipped or cut down when it cannot help
+reranker = AdaptiveReranker(
+    RERANK_MODEL,
+    batch_window_ms=DEFAULT_BATCH_WINDOW_MS,
+    max_batch_size=DEFAULT_MAX_BATCH_SIZE
+)
+
+# Concurrent identical searches (e.g. a popular question) run once
+search_flight = SingleFlight('search')
 
-# Instantiate the searcher
-searcher = Searcher(EMBEDDING_MODEL)
+# Instantiate the searcher; indexes are persisted so restarts skip re-embedding
+searcher = Searcher(
+    EMBEDDING_MODEL,
+    store=VectorStore(model_name=EMBEDDING_MODEL),
+    cache=EmbeddingCache(EMBEDDING_MODEL),
+    index_type=INDEX_TYPE,
+    batch_window_ms=DEFAULT_BATCH_WINDOW_MS,
+    max_batch_size=DEFAULT_MAX_BATCH_SIZE
+)
 
 class SemanticSearchHandlerV2(http.server.BaseHTTPRequestHandler):
     """
@@ -57,7 +95,20 @@ class SemanticSearchHandlerV2(http.server.BaseHTTPRequestHandler):
         """
         if self.path == '/health':
             self._set_headers()
-            response = {'status': 'ok', 'message': 'Semantic search server v2 is running', 'version': '2.0.0'}
+            response = {
+                'status': 'ok',
+                'message': 'Semantic search server v2 is running',
+                'version': '2.0.0',
+                'indexed_documents': len(searcher.documents),
+                'stored_documents': len(searcher.store.list_documents()),
+                'memory_usage': searcher.memory_usage(),
+                'embedding_cache': searcher.cache.get_stats(),
+                'batching': {
+                    'query_encoder': searcher.query_batcher.get_stats(),
+                },
+                'reranker': reranker.get_stats(),
+                'coalescing': search_flight.get_stats()
+            }
             self.wfile.write(json.dumps(response).encode())
         else:
             self._set_headers(404)
@@ -75,10 +126,26 @@ class SemanticSearchHandlerV2(http.server.BaseHTTPRequestHandler):
         try:
             data = json.loads(post_data.decode('utf-8'))
             
+            if self.path == '/ingest':
+                # Streams its own response
+                self._handle_ingest_request(data)
+                return
             if self.path == '/index':
                 response = self._handle_index_request(data)
             elif self.path == '/search':
                 response = self._handle_search_request(data)
+            elif self.path == '/remove':
+                response = self._handle_remove_request(data)
+            elif self.path == '/append':
+                response = self._handle_append_request(data)
+            elif self.path == '/remove_chunks':
+                response = self._handle_remove_chunks_request(data)
+            elif self.path == '/embed':
+                response = self._handle_embed_request(data)
+            elif self.path == '/chunk':
+                response = self._handle_chunk_request(data)
+            elif self.path == '/keywords':
+                response = self._handle_keywords_request(data)
             else:
                 self._set_headers(404)
                 response = {'status': 'error', 'message': 'Endpoint not found'}
@@ -108,11 +175,26 @@ class SemanticSearchHandlerV2(http.server.BaseHTTPRequestHandler):
                 self._set_headers(400)
                 return {'status': 'error', 'message': 'No chunks provided'}
             
-            # Build index using the provided chunks
-            searcher.build_index(chunks)
+            # Embeddings the caller already computed are indexed as they are
+            embeddings = None
+            if data.get('embeddings') is not None:
+                embeddings = decode_embeddings(data['embeddings'])
+                if embeddings.ndim != 2 or len(embeddings) != len(chunks):
+                    self._set_headers(400)
+                    return {'status': 'error', 'message': 'embeddings must hold one row per chunk'}
+            
+            # Index this document only; other documents are untouched, and a
+            # re-upload only re-encodes chunks whose text changed
+            changes = searcher.replace_document(document_id, chunks, embeddings)
+            # Cached answers built from the old chunks are stale now
+            notify_invalidation(document_id)
             
             self._set_headers()
-            return {'status': 'success', 'message': f'Indexed {len(chunks)} chunks for document {document_id}.'}
+            return {
+                'status': 'success',
+                'message': f'Indexed {len(chunks)} chunks for document {document_id}.',
+                'changes': changes
+            }
         
         # Fallback to old format for backward compatibility
         elif 'text' in data:
@@ -127,45 +209,128 @@ class SemanticSearchHandlerV2(http.server.BaseHTTPRequestHandler):
             self._set_headers(400)
             return {'status': 'error', 'message': 'Missing required field: documentId and chunks, or text'}
 
+    def _handle_ingest_request(self, data: Dict[str, Any]):
+        """
+        Chunk, embed and index a document in one pipelined pass, streaming
+        'progress' events and a final 'done' event (with the chunks and their
+        embeddings) or an 'error' event as Server-Sent Events.
+        """
+        encoding = data.get('encoding', ENCODING_JSON)
+        if not data.get('documentId') or 'text' not in data or encoding not in ENCODINGS:
+            self._set_headers(400)
+            message = 'Missing required fields: documentId and text' if encoding in ENCODINGS else f'Unknown encoding: {encoding}'
+            self.wfile.write(json.dumps({'status': 'error', 'message': message}).encode())
+            return
+        
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.close_connection = True
+        
+        document_id = data['documentId']
+        events = ingest_document(
+            searcher,
+            document_id,
+            io.StringIO(data['text']),
+            target_size=int(data.get('chunk_size', DEFAULT_CHUNK_SIZE)),
+            overlap=int(data.get('overlap', DEFAULT_OVERLAP)),
+            batch_size=int(data.get('batch_size', DEFAULT_INGEST_BATCH_SIZE))
+        )
+        try:
+            for event in events:
+                if event['type'] == 'done':
+                    notify_invalidation(document_id)
+                    event = {**event, 'embeddings': encode_embeddings(event['embeddings'], encoding),
+                             'total_chunks': len(event['chunks']), 'encoding': encoding}
+                self._write_event(event)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away; closing the generator cancels the pipeline
+            events.close()
+        except Exception as e:
+            logging.error(f"Error ingesting document {document_id}: {e}", exc_info=True)
+            self._write_event({'type': 'error', 'message': str(e)})
+
+    def _write_event(self, event: Dict[str, Any]):
+        payload = {key: value for key, value in event.items() if key != 'type'}
+        self.wfile.write(f"event: {event['type']}\ndata: {json.dumps(payload)}\n\n".encode())
+        self.wfile.flush()
+
     def _handle_search_request(self, data: Dict[str, Any]) -> Dict[str, Any]:
         """
         Handle semantic search requests with metadata filtering and reranking.
         """
+        # Stateless scoring of caller-supplied embeddings, no index needed
+        if 'query_embedding' in data and 'chunk_embeddings' in data:
+            return self._handle_embedding_search_request(data)
+        
+        min_similarity = float(data.get('min_similarity', DEFAULT_MIN_SIMILARITY))
+        # Optional recall/latency knobs for approximate indexes
+        nprobe = data.get('nprobe')
+        ef_search = data.get('ef_search')
+        # Retrieval mode: dense (FAISS), sparse (BM25) or hybrid (both, fused)
+        mode = data.get('mode', SEARCH_DENSE)
+        if mode not in SEARCH_MODES:
+            self._set_headers(400)
+            return {'status': 'error', 'message': f'Unknown search mode: {mode}'}
+        retrieval = {
+            'mode': mode,
+            'fusion': data.get('fusion', FUSION_RRF),
+            'dense_weight': float(data.get('dense_weight', DEFAULT_DENSE_WEIGHT))
+        }
+        
         # Support both new format (documentId + query) and old format (query only)
         if 'documentId' in data and 'query' in data:
             document_id = data['documentId']
             query = data['query']
             top_k = data.get('top_k', 5)
             
-            # Perform search (searcher should already be indexed with the document)
-            initial_results = searcher.search(query, top_k=top_k * 3)
-            
+            if not searcher.has_document(document_id):
+                self._set_headers(404)
+                return {'status': 'error', 'message': f'Document {document_id} not indexed'}
         elif 'query' in data:
+            # Search the document indexed without an ID
+            document_id = DEFAULT_DOCUMENT_ID
             query = data['query']
             top_k = data.get('top_k', 10)
-            
-            # Initial search
-            initial_results = searcher.search(query, top_k=top_k * 3)
         else:
             self._set_headers(400)
             return {'status': 'error', 'message': 'Missing required field: query'}
         
+        # Identical searches already in flight share one retrieval and rerank
+        response = search_flight.do(
+            request_key('search', data),
+            lambda: self._run_search(query, top_k, document_id, min_similarity, nprobe, ef_search,
+                                     retrieval, data.get('latency_budget_ms'), data.get('rerank', MODE_AUTO))
+        )
+        self._set_headers()
+        return response
+
+    def _run_search(self, query: str, top_k: int, document_id: str, min_similarity: float,
+                    nprobe: Optional[int], ef_search: Optional[int], retrieval: Dict[str, Any],
+                    latency_budget_ms: Optional[float], rerank_mode: str) -> Dict[str, Any]:
+        """
+        Retrieve, rerank and decorate results for one document's index.
+        """
+        initial_results = searcher.search(query, top_k=top_k * RERANK_CANDIDATE_FACTOR,
+                                          document_id=document_id, min_similarity=min_similarity,
+                                          nprobe=nprobe, ef_search=ef_search, **retrieval)
         if not initial_results:
-            self._set_headers()
             return {
                 'status': 'success',
                 'results': []
             }
         
-        # Reranking
-        passages = [result['text'] for result in initial_results]
-        rerank_scores = reranker.predict([(query, passage) for passage in passages])
-        
-        for result, score in zip(initial_results, rerank_scores):
-            result['rerank_score'] = float(score)
-            
-        # Sort by rerank score
-        reranked_results = sorted(initial_results, key=lambda x: x['rerank_score'], reverse=True)[:top_k]
+        # Adaptive reranking: may skip, use the fast model or rerank fewer candidates
+        reranked_results, rerank_info = reranker.rerank(
+            query,
+            initial_results,
+            top_k,
+            latency_budget_ms=latency_budget_ms,
+            mode=rerank_mode
+        )
         
         # Add missing fields expected by the backend
         for result in reranked_results:
@@ -178,19 +343,171 @@ class SemanticSearchHandlerV2(http.server.BaseHTTPRequestHandler):
             if 'end_idx' not in result:
                 result['end_idx'] = len(result['text'])
         
+        return {
+            'status': 'success',
+            'results': reranked_results,
+            'search_mode': retrieval['mode'],
+            'rerank': rerank_info
+        }
+
+    def _handle_embedding_search_request(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Score chunks against a query using embeddings sent with the request.
+        """
+        chunks = data.get('document_chunks') or data.get('chunks') or []
+        query = data.get('query', '')
+        try:
+            results = score_embeddings(
+                query,
+                data['query_embedding'],
+                data['chunk_embeddings'],
+                chunks,
+                query_terms=data.get('query_terms'),
+                top_k=data.get('top_k', 5)
+            )
+        except ValueError as e:
+            self._set_headers(400)
+            return {'status': 'error', 'message': str(e)}
+        
+        for result in results:
+            text = result.get('text', '')
+            result['highlighted_text'] = highlight_text(text, data.get('query_terms') or query.split())
+            result.setdefault('start_idx', 0)
+            result.setdefault('end_idx', len(text))
+            result.setdefault('word_count', len(text.split()))
+        
         self._set_headers()
         return {
             'status': 'success',
-            'results': reranked_results
+            'results': results,
+            'search_mode': 'embeddings'
         }
 
-def run_server(port: int = DEFAULT_PORT):
+    def _handle_remove_request(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Handle requests to drop a document's index.
+        """
+        if 'documentId' not in data:
+            self._set_headers(400)
+            return {'status': 'error', 'message': 'Missing required field: documentId'}
+        
+        document_id = data['documentId']
+        if not searcher.remove_document(document_id):
+            self._set_headers(404)
+            return {'status': 'error', 'message': f'Document {document_id} not indexed'}
+        notify_invalidation(document_id)
+        
+        self._set_headers()
+        return {'status': 'success', 'message': f'Removed index for document {document_id}.'}
+
+    def _handle_append_request(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Handle requests to add or update chunks of a document.
+        """
+        if 'documentId' not in data or not data.get('chunks'):
+            self._set_headers(400)
+            return {'status': 'error', 'message': 'Missing required fields: documentId and chunks'}
+        
+        changes = searcher.append_chunks(data['documentId'], data['chunks'])
+        notify_invalidation(data['documentId'])
+        self._set_headers()
+        return {'status': 'success', 'document_id': data['documentId'], 'changes': changes}
+
+    def _handle_remove_chunks_request(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Handle requests to remove chunks from a document by chunk_id.
+        """
+        if 'documentId' not in data or not data.get('chunk_ids'):
+            self._set_headers(400)
+            return {'status': 'error', 'message': 'Missing required fields: documentId and chunk_ids'}
+        
+        document_id = data['documentId']
+        if not searcher.has_document(document_id):
+            self._set_headers(404)
+            return {'status': 'error', 'message': f'Document {document_id} not indexed'}
+        
+        removed = searcher.remove_chunks(document_id, data['chunk_ids'])
+        if removed:
+            notify_invalidation(document_id)
+        self._set_headers()
+        return {'status': 'success', 'document_id': document_id, 'removed': removed}
+
+    def _handle_embed_request(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Handle embedding requests. A list of texts is encoded in one batch.
+        With 'encoding' set to 'float32' or 'float16', embeddings are
+        returned as a base64 buffer instead of float lists.
+        """
+        encoding = data.get('encoding', ENCODING_JSON)
+        if encoding not in ENCODINGS:
+            self._set_headers(400)
+            return {'status': 'error', 'message': f'Unknown encoding: {encoding}'}
+        
+        if 'texts' in data:
+            texts = data['texts']
+            if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+                self._set_headers(400)
+                return {'status': 'error', 'message': 'texts must be a list of strings'}
+            
+            embeddings = searcher.encode(texts) if texts else np.zeros((0, 0), dtype='float32')
+            self._set_headers()
+            return {
+                'status': 'success',
+                'embeddings': encode_embeddings(embeddings, encoding),
+                'dimension': int(embeddings.shape[1]) if len(texts) else 0,
+                'dtype': 'float32',
+                'encoding': encoding
+            }
+        
+        elif 'text' in data:
+            embedding = searcher.encode([data['text']])[0]
+            self._set_headers()
+            return {
+                'status': 'success',
+                'embedding': encode_embeddings(embedding, encoding),
+                'dimension': int(embedding.shape[0]),
+                'encoding': encoding
+            }
+        
+        else:
+            self._set_headers(400)
+            return {'status': 'error', 'message': 'Missing required field: texts or text'}
+
+    def _handle_chunk_request(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Handle semantic chunking requests.
+        """
+        if 'text' not in data:
+            self._set_headers(400)
+            return {'status': 'error', 'message': 'Missing required field: text'}
+        
+        chunks = semantic_chunk_text(
+            data['text'],
+            target_size=int(data.get('chunk_size', DEFAULT_CHUNK_SIZE)),
+            overlap=int(data.get('overlap', DEFAULT_OVERLAP))
+        )
+        self._set_headers()
+        return {'status': 'success', 'chunks': chunks, 'total_chunks': len(chunks)}
+
+    def _handle_keywords_request(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Handle keyword extraction requests.
+        """
+        if 'text' not in data:
+            self._set_headers(400)
+            return {'status': 'error', 'message': 'Missing required field: text'}
+        
+        keywords = extract_keywords(data['text'], max_keywords=int(data.get('max_keywords', 10)))
+        self._set_headers()
+        return {'status': 'success', 'keywords': keywords}
+
+def run_server(port: int = DEFAULT_PORT, workers: int = DEFAULT_WORKERS, queue_size: int = DEFAULT_QUEUE_SIZE):
     """
-    Run the semantic search server.
+    Run the semantic search server with a pool of worker threads.
     """
     try:
-        with socketserver.TCPServer(("0.0.0.0", port), SemanticSearchHandlerV2) as httpd:
-            logging.info(f"Starting semantic search server v2 on port {port}...")
+        with ThreadPoolTCPServer(("0.0.0.0", port), SemanticSearchHandlerV2, workers, queue_size) as httpd:
+            logging.info(f"Starting semantic search server v2 on port {port} with {workers} workers...")
             httpd.serve_forever()
     except OSError as e:
         logging.error(f"Could not start server on port {port}: {e}")
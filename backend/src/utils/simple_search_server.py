@@ -5,126 +5,79 @@ This version avoids heavy dependencies and focuses on basic functionality.
 """
 
 import http.server
-import socketserver
 import json
 import sys
+import heapq
 import logging
 from typing import Dict, Any, List, Optional
 import re
 
+from threaded_server import ThreadPoolTCPServer, DEFAULT_WORKERS, DEFAULT_QUEUE_SIZE
+from inverted_index import InvertedIndex
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Constants
 DEFAULT_PORT = 5004
+MIN_SIMILARITY = 0.1
+PHRASE_MATCH_BONUS = 0.3
 
 # Global storage for indexed documents
-document_indices = {}  # documentId -> list of chunks
+document_indices = {}  # documentId -> {'chunks', 'texts', 'lowered_texts', 'index'}
 
-def advanced_similarity(query: str, text: str) -> float:
+def lexical_similarity(index: InvertedIndex, query: str, lowered_texts: List[str]) -> Dict[int, float]:
     """
-    Advanced similarity calculation with multi-signal ranking.
+    Score the chunks that share a term with the query.
+
+    BM25 scores from the precomputed inverted index are normalised to [0, 1]
+    by the best score the query could reach, and an exact phrase match adds
+    a bonus on top.
+
+    Returns:
+        Mapping of chunk position to similarity, for candidate chunks only
     """
     query_lower = query.lower().strip()
-    text_lower = text.lower()
-    
-    if not query_lower or not text_lower:
-        return 0.0
-    
-    score = 0.0
-    
-    # 1. Exact phrase match (highest priority) - 40% weight
-    if query_lower in text_lower:
-        score += 10.0
-        
-        # Position bonus - earlier matches get higher scores
-        start_index = text_lower.find(query_lower)
-        position_bonus = max(0, (1000 - start_index) / 1000) * 2
-        score += position_bonus
-        
-        # Whole word boundary bonus
-        import re
-        if re.search(r'\b' + re.escape(query_lower) + r'\b', text_lower):
-            score += 3.0
-    
-    # 2. Individual word matching - 35% weight
-    query_words = query_lower.split()
-    text_words = set(text_lower.split())
-    
-    matched_words = 0
-    for word in query_words:
-        if len(word) < 2:
-            continue
-            
-        # Exact word match
-        if word in text_words:
-            matched_words += 1
-            score += 2.0 * min(len(word) / 4, 2)  # Length bonus
-        else:
-            # Partial word match
-            for text_word in text_words:
-                if word in text_word or text_word in word:
-                    score += 0.5
-                    break
-    
-    # All words present bonus
-    if len(query_words) > 1 and matched_words == len(query_words):
-        score += 5.0  # Strong bonus for having all words
-    
-    # Word coverage ratio
-    coverage = matched_words / max(len(query_words), 1)
-    score += coverage * 3.0
-    
-    # 3. Term frequency - 15% weight
-    for word in query_words:
-        if len(word) >= 3:
-            count = text_lower.count(word)
-            score += min(count * 0.5, 2.0)  # Diminishing returns
-    
-    # 4. Length normalization - 10% weight
-    text_length = len(text.split())
-    if 50 <= text_length <= 300:
-        score *= 1.2  # Prefer medium-length texts
-    elif text_length < 20:
-        score *= 0.7  # Penalize very short texts
-    elif text_length > 500:
-        score *= 0.9  # Slight penalty for very long texts
-    
-    # Normalize final score
-    return min(score / 10.0, 1.0)
+    if not query_lower:
+        return {}
+
+    scores = index.score(query_lower)
+    if not scores:
+        return {}
+    upper_bound = index.max_score(query_lower) or 1.0
+
+    similarities = {}
+    for position, score in scores.items():
+        similarity = score / upper_bound
+        # Exact phrase match (highest priority)
+        if query_lower in lowered_texts[position]:
+            similarity += PHRASE_MATCH_BONUS
+        similarities[position] = min(similarity, 1.0)
+    return similarities
 
 def highlight_text_advanced(text: str, query: str) -> str:
     """
     Advanced text highlighting with phrase and word priority.
     """
-    import re
-    
-    highlighted = text
     query = query.strip()
-    
     if not query:
-        return highlighted
-    
-    # 1. Highlight exact phrase match first (highest priority)
-    if len(query) > 0:
-        phrase_pattern = re.compile(f'({re.escape(query)})', re.IGNORECASE)
-        highlighted = phrase_pattern.sub(
-            r'<mark style="background: #ff6b35; color: white; font-weight: bold;">\1</mark>',
-            highlighted
-        )
-    
-    # 2. Highlight individual words (if not already highlighted as part of phrase)
-    words = query.split()
-    for word in words:
-        if len(word) > 2:  # Only highlight words longer than 2 characters
-            # Use word boundary for accurate matching, avoid double highlighting
-            word_pattern = re.compile(f'(?<!<mark[^>]*>)\\b({re.escape(word)})\\b(?![^<]*</mark>)', re.IGNORECASE)
-            highlighted = word_pattern.sub(
-                r'<mark style="background: #ffd23f;">\1</mark>',
-                highlighted
-            )
-    
-    return highlighted
+        return text
+
+    words = [re.escape(word) for word in query.split() if len(word) > 2]
+    # The phrase comes first in the alternation so it wins over its own words
+    phrase_pattern = re.escape(query)
+    word_pattern = r'\b(?:' + '|'.join(words) + r')\b' if words else None
+    pattern = re.compile(
+        f'(?P<phrase>{phrase_pattern})' + (f'|(?P<word>{word_pattern})' if word_pattern else ''),
+        re.IGNORECASE
+    )
+
+    def mark(match):
+        if match.group('phrase') is not None:
+            return f'<mark style="background: #ff6b35; color: white; font-weight: bold;">{match.group(0)}</mark>'
+        return f'<mark style="background: #ffd23f;">{match.group(0)}</mark>'
+
+    return pattern.sub(mark, text)
 
 def highlight_text_simple(text: str, query: str) -> str:
     """
@@ -217,8 +170,14 @@ class SimpleSearchHandler(http.server.BaseHTTPRequestHandler):
             self._set_headers(400)
             return {'status': 'error', 'message': 'No chunks provided'}
         
-        # Store chunks for this document
-        document_indices[document_id] = chunks
+        # Build the inverted index once so searches only touch matching postings
+        texts = [chunk.get('text', '') if isinstance(chunk, dict) else str(chunk) for chunk in chunks]
+        document_indices[document_id] = {
+            'chunks': chunks,
+            'texts': texts,
+            'lowered_texts': [text.lower() for text in texts],
+            'index': InvertedIndex(texts)
+        }
         
         logging.info(f"Indexed {len(chunks)} chunks for document {document_id}")
         
@@ -241,41 +200,34 @@ class SimpleSearchHandler(http.server.BaseHTTPRequestHandler):
             self._set_headers(404)
             return {'status': 'error', 'message': f'Document {document_id} not indexed'}
         
-        chunks = document_indices[document_id]
+        document = document_indices[document_id]
+        chunks = document['chunks']
+        texts = document['texts']
         
-        # Calculate similarity for each chunk
-        scored_results = []
-        for i, chunk in enumerate(chunks):
-            chunk_text = chunk.get('text', '') if isinstance(chunk, dict) else str(chunk)
-            
-            if not chunk_text:
-                continue
-            
-            similarity = advanced_similarity(query, chunk_text)
-            
-            # Skip results with very low similarity
-            if similarity < 0.1:
-                continue
-            
-            result = {
+        # Score only the chunks that share a term with the query
+        similarities = lexical_similarity(document['index'], query, document['lowered_texts'])
+        top_positions = heapq.nlargest(
+            top_k,
+            (position for position, similarity in similarities.items() if similarity >= MIN_SIMILARITY),
+            key=lambda position: (similarities[position], -position)
+        )
+        
+        final_results = []
+        for i in top_positions:
+            chunk = chunks[i]
+            chunk_text = texts[i]
+            similarity = similarities[i]
+            final_results.append({
                 'text': chunk_text,
                 'similarity': similarity,
                 'chunk_id': chunk.get('chunk_id', f'chunk_{i}') if isinstance(chunk, dict) else f'chunk_{i}',
                 'header': chunk.get('header', '') if isinstance(chunk, dict) else '',
                 'word_count': chunk.get('word_count', len(chunk_text.split())) if isinstance(chunk, dict) else len(chunk_text.split()),
-                'start_idx': 0,
-                'end_idx': len(chunk_text),
+                'start_idx': chunk.get('start_idx', 0) if isinstance(chunk, dict) else 0,
+                'end_idx': chunk.get('end_idx', len(chunk_text)) if isinstance(chunk, dict) else len(chunk_text),
                 'highlighted_text': highlight_text_advanced(chunk_text, query),
                 'rerank_score': similarity  # Use same score for rerank_score
-            }
-            
-            scored_results.append(result)
-        
-        # Sort by similarity
-        scored_results.sort(key=lambda x: x['similarity'], reverse=True)
-        
-        # Take top results
-        final_results = scored_results[:top_k]
+            })
         
         logging.info(f"Returning {len(final_results)} search results for query: '{query}'")
         
@@ -288,13 +240,13 @@ class SimpleSearchHandler(http.server.BaseHTTPRequestHandler):
             'total_results': len(final_results)
         }
 
-def run_server(port: int = DEFAULT_PORT):
+def run_server(port: int = DEFAULT_PORT, workers: int = DEFAULT_WORKERS, queue_size: int = DEFAULT_QUEUE_SIZE):
     """
-    Run the search server.
+    Run the search server with a pool of worker threads.
     """
     try:
-        with socketserver.TCPServer(("0.0.0.0", port), SimpleSearchHandler) as httpd:
-            logging.info(f"Starting simple search server on port {port}...")
+        with ThreadPoolTCPServer(("0.0.0.0", port), SimpleSearchHandler, workers, queue_size) as httpd:
+            logging.info(f"Starting simple search server on port {port} with {workers} workers...")
             httpd.serve_forever()
     except OSError as e:
         logging.error(f"Could not start server on port {port}: {e}")
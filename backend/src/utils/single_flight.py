@@ -0,0 +1,138 @@
+import json
+import hashlib
+import threading
+import logging
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Iterable, Iterator, Sequence
+
+from embedding_cache import normalize_text
+
+def request_key(endpoint: str, payload: Dict[str, Any], text_fields: Sequence[str] = ('query', 'question')) -> str:
+    """
+    Canonical key for a request: the endpoint plus its JSON payload with
+    keys sorted and free-text fields normalized, so requests that differ
+    only in case or whitespace share a key.
+    """
+    canonical = dict(payload)
+    for field in text_fields:
+        if isinstance(canonical.get(field), str):
+            canonical[field] = normalize_text(canonical[field])
+    body = json.dumps(canonical, sort_keys=True, separators=(',', ':'), default=str)
+    return endpoint + ':' + hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+class _Broadcast:
+    """
+    Events from one producer, replayed to any number of subscribers,
+    including ones that join after the first events were published.
+    """
+    def __init__(self):
+        self.events = []
+        self.finished = False
+        self.condition = threading.Condition()
+
+    def publish(self, event: Any):
+        with self.condition:
+            self.events.append(event)
+            self.condition.notify_all()
+
+    def finish(self):
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+    def subscribe(self) -> Iterator[Any]:
+        position = 0
+        while True:
+            with self.condition:
+                while position >= len(self.events) and not self.finished:
+                    self.condition.wait()
+                if position >= len(self.events):
+                    return
+                event = self.events[position]
+            position += 1
+            yield event
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical requests.
+
+    The first caller for a key runs the computation; callers arriving with
+    the same key while it is in flight wait for and share its result (or
+    its exception) instead of repeating the work. Nothing is cached once
+    the computation finishes.
+    """
+    def __init__(self, name: str = 'single-flight'):
+        self.name = name
+        self._calls: Dict[str, Future] = {}
+        self._streams: Dict[str, _Broadcast] = {}
+        self._lock = threading.Lock()
+        self.stats = {'executed': 0, 'coalesced': 0}
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """
+        Run fn once for all concurrent callers with the same key.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+                self.stats['executed'] += 1
+            else:
+                self.stats['coalesced'] += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def stream(self, key: str, events_fn: Callable[[], Iterable[Any]]) -> Iterator[Any]:
+        """
+        Share one event stream between concurrent callers with the same key.
+
+        The producer runs on its own thread to completion, so a subscriber
+        disconnecting never cuts the stream short for the others. Late
+        joiners replay the events published so far, then follow live.
+        """
+        with self._lock:
+            broadcast = self._streams.get(key)
+            if broadcast is None:
+                broadcast = _Broadcast()
+                self._streams[key] = broadcast
+                self.stats['executed'] += 1
+                threading.Thread(target=self._produce, args=(key, broadcast, events_fn),
+                                 name=f'{self.name}-producer', daemon=True).start()
+            else:
+                self.stats['coalesced'] += 1
+        return broadcast.subscribe()
+
+    def _produce(self, key: str, broadcast: _Broadcast, events_fn: Callable[[], Iterable[Any]]):
+        try:
+            for event in events_fn():
+                broadcast.publish(event)
+        except Exception as e:
+            logging.error(f"{self.name}: stream for {key} failed: {e}", exc_info=True)
+            broadcast.publish({'type': 'error', 'message': str(e)})
+        finally:
+            # Stop new subscribers joining before finishing the stream
+            with self._lock:
+                self._streams.pop(key, None)
+            broadcast.finish()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self.stats,
+                'in_flight': len(self._calls) + len(self._streams)
+            }
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Threaded tests for the request scheduling primitives: generation
+admission control, request coalescing and micro-batching.
+"""
+
+import sys
+import os
+import time
+import threading
+
+# The utilities import each other as top-level modules
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from generation_scheduler import GenerationScheduler, Overloaded, PRIORITY_HIGH, PRIORITY_LOW
+from single_flight import SingleFlight
+from micro_batcher import MicroBatcher
+
+def wait_until(condition, timeout=2.0):
+    """Poll until condition() is true; fail the test if it never is."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out waiting for condition"
+        time.sleep(0.005)
+
+def run_acquire(scheduler, results, name, priority, timeout):
+    """Acquire a slot on a thread, recording the outcome under name."""
+    try:
+        scheduler.acquire(priority, timeout=timeout)
+        results[name] = 'admitted'
+        scheduler.release(0.01)
+    except Overloaded as e:
+        results[name] = e
+
+def test_scheduler_deadline_expiry():
+    scheduler = GenerationScheduler(max_concurrency=1, max_queue=4)
+    scheduler.acquire()
+    results = {}
+    waiter = threading.Thread(target=run_acquire, args=(scheduler, results, 'waiter', PRIORITY_LOW, 0.2))
+    started = time.monotonic()
+    waiter.start()
+    waiter.join(2.0)
+
+    # The slot was never released, so the waiter gives up at its deadline
+    assert isinstance(results['waiter'], Overloaded)
+    assert 0.15 <= time.monotonic() - started < 1.5
+    stats = scheduler.get_stats()
+    assert stats['expired'] == 1
+    assert stats['queue_depth'] == 0
+
+    # The expired waiter is skipped when the slot frees up
+    scheduler.release(0.01)
+    assert scheduler.get_stats()['running'] == 0
+
+def test_scheduler_queue_full_retry_after():
+    scheduler = GenerationScheduler(max_concurrency=1, max_queue=1)
+    scheduler.acquire()
+    results = {}
+    queued = threading.Thread(target=run_acquire, args=(scheduler, results, 'queued', PRIORITY_LOW, 5.0))
+    queued.start()
+    wait_until(lambda: scheduler.get_stats()['queue_depth'] == 1)
+
+    # Same priority as the queued request: the newcomer is turned away with
+    # a Retry-After hint, which rag_server sends back as a 503
+    try:
+        scheduler.acquire(PRIORITY_LOW, timeout=5.0)
+        assert False, "Expected Overloaded"
+    except Overloaded as e:
+        assert e.retry_after >= 1
+    assert scheduler.get_stats()['rejected_queue_full'] == 1
+
+    scheduler.release(0.01)
+    queued.join(2.0)
+    assert results['queued'] == 'admitted'
+
+def test_scheduler_queue_full_evicts_lower_priority():
+    scheduler = GenerationScheduler(max_concurrency=1, max_queue=1)
+    scheduler.acquire()
+    results = {}
+    low = threading.Thread(target=run_acquire, args=(scheduler, results, 'low', PRIORITY_LOW, 5.0))
+    low.start()
+    wait_until(lambda: scheduler.get_stats()['queue_depth'] == 1)
+
+    high = threading.Thread(target=run_acquire, args=(scheduler, results, 'high', PRIORITY_HIGH, 5.0))
+    high.start()
+    low.join(2.0)
+    assert isinstance(results['low'], Overloaded)
+    assert results['low'].retry_after >= 1
+
+    scheduler.release(0.01)
+    high.join(2.0)
+    assert results['high'] == 'admitted'
+    stats = scheduler.get_stats()
+    assert stats['evicted'] == 1
+    assert stats['queue_depth'] == 0
+
+def test_single_flight_error_reaches_followers():
+    flight = SingleFlight('test')
+    release = threading.Event()
+    calls = []
+
+    def failing():
+        calls.append(1)
+        release.wait(2.0)
+        raise ValueError("generation failed")
+
+    errors = []
+    def call():
+        try:
+            flight.do('key', failing)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    # Let every follower join the in-flight call before the leader fails
+    wait_until(lambda: flight.get_stats()['coalesced'] == 3)
+    release.set()
+    for thread in threads:
+        thread.join(2.0)
+
+    assert len(calls) == 1
+    assert len(errors) == 4
+    assert all(str(e) == "generation failed" for e in errors)
+    assert flight.get_stats()['in_flight'] == 0
+
+    # Nothing is remembered once the call finishes
+    assert flight.do('key', lambda: 'ok') == 'ok'
+
+def test_micro_batcher_flushes_on_timeout():
+    batches = []
+    def process(items):
+        batches.append(list(items))
+        return [item * 2 for item in items]
+
+    # The batch never fills, so only the window can flush it
+    batcher = MicroBatcher(process, max_batch_size=100, max_wait_ms=50, name='test')
+    results = {}
+    def submit(name, items):
+        results[name] = list(batcher.submit(items, timeout=2.0))
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=submit, args=('a', [1, 2])),
+               threading.Thread(target=submit, args=('b', [3]))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(2.0)
+
+    assert results == {'a': [2, 4], 'b': [6]}
+    assert time.monotonic() - started < 1.0
+    assert len(batches) == 1
+    assert sorted(batches[0]) == [1, 2, 3]
+
+def main():
+    """Run all tests."""
+    for test in (test_scheduler_deadline_expiry, test_scheduler_queue_full_retry_after,
+                 test_scheduler_queue_full_evicts_lower_priority,
+                 test_single_flight_error_reaches_followers, test_micro_batcher_flushes_on_timeout):
+        test()
+        print(f"{test.__name__}: ok")
+
+if __name__ == "__main__":
+    main()
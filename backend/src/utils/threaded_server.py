@@ -0,0 +1,65 @@
+import os
+import json
+import socketserver
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# Worker threads and queued connections, configurable per deployment
+DEFAULT_WORKERS = int(os.environ.get('SERVER_WORKERS', min(32, (os.cpu_count() or 1) * 4)))
+DEFAULT_QUEUE_SIZE = int(os.environ.get('SERVER_QUEUE_SIZE', 64))
+
+class ThreadPoolTCPServer(socketserver.TCPServer):
+    """
+    TCP server that handles each connection on a bounded thread pool.
+
+    At most `workers` requests run at once and at most `queue_size` more wait
+    for a free worker. Connections beyond that are answered immediately with
+    503 so a slow request (e.g. an LLM generation) cannot block the others.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class,
+                 workers: int = DEFAULT_WORKERS, queue_size: int = DEFAULT_QUEUE_SIZE):
+        super().__init__(server_address, handler_class)
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='http-worker')
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def process_request(self, request, client_address):
+        if not self._slots.acquire(blocking=False):
+            logging.warning(f"Request queue full, rejecting connection from {client_address[0]}")
+            self._reject(request)
+            return
+        self._executor.submit(self._process_request_worker, request, client_address)
+
+    def _process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def _reject(self, request):
+        body = json.dumps({'status': 'error', 'message': 'Server busy, try again shortly'}).encode()
+        response = (
+            b'HTTP/1.0 503 Service Unavailable\r\n'
+            b'Content-Type: application/json\r\n'
+            b'Access-Control-Allow-Origin: *\r\n'
+            b'Retry-After: 1\r\n'
+            b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body
+        )
+        try:
+            request.sendall(response)
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=False)
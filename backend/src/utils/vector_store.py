@@ -0,0 +1,191 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import logging
+import threading
+import numpy as np
+from typing import List, Dict, Any, Optional, Tuple
+import faiss
+
+# Default location for persisted indexes (backend/data/vector_store)
+DEFAULT_DATA_DIR = os.environ.get(
+    'VECTOR_STORE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'vector_store')
+)
+
+INDEX_FILE = 'index.faiss'
+EMBEDDINGS_FILE = 'embeddings.npy'
+IDS_FILE = 'ids.npy'
+CHUNKS_FILE = 'chunks.json'
+META_FILE = 'meta.json'
+
+# Suffixes of a document directory being written and of the version it replaces
+TMP_SUFFIX = '.tmp'
+OLD_SUFFIX = '.old'
+
+class VectorStore:
+    """
+    On-disk store for per-document FAISS indexes.
+
+    Each document gets its own directory holding the FAISS index, the raw
+    embeddings as a .npy file (loaded memory-mapped), the vector IDs and the
+    chunk metadata as JSON, so a restarted server can serve queries without
+    re-encoding.
+
+    A save writes a complete copy beside the document and swaps it in with
+    renames. If a crash interrupts the swap, the next read recovers the new
+    copy, or failing that the previous one.
+    """
+    def __init__(self, data_dir: str = DEFAULT_DATA_DIR, model_name: Optional[str] = None):
+        self.data_dir = os.path.abspath(data_dir)
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        os.makedirs(self.data_dir, exist_ok=True)
+
+    def _document_dir(self, document_id: str) -> str:
+        # Keep directory names filesystem-safe; the hash suffix avoids collisions
+        safe_id = re.sub(r'[^A-Za-z0-9_-]', '_', str(document_id))[:64]
+        digest = hashlib.sha1(str(document_id).encode('utf-8')).hexdigest()[:8]
+        return os.path.join(self.data_dir, f'{safe_id}-{digest}')
+
+    def _recover(self, document_id: str) -> str:
+        """
+        Return the document directory, first moving a complete copy left
+        by an interrupted save into place if the directory is missing.
+        """
+        document_dir = self._document_dir(document_id)
+        if os.path.exists(os.path.join(document_dir, META_FILE)):
+            return document_dir
+        with self._lock:
+            if not os.path.exists(os.path.join(document_dir, META_FILE)):
+                # The new copy is complete once its meta file exists
+                for candidate in (document_dir + TMP_SUFFIX, document_dir + OLD_SUFFIX):
+                    if os.path.exists(os.path.join(candidate, META_FILE)):
+                        shutil.rmtree(document_dir, ignore_errors=True)
+                        os.replace(candidate, document_dir)
+                        logging.warning(f"Recovered index for document {document_id} from {candidate}")
+                        break
+        return document_dir
+
+    def has(self, document_id: str) -> bool:
+        return os.path.exists(os.path.join(self._recover(document_id), META_FILE))
+
+    def save(self, document_id: str, index: faiss.Index, embeddings: np.ndarray,
+             chunks: List[Any], extra_meta: Optional[Dict[str, Any]] = None,
+             ids: Optional[np.ndarray] = None):
+        """
+        Persist one document. Files are written to a temporary directory and
+        swapped in, so a crash never leaves a half-written document behind.
+        """
+        target_dir = self._document_dir(document_id)
+        tmp_dir = target_dir + TMP_SUFFIX
+        old_dir = target_dir + OLD_SUFFIX
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        faiss.write_index(index, os.path.join(tmp_dir, INDEX_FILE))
+        np.save(os.path.join(tmp_dir, EMBEDDINGS_FILE), np.ascontiguousarray(embeddings, dtype='float32'))
+        if ids is not None:
+            np.save(os.path.join(tmp_dir, IDS_FILE), np.asarray(ids, dtype='int64'))
+        with open(os.path.join(tmp_dir, CHUNKS_FILE), 'w', encoding='utf-8') as f:
+            json.dump(chunks, f)
+
+        meta = {
+            'document_id': document_id,
+            'model': self.model_name,
+            'count': int(index.ntotal),
+            'dimension': int(index.d)
+        }
+        if extra_meta:
+            meta.update(extra_meta)
+        # The meta file marks a complete document, so it is written last
+        with open(os.path.join(tmp_dir, META_FILE), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+
+        # Move the previous version aside rather than deleting it, so there
+        # is always a complete copy on disk
+        with self._lock:
+            shutil.rmtree(old_dir, ignore_errors=True)
+            if os.path.exists(target_dir):
+                os.replace(target_dir, old_dir)
+            os.replace(tmp_dir, target_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        logging.info(f"Persisted index for document {document_id} to {target_dir}")
+
+    def load(self, document_id: str) -> Optional[Tuple[faiss.Index, np.ndarray, Optional[np.ndarray],
+                                                         List[Any], Dict[str, Any]]]:
+        """
+        Load a persisted document.
+
+        Returns:
+            Tuple of (index, memory-mapped embeddings, vector IDs or None,
+            chunks, meta), or None if the document is not stored or was built
+            with a different model
+        """
+        document_dir = self._recover(document_id)
+        meta_path = os.path.join(document_dir, META_FILE)
+        if not os.path.exists(meta_path):
+            return None
+
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+
+            if self.model_name and meta.get('model') and meta['model'] != self.model_name:
+                logging.warning(f"Stored index for document {document_id} was built with "
+                                f"{meta['model']}, not {self.model_name}; ignoring it")
+                return None
+
+            index = faiss.read_index(os.path.join(document_dir, INDEX_FILE))
+            embeddings = np.load(os.path.join(document_dir, EMBEDDINGS_FILE), mmap_mode='r')
+            ids_path = os.path.join(document_dir, IDS_FILE)
+            ids = np.load(ids_path) if os.path.exists(ids_path) else None
+            with open(os.path.join(document_dir, CHUNKS_FILE), 'r', encoding='utf-8') as f:
+                chunks = json.load(f)
+        except Exception as e:
+            logging.error(f"Failed to load stored index for document {document_id}: {e}")
+            return None
+
+        logging.info(f"Loaded stored index for document {document_id} ({meta.get('count', 0)} vectors)")
+        return index, embeddings, ids, chunks, meta
+
+    def load_chunks(self, document_id: str) -> Optional[List[Any]]:
+        """
+        Load only the chunk metadata of a stored document, whatever model
+        built it, e.g. to re-embed the corpus with a new model.
+        """
+        chunks_path = os.path.join(self._recover(document_id), CHUNKS_FILE)
+        if not os.path.exists(chunks_path):
+            return None
+        with open(chunks_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def delete(self, document_id: str) -> bool:
+        document_dir = self._recover(document_id)
+        for leftover in (document_dir + TMP_SUFFIX, document_dir + OLD_SUFFIX):
+            shutil.rmtree(leftover, ignore_errors=True)
+        if not os.path.exists(document_dir):
+            return False
+        shutil.rmtree(document_dir, ignore_errors=True)
+        return True
+
+    def clear(self):
+        for name in os.listdir(self.data_dir):
+            shutil.rmtree(os.path.join(self.data_dir, name), ignore_errors=True)
+
+    def list_documents(self) -> List[str]:
+        document_ids = []
+        for name in os.listdir(self.data_dir):
+            meta_path = os.path.join(self.data_dir, name, META_FILE)
+            if os.path.exists(meta_path):
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    document_id = json.load(f)['document_id']
+                if name.endswith((TMP_SUFFIX, OLD_SUFFIX)):
+                    # Left by an interrupted save; move it into place if the
+                    # document directory is missing
+                    self._recover(document_id)
+                if document_id not in document_ids:
+                    document_ids.append(document_id)
+        return document_ids